@@ -0,0 +1,143 @@
+"""
+Headless batch mode: match many main users without prompts.
+
+Settings of main users are given in JSON Lines file, one main user per line:
+{"access_token": "...", "desired_age_from": 20, "desired_age_to": 30}
+Ages can be skipped, then they are taken from the last run of the user.
+
+Example: python batch.py tokens.jsonl --output batch_output.jsonl --workers 4 --pages 2
+"""
+from vk.vk_machinery import VkMachinery
+from tinder_users import MainUser
+from seen_filter import SeenUsersFilter
+from candidate_pool import CandidatePool
+from database.db import create_db
+from database.cache import ProfileCache
+from database.write_behind import write_behind
+from vocabulary import vocabulary
+from main import fetch_next_page, tact_of_app
+from config.config_app import BATCH_WORKERS, BATCH_PAGES_PER_USER, PATH_TO_BATCH_OUTPUT
+from config.config_app import PATH_TO_PROFILE_CACHE
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, List
+
+import argparse
+import json
+
+
+def read_batch_settings(path: str) -> List[Dict]:
+    """
+    Read settings of main users from JSON Lines file, empty lines are skipped
+
+    :param path: path to file
+    """
+
+    with open(path, encoding='utf8') as settings_file:
+        return [json.loads(line) for line in settings_file if line.strip()]
+
+
+def match_main_user(settings: Dict, pages: int = BATCH_PAGES_PER_USER, cache: ProfileCache = None,
+                    seen_filter: SeenUsersFilter = None, candidate_pool: CandidatePool = None) -> Dict:
+    """
+    Run search rounds for one main user. Results are saved to tinder_result like in the interactive app
+
+    :param settings: settings of main user: "access_token", optional "desired_age_from" and "desired_age_to"
+    :param pages: count of rounds of search
+    :param cache: cache of profiles shared by all main users
+    :param seen_filter: shown and blacklisted users of this main user
+    :param candidate_pool: pool where all hydrated candidates are added
+    :return: Dict with id of main user and its matches
+    """
+
+    with VkMachinery(cache=cache) as vk_client:
+        # VK limits requests per token, so every token has its own rate limiter
+        vk_client.initialize_vk_api(access_token=settings['access_token'])
+
+        main_user = MainUser(vk_client=vk_client, desired_age_from=settings.get('desired_age_from'),
+                             desired_age_to=settings.get('desired_age_to'), interactive=False)
+        try:
+            main_user_config = main_user.get_search_config_obj()
+
+            matches = []
+            for _ in range(pages):
+                list_of_tinder_users = fetch_next_page(vk_client, main_user, main_user_config,
+                                                       seen_filter=seen_filter, verbose=False,
+                                                       candidate_pool=candidate_pool)
+                if not list_of_tinder_users:
+                    break
+
+                main_user.update_search_offset(main_user_config['offset_for_search'])
+                matches.extend(tact_of_app(main_user=main_user, tinder_users=list_of_tinder_users, scored=True,
+                                           seen_filter=seen_filter))
+        finally:
+            main_user.close()
+
+    return {'vk_id': main_user.tinder_user_id,
+            'first_name': main_user.first_name,
+            'last_name': main_user.last_name,
+            'desired_age_from': main_user.desired_age_from,
+            'desired_age_to': main_user.desired_age_to,
+            'matches': matches}
+
+
+def run_batch(list_of_settings: List[Dict], pages: int = BATCH_PAGES_PER_USER,
+              workers: int = BATCH_WORKERS, cache: ProfileCache = None,
+              candidate_pool: CandidatePool = None) -> Iterator[Dict]:
+    """
+    Match main users in a pool of threads and give their results as they are ready.
+    A main user which failed gives {'index': ..., 'error': ...}, the others are not stopped
+
+    :param list_of_settings: settings of main users (see match_main_user)
+    :param pages: count of rounds of search for every main user
+    :param workers: count of main users matched at the same time
+    :param cache: cache of profiles shared by all main users
+    :param candidate_pool: pool where all hydrated candidates are added
+    """
+
+    # history is loaded once, every main user gets its own copy, so users shown to one main user
+    # are still matched for the others
+    seen_filter = SeenUsersFilter.load()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(match_main_user, settings, pages, cache, seen_filter.copy(), candidate_pool): index
+                   for index, settings in enumerate(list_of_settings)}
+
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:  # a broken account must not stop the nightly batch
+                result = {'error': f'{type(e).__name__}: {e}'}
+
+            yield dict(result, index=futures[future])
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description='Match many main users without prompts')
+    parser.add_argument('settings', help='JSON Lines file with settings of main users')
+    parser.add_argument('--output', default=PATH_TO_BATCH_OUTPUT, help='JSON Lines file for results')
+    parser.add_argument('--pages', type=int, default=BATCH_PAGES_PER_USER, help='rounds of search per main user')
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS, help='main users matched at the same time')
+    args = parser.parse_args(argv)
+
+    create_db()
+
+    vocabulary.open(PATH_TO_PROFILE_CACHE)
+    profile_cache = ProfileCache()
+    try:
+        with open(args.output, encoding='utf8', mode='w') as output:
+            for result in run_batch(read_batch_settings(args.settings), pages=args.pages, workers=args.workers,
+                                    cache=profile_cache, candidate_pool=CandidatePool()):
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+
+                status = result['error'] if 'error' in result else f'{len(result["matches"])} matches'
+                print(f'{result["index"] + 1}.{status}')
+    finally:
+        profile_cache.close()
+        vocabulary.close()
+        write_behind.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+Benchmark of the search round of the app (search, hydration, scoring, selection of the best users and
+fetching of their photos) against the local mock of VK API. Results are printed as JSON, so they can be
+compared between commits.
+
+Example: python -m benchmarks.bench_search --rounds 50 --latency 0.05 --error-rate 0.01 --output bench.json
+"""
+from vk.vk_machinery import VkMachinery
+from vk.async_vk_machinery import AsyncVkMachinery
+from vk.rate_limiter import set_rate_limit
+from tinder_users import MainUser
+from seen_filter import SeenUsersFilter
+from database.cache import ProfileCache
+from main import fetch_next_page, match_tinder_users
+from benchmarks.mock_vk_server import add_api_arguments
+from metrics import metrics
+
+from typing import Dict, List
+from urllib import request as urllib_request
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+BENCHMARK_ACCESS_TOKEN = 'benchmark'
+
+
+class BenchmarkMainUser(MainUser):
+    """
+    Main user whose settings of search are given. Nothing is asked and nothing is read from or written to database
+    """
+
+    def __init__(self, vk_client, desired_age_from: int, desired_age_to: int, count_for_search: int):
+        super().__init__(vk_client=vk_client, count_for_search=count_for_search)
+        self.desired_age_from = desired_age_from
+        self.desired_age_to = desired_age_to
+
+    def _init_main_user(self, debug) -> None:
+        self._init_default_params(self._get_profile_info())
+
+    def update_search_offset(self, offset_for_setup) -> None:
+        pass
+
+
+def get_percentiles(values: List[float]) -> Dict[str, float]:
+    """
+    Percentiles by nearest rank, mean and max of values
+    """
+
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def percentile(part):
+        return values[min(len(values) - 1, max(0, int(round(part * len(values))) - 1))]
+
+    return {'p50': percentile(0.5), 'p90': percentile(0.9), 'p99': percentile(0.99),
+            'max': values[-1], 'mean': sum(values) / len(values)}
+
+
+def start_mock_server(args: argparse.Namespace) -> (subprocess.Popen, str):
+    """
+    Start the mock of VK API in another process, so it does not compete with the benchmark for the GIL
+
+    :return: process of server and its url
+    """
+
+    command = [sys.executable, '-m', 'benchmarks.mock_vk_server', '--port', '0',
+               '--users', str(args.users), '--friends', str(args.friends), '--groups', str(args.groups),
+               '--photos', str(args.photos), '--closed-rate', str(args.closed_rate),
+               '--latency', str(args.latency), '--error-rate', str(args.error_rate), '--seed', str(args.seed)]
+    root_of_repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    server_process = subprocess.Popen(command, cwd=root_of_repository, stdout=subprocess.PIPE,
+                                      universal_newlines=True)
+    return server_process, server_process.stdout.readline().strip()
+
+
+def get_stats_of_mock_server(server_url: str, reset: bool = False) -> Dict:
+    with urllib_request.urlopen(f'{server_url}/stats' + ('?reset=1' if reset else '')) as response:
+        return json.load(response)
+
+
+def run_benchmark(server_url: str, args: argparse.Namespace) -> Dict:
+    """
+    Run rounds of search against the mock of VK API and measure them
+
+    :param server_url: url of the mock server
+    :param args: settings of benchmark
+    :return: results of benchmark
+    """
+
+    set_rate_limit(BENCHMARK_ACCESS_TOKEN, rate=args.requests_per_second, capacity=args.burst)
+    profile_cache = ProfileCache(path=':memory:') if args.cache else None
+
+    with VkMachinery(cache=profile_cache, api_url=f'{server_url}/method') as vk_client:
+        vk_client.initialize_vk_api(access_token=BENCHMARK_ACCESS_TOKEN)
+        async_vk_client = AsyncVkMachinery(vk_client=vk_client) if args.use_async else None
+
+        main_user = BenchmarkMainUser(vk_client, desired_age_from=args.age_from, desired_age_to=args.age_to,
+                                      count_for_search=args.page_size)
+        main_user_config = main_user.get_search_config_obj()
+        seen_filter = SeenUsersFilter()
+        # requests for profile of the main user are not part of rounds
+        get_stats_of_mock_server(server_url, reset=True)
+        metrics.reset()
+
+        if args.trace_memory:
+            tracemalloc.start()
+
+        count_of_candidates, latencies = 0, []
+        started_at = time.perf_counter()
+        for _ in range(args.rounds):
+            round_started_at = time.perf_counter()
+
+            tinder_users = fetch_next_page(vk_client, main_user, main_user_config, async_vk_client=async_vk_client,
+                                           seen_filter=seen_filter, verbose=False)
+            match_tinder_users(main_user, tinder_users, scored=True)
+
+            latencies.append(time.perf_counter() - round_started_at)
+            count_of_candidates += len(tinder_users)
+        elapsed = time.perf_counter() - started_at
+        api_stats = get_stats_of_mock_server(server_url)
+
+        results = {'rounds': args.rounds,
+                   'candidates': count_of_candidates,
+                   'elapsed_seconds': elapsed,
+                   'candidates_per_second': count_of_candidates / elapsed if elapsed else 0.0,
+                   'round_latency_seconds': get_percentiles(latencies),
+                   'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   'api_requests': api_stats['requests'],
+                   'api_calls': api_stats['calls'],
+                   'api_errors': api_stats['errors'],
+                   'api_requests_per_candidate': sum(api_stats['requests'].values()) / max(count_of_candidates, 1),
+                   'api_calls_per_candidate': sum(api_stats['calls'].values()) / max(count_of_candidates, 1),
+                   'metrics': metrics.snapshot()}
+
+        if args.trace_memory:
+            results['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        if async_vk_client is not None:
+            async_vk_client.close()
+
+    if profile_cache is not None:
+        results['cache'] = profile_cache.stats()
+        profile_cache.close()
+
+    return results
+
+
+def main(argv: List[str] = None) -> Dict:
+    parser = argparse.ArgumentParser(description='Benchmark of the search round against the local mock of VK API')
+    parser.add_argument('--rounds', type=int, default=20, help='count of search rounds')
+    parser.add_argument('--page-size', type=int, default=15, help='count of users in one page of search')
+    parser.add_argument('--age-from', type=int, default=20)
+    parser.add_argument('--age-to', type=int, default=30)
+    parser.add_argument('--async', dest='use_async', action='store_true', help='hydrate users with asyncio')
+    parser.add_argument('--cache', action='store_true', help='use in-memory cache of profiles')
+    parser.add_argument('--requests-per-second', type=float, default=1000.0, help='client-side rate limit')
+    parser.add_argument('--burst', type=int, default=10, help='burst of client-side rate limit')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='measure peak of Python allocations (it slows the benchmark down)')
+    parser.add_argument('--output', help='also write results to this file')
+    add_api_arguments(parser)
+    args = parser.parse_args(argv)
+
+    server_process, server_url = start_mock_server(args)
+    try:
+        # messages of the app go to stderr, so stdout is valid JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            results = run_benchmark(server_url, args)
+    finally:
+        server_process.terminate()
+        server_process.wait()
+
+    results['settings'] = {key: value for key, value in vars(args).items() if key != 'output'}
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, encoding='utf8', mode='w') as output:
+            json.dump(results, output, indent=2)
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
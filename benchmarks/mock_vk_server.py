@@ -0,0 +1,335 @@
+"""
+Local stand-in for api.vk.com which serves synthetic users. It is used by the benchmarks,
+so throughput of the app can be measured without network and real tokens.
+
+Run it standalone: python -m benchmarks.mock_vk_server --port 8080 --latency 0.05
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+
+MAIN_USER_ID = 1
+
+_artists = ['Queen', 'Nirvana', 'Metallica', 'Radiohead', 'Muse', 'Coldplay', 'Kino', 'Aria', 'Splin',
+            'Nautilus Pompilius', 'Zemfira', 'Bi-2', 'Daft Punk', 'Massive Attack', 'Portishead', 'Bjork']
+_books = ['War and Peace', 'Crime and Punishment', 'The Master and Margarita', 'Dead Souls', 'Oblomov',
+          'Fathers and Sons', 'Anna Karenina', 'The Idiot', 'Dune', 'Solaris', 'Roadside Picnic', 'We']
+
+_api_call_pattern = re.compile(r'API\.(?P<method>[\w.]+)\((?P<params>\{[^{}]*\})\)')
+
+
+class MockVkApi:
+    """
+    Synthetic data and logic of methods of VK API. Every user is generated from its id, so answers are stable
+    """
+
+    def __init__(self, count_of_users: int = 100000, count_of_friends: int = 150, count_of_groups: int = 50,
+                 count_of_photos: int = 10, closed_rate: float = 0.3, friend_pool: int = 20000,
+                 group_pool: int = 5000, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0,
+                 invalid_tokens: Iterable[str] = ()):
+        """
+        :param count_of_users: count of users which can be found by users.search
+        :param count_of_friends: mean count of friends of user
+        :param count_of_groups: mean count of groups of user
+        :param count_of_photos: count of profile photos of user
+        :param closed_rate: part of users with closed profiles
+        :param friend_pool: ids of friends are taken from range(friend_pool), so users have mutual friends
+        :param group_pool: ids of groups are taken from range(group_pool)
+        :param latency: delay of every response in seconds
+        :param error_rate: part of requests which are answered with error 6 (too many requests per second)
+        :param seed: seed of generated data
+        :param invalid_tokens: tokens which are answered with error 5 (user authorization failed)
+        """
+
+        self.count_of_users = count_of_users
+        self.count_of_friends = count_of_friends
+        self.count_of_groups = count_of_groups
+        self.count_of_photos = count_of_photos
+        self.closed_rate = closed_rate
+        self.friend_pool = friend_pool
+        self.group_pool = group_pool
+        self.latency = latency
+        self.error_rate = error_rate
+        self.seed = seed
+        self.invalid_tokens = set(invalid_tokens)
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = {}  # count of HTTP requests per method
+        self.calls = {}  # count of calls per method, sub-calls of execute are counted too
+        self.errors = 0
+
+        self._methods = {'users.search': self.users_search,
+                         'users.get': self.users_get,
+                         'friends.get': self.friends_get,
+                         'friends.getMutual': self.friends_get_mutual,
+                         'users.getSubscriptions': self.users_get_subscriptions,
+                         'photos.get': self.photos_get}
+
+    def _get_random_of_user(self, user_id: int, field: str) -> random.Random:
+        return random.Random(f'{self.seed}:{field}:{user_id}')
+
+    def _get_count(self, rnd: random.Random, mean: int) -> int:
+        return rnd.randint(mean // 2, mean + mean // 2)
+
+    def _count(self, counter: Dict[str, int], method: str) -> None:
+        with self._lock:
+            counter[method] = counter.get(method, 0) + 1
+
+    def stats(self, reset: bool = False) -> Dict:
+        """
+        Count of requests and calls per method
+
+        :param reset: reset counters after reading
+        """
+
+        with self._lock:
+            stats = {'requests': dict(self.requests), 'calls': dict(self.calls), 'errors': self.errors}
+            if reset:
+                self.requests, self.calls, self.errors = {}, {}, 0
+
+        return stats
+
+    def handle(self, method: str, params: Dict[str, str]) -> Dict:
+        """
+        Answer on request like VK API does
+
+        :param method: method of VK API
+        :param params: params of request
+        :return: body of response
+        """
+
+        self._count(self.requests, method)
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            is_failed = self._random.random() < self.error_rate
+            self.errors += is_failed
+        if is_failed:
+            return {'error': {'error_code': 6, 'error_msg': 'Too many requests per second'}}
+        if params.get('access_token') in self.invalid_tokens:
+            return {'error': {'error_code': 5, 'error_msg': 'User authorization failed: invalid access_token'}}
+
+        if method == 'execute':
+            return {'response': self.execute(params['code'])}
+        if method not in self._methods:
+            return {'error': {'error_code': 3, 'error_msg': 'Unknown method passed'}}
+
+        self._count(self.calls, method)
+        return {'response': self._methods[method](params)}
+
+    def execute(self, code: str) -> List:
+        """
+        Run VKScript of form "return [API.method({...}), ...];". A failed sub-call gives false
+        """
+
+        results = []
+        for api_call in _api_call_pattern.finditer(code):
+            method = api_call.group('method')
+            self._count(self.calls, method)
+            if method not in self._methods:
+                results.append(False)
+                continue
+
+            params = {key: str(value) for key, value in json.loads(api_call.group('params')).items()}
+            results.append(self._methods[method](params))
+
+        return results
+
+    def get_profile(self, user_id: int) -> Dict:
+        rnd = self._get_random_of_user(user_id, 'profile')
+
+        return {'id': user_id,
+                'first_name': f'Name{user_id}',
+                'last_name': f'Surname{user_id}',
+                'is_closed': user_id != MAIN_USER_ID and rnd.random() < self.closed_rate,
+                'can_access_closed': True,
+                'sex': rnd.choice((1, 2)),
+                'bdate': f'{rnd.randint(1, 28)}.{rnd.randint(1, 12)}.{rnd.randint(1975, 2002)}',
+                'city': {'id': 1, 'title': 'Moscow'},
+                'music': ', '.join(rnd.sample(_artists, rnd.randint(0, 5))),
+                'books': ', '.join(rnd.sample(_books, rnd.randint(0, 4))),
+                'movies': ''}
+
+    def users_search(self, params: Dict[str, str]) -> Dict:
+        count, offset = int(params.get('count', 20)), int(params.get('offset', 0))
+        # ids of found users start after the main user
+        found_ids = range(MAIN_USER_ID + 1 + offset, MAIN_USER_ID + 1 + min(offset + count, self.count_of_users))
+
+        fields_of_search = ('id', 'first_name', 'last_name', 'is_closed', 'can_access_closed')
+
+        items = []
+        for user_id in found_ids:
+            profile = self.get_profile(user_id)
+            items.append({field: profile[field] for field in fields_of_search})
+
+        return {'count': self.count_of_users, 'items': items}
+
+    def users_get(self, params: Dict[str, str]) -> List[Dict]:
+        user_ids = params.get('user_ids')
+        if not user_ids:
+            return [self.get_profile(MAIN_USER_ID)]
+
+        return [self.get_profile(int(user_id)) for user_id in user_ids.split(',')]
+
+    def friends_get(self, params: Dict[str, str]) -> Dict:
+        user_id = int(params.get('user_id', MAIN_USER_ID))
+        rnd = self._get_random_of_user(user_id, 'friends')
+        friends = rnd.sample(range(self.friend_pool), min(self._get_count(rnd, self.count_of_friends),
+                                                          self.friend_pool))
+
+        return {'count': len(friends), 'items': friends}
+
+    def friends_get_mutual(self, params: Dict[str, str]) -> List[Dict]:
+        # the owner of token is the main user
+        friends_of_main_user = set(self.friends_get({'user_id': MAIN_USER_ID})['items'])
+
+        common_friends = []
+        for user_id in params['target_uids'].split(','):
+            common = sorted(friends_of_main_user.intersection(self.friends_get({'user_id': user_id})['items']))
+            common_friends.append({'id': int(user_id), 'common_friends': common, 'common_count': len(common)})
+
+        return common_friends
+
+    def users_get_subscriptions(self, params: Dict[str, str]) -> Dict:
+        user_id = int(params.get('user_id', MAIN_USER_ID))
+        rnd = self._get_random_of_user(user_id, 'groups')
+        groups = rnd.sample(range(self.group_pool), min(self._get_count(rnd, self.count_of_groups),
+                                                        self.group_pool))
+
+        return {'users': {'count': 0, 'items': []}, 'groups': {'count': len(groups), 'items': groups}}
+
+    def photos_get(self, params: Dict[str, str]) -> Dict:
+        user_id = int(params['owner_id'])
+        rnd = self._get_random_of_user(user_id, 'photos')
+
+        items = [{'id': photo_id, 'owner_id': user_id, 'likes': {'user_likes': 0, 'count': rnd.randint(0, 500)},
+                  'sizes': [{'type': size, 'url': f'https://mock.vk/{user_id}/{photo_id}_{size}.jpg'}
+                            for size in ('s', 'm', 'x')]}
+                 for photo_id in range(self.count_of_photos)]
+
+        return {'count': len(items), 'items': items}
+
+
+class _MockVkRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like api.vk.com
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        self._answer(url.path, params)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf8')
+        params = {key: values[-1] for key, values in parse_qs(body).items()}
+        self._answer(urlparse(self.path).path, params)
+
+    def _answer(self, path: str, params: Dict[str, str]) -> None:
+        if path == '/stats':
+            answer = self.server.api.stats(reset='reset' in params)
+        elif path.startswith('/method/'):
+            answer = self.server.api.handle(path[len('/method/'):], params)
+        else:
+            self.send_error(404)
+            return
+
+        body = json.dumps(answer).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockVkServer:
+    """
+    HTTP server of MockVkApi on localhost. Use its "api_url" as api_url of VkMachinery
+    """
+
+    def __init__(self, api: MockVkApi = None, host: str = '127.0.0.1', port: int = 0):
+        """
+        :param api: data and logic of methods, by default MockVkApi()
+        :param host: host of server
+        :param port: port of server, 0 means any free port
+        """
+
+        self.api = api or MockVkApi()
+        self._server = ThreadingHTTPServer((host, port), _MockVkRequestHandler)
+        self._server.daemon_threads = True
+        self._server.api = self.api
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def api_url(self) -> str:
+        return f'{self.url}/method'
+
+    def start(self) -> 'MockVkServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def add_api_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Add arguments of MockVkApi to parser of command line
+    """
+
+    parser.add_argument('--users', type=int, default=100000, help='count of users which can be found')
+    parser.add_argument('--friends', type=int, default=150, help='mean count of friends of user')
+    parser.add_argument('--groups', type=int, default=50, help='mean count of groups of user')
+    parser.add_argument('--photos', type=int, default=10, help='count of profile photos of user')
+    parser.add_argument('--closed-rate', type=float, default=0.3, help='part of users with closed profiles')
+    parser.add_argument('--latency', type=float, default=0.0, help='delay of every response in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='part of requests answered with error 6')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def create_api_from_arguments(args: argparse.Namespace) -> MockVkApi:
+    return MockVkApi(count_of_users=args.users, count_of_friends=args.friends, count_of_groups=args.groups,
+                     count_of_photos=args.photos, closed_rate=args.closed_rate, latency=args.latency,
+                     error_rate=args.error_rate, seed=args.seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local mock of VK API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    add_api_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockVkServer(create_api_from_arguments(args), host=args.host, port=args.port)
+    # the first line tells where the server is, benchmarks read it
+    print(server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.close()
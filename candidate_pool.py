@@ -0,0 +1,244 @@
+from config.config_app import POINT_OF_GROUP_UNIT, POINT_OF_FRIEND_UNIT, COUNT_OF_TOP_MATCHES, CANDIDATE_POOL_SHORTLIST
+from config.config_app import CANDIDATE_POOL_LSH_MIN_SIZE
+from tinder_users import TinderUser, CandidateRecord, get_feature_profile, select_top_tinder_users
+from tinder_users import add_terms_to_vocabulary
+from minhash import MinHasher, LshIndex, get_minhash_features
+from scoring import score_candidates
+from database import db
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+from array import array
+
+import heapq
+import threading
+
+
+def _record_to_row(record: CandidateRecord, signature: Optional[array]) -> Tuple:
+    age = record.age if isinstance(record.age, int) else None
+    sex = record.sex if isinstance(record.sex, int) else None
+    city = record.city if isinstance(record.city, int) else None
+
+    return (record.vk_id, record.first_name, record.last_name, sex, age, city, record.movies, record.music,
+            record.books, list(record.friends), list(record.groups),
+            list(signature) if signature is not None else None)
+
+
+def _record_from_row(row: Tuple) -> Tuple[CandidateRecord, Optional[array]]:
+    record = CandidateRecord()
+    (record.vk_id, record.first_name, record.last_name, record.sex, age, record.city, record.movies,
+     record.music, record.books, record.friends, record.groups, signature) = row
+    record.age = age if age is not None else 'closed'
+
+    return record, array('i', signature) if signature is not None else None
+
+
+def _get_record_features(record: CandidateRecord) -> Set[int]:
+    return get_minhash_features(record.groups, record.friends, record.music_terms, record.book_terms)
+
+
+class CandidatePool:
+    """
+    All hydrated candidates which we have ever seen, with inverted indexes group -> candidates and
+    friend -> candidates. The best candidates for the main user are found by lookups in the indexes,
+    without requests to VK API.
+
+    Every candidate has a MinHash signature of its groups, friends and terms of music and books. In large pools
+    the shortlist is taken from LSH index of signatures, so ranking does not touch all candidates which have
+    one common group with the main user.
+
+    Candidates are persisted to the table "tinder_candidate_pool" (friends and groups are integer
+    arrays with GIN indexes, signatures are stored too), so the pool grows across runs.
+
+    With USE_MUTUAL_FRIENDS candidates are hydrated without full lists of friends (common friends depend on
+    the main user, see VkMachinery.get_friends_and_groups_of_users). A candidate added without friends keeps
+    the friends which are already known, but candidates whose full lists were never fetched are found
+    by common groups only.
+    """
+
+    def __init__(self, records: Iterable[CandidateRecord] = (), persist: bool = True,
+                 lsh_min_size: int = CANDIDATE_POOL_LSH_MIN_SIZE):
+        """
+        :param records: initial candidates
+        :param persist: save added candidates to the database
+        :param lsh_min_size: min size of pool where the shortlist is found by LSH index
+        """
+
+        self.persist = persist
+        self.lsh_min_size = lsh_min_size
+
+        self._lock = threading.Lock()
+        self._records: Dict[int, CandidateRecord] = {}
+        self._group_index: Dict[int, Set[int]] = {}
+        self._friend_index: Dict[int, Set[int]] = {}
+        self._hasher = MinHasher()
+        self._lsh_index = LshIndex(permutations=self._hasher.permutations)
+
+        with self._lock:
+            for record in records:
+                self._add(record)
+
+    @classmethod
+    def load(cls, main_user=None, persist: bool = True) -> 'CandidatePool':
+        """
+        Create pool from the table "tinder_candidate_pool"
+
+        :param main_user: if it is given, only candidates with common friends or groups are loaded
+        :param persist: save added candidates to the database
+        """
+
+        if main_user is None:
+            rows = db.get_pool_candidates()
+        else:
+            rows = db.get_pool_candidates(friends=main_user.friends, groups=main_user.groups)
+        rows = list(rows)
+        # new terms of all candidates are written to the vocabulary at once
+        add_terms_to_vocabulary((row[7] for row in rows), (row[8] for row in rows))
+
+        candidate_pool = cls(persist=persist)
+        with candidate_pool._lock:
+            for row in rows:
+                candidate_pool._add(*_record_from_row(row))
+
+        return candidate_pool
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __contains__(self, vk_id: int) -> bool:
+        return int(vk_id) in self._records
+
+    def _keep_known_friends(self, record: CandidateRecord) -> None:
+        # a record without friends (e.g. hydrated with common friends only) does not wipe the known ones
+        known_record = self._records.get(record.vk_id)
+        if not len(record.friends) and known_record is not None and len(known_record.friends):
+            record.friends = known_record.friends
+
+    def _add(self, record: CandidateRecord, signature: Optional[array] = None) -> None:
+        if record.vk_id in self._records:
+            self._keep_known_friends(record)
+            self._remove_from_indexes(self._records[record.vk_id])
+        self._records[record.vk_id] = record
+
+        for group_id in record.groups:
+            self._group_index.setdefault(group_id, set()).add(record.vk_id)
+        for friend_id in record.friends:
+            self._friend_index.setdefault(friend_id, set()).add(record.vk_id)
+
+        # a stored signature of other length was calculated with other settings of MinHash
+        if signature is None or len(signature) != self._hasher.permutations:
+            signature = self._hasher.signature(_get_record_features(record))
+        self._lsh_index.add(record.vk_id, signature)
+
+    def _remove_from_indexes(self, record: CandidateRecord) -> None:
+        for index, ids in ((self._group_index, record.groups), (self._friend_index, record.friends)):
+            for id_of_index in ids:
+                index[id_of_index].discard(record.vk_id)
+                if not index[id_of_index]:
+                    del index[id_of_index]
+
+    def add_many(self, tinder_users: Iterable[TinderUser]) -> None:
+        """
+        Add hydrated Tinder Users to the pool (a known candidate is replaced with its fresh data)
+        """
+
+        records = [tinder_user.record for tinder_user in tinder_users]
+        if not records:
+            return
+
+        with self._lock:
+            for record in records:
+                self._keep_known_friends(record)
+
+        # signatures are calculated out of the lock
+        signatures = [self._hasher.signature(_get_record_features(record)) for record in records]
+        with self._lock:
+            for record, signature in zip(records, signatures):
+                self._add(record, signature)
+
+        if self.persist:
+            db.save_pool_candidates(_record_to_row(record, signature)
+                                    for record, signature in zip(records, signatures))
+
+    def count_overlaps(self, main_user) -> Dict[int, float]:
+        """
+        Points of common groups and friends of every candidate which has at least one of them
+
+        :param main_user: Instance of class MainUser(TinderUser)
+        :return: Dict like {vk_id: points}
+        """
+
+        profile = get_feature_profile(main_user)
+
+        points = {}
+        with self._lock:
+            for index, ids, point in ((self._group_index, profile.groups, POINT_OF_GROUP_UNIT),
+                                      (self._friend_index, profile.friends, POINT_OF_FRIEND_UNIT)):
+                for id_of_index in ids:
+                    for vk_id in index.get(id_of_index, ()):
+                        points[vk_id] = points.get(vk_id, 0.0) + point
+
+        return points
+
+    def _get_overlapping_candidates(self, main_user, count: int,
+                                    is_excluded: Callable[[int], bool] = None) -> List[int]:
+        """
+        Ids of candidates with the most points of common groups and friends with the main user
+        """
+
+        points = self.count_overlaps(main_user)
+        points.pop(main_user.tinder_user_id, None)
+        if is_excluded is not None:
+            points = {vk_id: point for vk_id, point in points.items() if not is_excluded(vk_id)}
+
+        return heapq.nlargest(count, points, key=points.get)
+
+    def _get_similar_candidates(self, main_user, count: int, is_excluded: Callable[[int], bool] = None) -> List[int]:
+        """
+        Ids of candidates which are the most similar to the main user by MinHash signatures
+        """
+
+        profile = get_feature_profile(main_user)
+        signature = self._hasher.signature(get_minhash_features(profile.groups, profile.friends,
+                                                                profile.music_terms, profile.book_terms))
+
+        def is_skipped(vk_id: int) -> bool:
+            return vk_id == main_user.tinder_user_id or (is_excluded is not None and is_excluded(vk_id))
+
+        with self._lock:
+            return self._lsh_index.query(signature, count, is_excluded=is_skipped)
+
+    def best_candidates(self, main_user, count: int = COUNT_OF_TOP_MATCHES,
+                        shortlist: int = CANDIDATE_POOL_SHORTLIST,
+                        is_excluded: Callable[[int], bool] = None) -> List[TinderUser]:
+        """
+        Rank candidates of the pool for the main user without requests to VK API.
+
+        Candidates with the most points of common groups and friends are taken from the indexes, then
+        "shortlist" of them are scored exactly (common music, books and age are added).
+        In pools with at least lsh_min_size candidates only hits of LSH index are ranked: the shortlist is
+        the most similar of them by MinHash signatures. The indexes are scanned only when LSH finds less
+        than "count" candidates (LSH finds only candidates with a large Jaccard similarity)
+
+        :param main_user: Instance of class MainUser(TinderUser)
+        :param count: how many candidates to return
+        :param shortlist: how many candidates are scored exactly
+        :param is_excluded: function which says if candidate with this id must be skipped
+        :return: List of Tinder Users sorted by score, the best one is the last one (see select_top_tinder_users)
+        """
+
+        count_of_shortlisted = max(shortlist, count)
+        if len(self) >= self.lsh_min_size:
+            shortlisted_ids = self._get_similar_candidates(main_user, count_of_shortlisted, is_excluded)
+            if len(shortlisted_ids) < count:
+                similar_ids = set(shortlisted_ids)
+                overlapping_ids = self._get_overlapping_candidates(main_user, count_of_shortlisted, is_excluded)
+                shortlisted_ids += [vk_id for vk_id in overlapping_ids
+                                    if vk_id not in similar_ids][:count_of_shortlisted - len(shortlisted_ids)]
+        else:
+            shortlisted_ids = self._get_overlapping_candidates(main_user, count_of_shortlisted, is_excluded)
+
+        with self._lock:
+            candidates = [TinderUser(vk_client=main_user.vk_client, record=self._records[vk_id])
+                          for vk_id in shortlisted_ids]
+
+        score_candidates(main_user, candidates)
+        return select_top_tinder_users(candidates, count)
@@ -12,15 +12,120 @@ OAUTH_LINK = 'https://oauth.vk.com/authorize?client_id=549005' \
 
 DB_NAME = 'tinderdb'
 DB_USER = 'tinderuser'
+DB_POOL_MIN_CONNECTIONS = 1
+DB_POOL_MAX_CONNECTIONS = 5
+# results, blacklist and favorites are written in bulk from a background thread (see database/write_behind.py):
+# a write waits at most so many seconds, or less when so many persons are buffered
+WRITE_BEHIND_FLUSH_INTERVAL = 1.0
+WRITE_BEHIND_MAX_BUFFERED = 1000
+# after so many failed flushes in a row persons are written one by one and persons which fail alone are dropped
+WRITE_BEHIND_MAX_FAILED_FLUSHES = 3
+# max count of persons in every buffer while the database is unavailable, the oldest ones are dropped
+WRITE_BEHIND_BUFFER_LIMIT = 100000
 
 PATH_TO_OUTPUT_RESULT = 'output.json'
 PATH_TO_DATA_FOR_TEST = os.path.join('tests', 'data_for_test.txt')
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# local cache of data of VK users (see database/cache.py), time to live of every field is in seconds
+PATH_TO_PROFILE_CACHE = os.path.join(BASE_DIR, 'profile_cache.sqlite3')
+PROFILE_CACHE_TTL = {'profile': 7 * 24 * 3600,
+                     'friends': 24 * 3600,
+                     'groups': 24 * 3600,
+                     'photos': 3 * 24 * 3600}
+PROFILE_CACHE_MAX_ENTRIES = 200000
+# vocabulary of terms of music, books and movies is kept in the file of the profile cache (see vocabulary.py),
+# SQLite gives ids to new terms, so processes which share the file get the same ids
+# snapshot of the main user (profile, friends, groups) is kept in the same file, while it is younger
+# than so many seconds the app starts without requests to VK API and refreshes it in background
+MAIN_USER_SNAPSHOT_TTL = 7 * 24 * 3600
+
 STANDARD_SEARCH_OFFSET = 30
+# state of the main user (ages and offset of search) is kept in memory and saved to "last_run_state"
+# at most once in so many seconds, on close and at exit (see database/session_state.py)
+SESSION_STATE_CHECKPOINT_INTERVAL = 30.0
+# how many pages in a row may have only closed profiles before the session is restarted
+MAX_COUNT_OF_EMPTY_PAGES = 12
+
+# count of best matched users which are shown after every round of search
+COUNT_OF_TOP_MATCHES = 11
 
 VERSION_VK_API = 5.92
 
+# VK allows at most 25 API calls inside a single "execute" request
+MAX_CALLS_IN_EXECUTE = 25
+# friends of candidates are fetched as common friends with the main user (friends.getMutual takes up to 100 users
+# per call) instead of full lists. Common friends belong to the main user's view of candidate (TinderUser), they
+# are not cached, not added to the candidate pool and not persisted
+USE_MUTUAL_FRIENDS = True
+MAX_TARGETS_OF_GET_MUTUAL = 100
+
+# metrics of calls of VK API and database (see metrics.py): upper bounds of buckets of latency in seconds,
+# path of json file where metrics are saved on exit and port of Prometheus endpoint (None turns them off)
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_DUMP_PATH = None
+METRICS_PORT = None
+
+# candidate pool (see candidate_pool.py): count of candidates with the largest overlap of groups and friends
+# which are scored exactly when the best candidates are chosen from the pool
+CANDIDATE_POOL_SHORTLIST = 300
+# in pools with at least so many candidates the shortlist is found by LSH index of MinHash signatures
+# of groups, friends and terms (see minhash.py) instead of exact overlaps
+CANDIDATE_POOL_LSH_MIN_SIZE = 20000
+# signatures are stored with candidates, they must be recalculated if permutations or seed are changed
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 32
+MINHASH_SEED = 1
+
+# headless batch mode (see batch.py): count of main users matched at the same time
+# and count of pages of matches for every main user
+BATCH_WORKERS = 4
+BATCH_PAGES_PER_USER = 1
+PATH_TO_BATCH_OUTPUT = 'batch_output.jsonl'
+
+# match server (see server.py): address and count of threads for requests to VK API and to the database
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8000
+SERVER_WORKERS = 8
+
+# base url of methods of VK API
+VK_API_URL = 'https://api.vk.com/method'
+
+# VK gives at most 1000 users per request of users.search and at most 1000 results of one query,
+# high-volume search splits the query into shards by age (see VkMachinery.iter_users_search_sharded)
+VK_SEARCH_MAX_RESULTS = 1000
+SEARCH_SHARD_WORKERS = 3
+
+# HTTP connections to api.vk.com are kept alive and reused
+VK_HTTP_POOL_SIZE = 10
+VK_HTTP_TIMEOUT = (3.05, 10)  # (connect, read) in seconds
+
+# VK allows 3 requests per second for a user token
+VK_REQUESTS_PER_SECOND = 3
+VK_RATE_LIMIT_BURST = 1
+
+# 6 - too many requests per second, 10 - internal server error
+VK_RETRY_ERROR_CODES = (6, 10)
+VK_TOO_MANY_REQUESTS_ERROR_CODE = 6
+RETRY_BASE_DELAY = 0.3
+RETRY_MAX_DELAY = 8.0
+
+# users from blacklist and from previous results are not shown again, a history larger than threshold
+# is kept in a Bloom filter instead of a set
+SEEN_FILTER_BLOOM_THRESHOLD = 1000000
+SEEN_FILTER_FALSE_POSITIVE_RATE = 0.001
+
+# streaming search (see pipeline.py): users hydrated and scored together, max count of items between stages
+PIPELINE_BATCH_SIZE = 100
+PIPELINE_QUEUE_SIZE = 200
+
+# count of pages of search which are fetched in background while the user reads results (0 turns it off)
+PREFETCH_PAGES = 2
+
+# Hydration and scoring of candidates with asyncio (see vk/async_vk_machinery.py)
+USE_ASYNC_PIPELINE = False
+ASYNC_VK_MAX_CONCURRENCY = 3
+
 POINT_OF_GROUP_UNIT = 0.05
 POINT_OF_FRIEND_UNIT = 0.1
 POINT_OF_AGE = 2.5
@@ -0,0 +1,138 @@
+from config.config_app import PATH_TO_PROFILE_CACHE, PROFILE_CACHE_TTL, PROFILE_CACHE_MAX_ENTRIES
+from typing import Any, Dict, Iterable, Tuple
+
+import json
+import sqlite3
+import threading
+import time
+
+
+class ProfileCache:
+    """
+    Local on-disk (SQLite) cache of data of VK users: profile, friends, groups and photos.
+
+    Every field of user is stored separately with its own time to live. When count of entries
+    exceeds "max_entries" the least recently used entries are evicted.
+
+    Reads do not write to the file: times of access are kept in memory and saved by the next put_many
+    (before eviction) or by close()
+    """
+
+    _evict_fraction = 0.1  # part of entries which is dropped at once when cache is full
+
+    def __init__(self, path: str = PATH_TO_PROFILE_CACHE, ttl: Dict[str, float] = None,
+                 max_entries: int = PROFILE_CACHE_MAX_ENTRIES):
+        """
+        :param path: path to file of cache (':memory:' keeps cache only in memory)
+        :param ttl: time to live in seconds of every field, like {'friends': 86400}
+        :param max_entries: max count of entries (user, field) in cache
+        """
+
+        self.ttl = dict(PROFILE_CACHE_TTL, **(ttl or {}))
+        self.max_entries = max_entries
+
+        self.hits = {field: 0 for field in self.ttl}
+        self.misses = {field: 0 for field in self.ttl}
+
+        self._lock = threading.Lock()
+        # times of access which are not saved yet, like {(vk_id, field): accessed_at}
+        self._accessed_at: Dict[Tuple[int, str], float] = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS profile_cache(
+                           vk_id INTEGER NOT NULL,
+                           field TEXT NOT NULL,
+                           data TEXT NOT NULL,
+                           fetched_at REAL NOT NULL,
+                           accessed_at REAL NOT NULL,
+                           PRIMARY KEY (vk_id, field));""")
+        self._conn.execute("""CREATE INDEX IF NOT EXISTS profile_cache_accessed_at
+                           ON profile_cache (accessed_at);""")
+        self._conn.commit()
+
+        self._size = self._conn.execute("""SELECT count(*) FROM profile_cache""").fetchone()[0]
+
+    def get_many(self, field: str, vk_ids: Iterable[int]) -> Dict[int, Any]:
+        """
+        Return fresh cached values of field for users. Users without fresh value are not in the result
+
+        :param field: name of field ('profile', 'friends', 'groups', 'photos')
+        :param vk_ids: ids of users from the VK site
+        """
+
+        vk_ids = [int(vk_id) for vk_id in vk_ids]
+        if not vk_ids:
+            return {}
+
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                f"""SELECT vk_id, data FROM profile_cache
+                    WHERE field=? AND fetched_at>=? AND vk_id IN ({','.join('?' * len(vk_ids))})""",
+                [field, now - self.ttl[field]] + vk_ids).fetchall()
+
+            self._accessed_at.update(((vk_id, field), now) for vk_id, _ in rows)
+
+            self.hits[field] += len(rows)
+            self.misses[field] += len(vk_ids) - len(rows)
+
+        return {vk_id: json.loads(data) for vk_id, data in rows}
+
+    def put_many(self, field: str, values: Dict[int, Any]) -> None:
+        """
+        Save values of field of users in cache
+
+        :param field: name of field ('profile', 'friends', 'groups', 'photos')
+        :param values: Dict like {vk_id: value}, values must be serializable to json
+        """
+
+        if not values:
+            return
+
+        now = time.time()
+        with self._lock:
+            count_before = self._conn.total_changes
+            self._conn.executemany("""INSERT OR IGNORE INTO profile_cache (vk_id, field, data, fetched_at, accessed_at)
+                                      VALUES (?, ?, '', 0, 0)""",
+                                   [(int(vk_id), field) for vk_id in values])
+            self._size += self._conn.total_changes - count_before
+
+            self._conn.executemany("""UPDATE profile_cache SET data=?, fetched_at=?, accessed_at=?
+                                      WHERE vk_id=? AND field=?""",
+                                   [(json.dumps(value), now, now, int(vk_id), field)
+                                    for vk_id, value in values.items()])
+
+            for vk_id in values:  # fresh values were just accessed
+                self._accessed_at.pop((int(vk_id), field), None)
+            self._save_access_times()
+            if self._size > self.max_entries:
+                self._evict()
+
+            self._conn.commit()
+
+    def _save_access_times(self) -> None:
+        if self._accessed_at:
+            self._conn.executemany("""UPDATE profile_cache SET accessed_at=? WHERE vk_id=? AND field=?""",
+                                   [(accessed_at, vk_id, field)
+                                    for (vk_id, field), accessed_at in self._accessed_at.items()])
+            self._accessed_at = {}
+
+    def _evict(self) -> None:
+        count_to_evict = self._size - self.max_entries + int(self.max_entries * self._evict_fraction)
+        self._conn.execute("""DELETE FROM profile_cache WHERE rowid IN (
+                              SELECT rowid FROM profile_cache ORDER BY accessed_at LIMIT ?)""",
+                           (count_to_evict,))
+        self._size = self._conn.execute("""SELECT count(*) FROM profile_cache""").fetchone()[0]
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Count of hits and misses of every field and current size of cache
+        """
+
+        with self._lock:
+            return {'hits': dict(self.hits), 'misses': dict(self.misses), 'size': self._size}
+
+    def close(self) -> None:
+        with self._lock:
+            self._save_access_times()
+            self._conn.commit()
+            self._conn.close()
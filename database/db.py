@@ -1,185 +1,336 @@
 from config.config_app import DB_USER, DB_NAME, STANDARD_SEARCH_OFFSET
-from utils import StrOrInt
-from typing import List, Dict
-import psycopg2 as pg
+from config.config_app import DB_POOL_MIN_CONNECTIONS, DB_POOL_MAX_CONNECTIONS
+from utils import StrOrInt, get_vk_id_from_link
+from metrics import metrics
+from typing import Iterable, List, Dict, Tuple
+from contextlib import contextmanager
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import execute_values
 
+import threading
 
-def create_db() -> None:
+
+class Database:
     """
-    Create standard databases for the Tinder App
+    Pool of connections to the database of the Tinder App. All functions of this module go through it.
+
+    Every "cursor()" takes a connection from the pool and commits its own transaction.
+    Inside of "transaction()" all cursors of the current thread share one connection and one transaction.
     """
 
-    with pg.connect(dbname=DB_NAME, user=DB_USER) as conn:
-        with conn.cursor() as cur:
-            cur.execute("""CREATE TABLE IF NOT EXISTS tinder_result(
-                        id serial PRIMARY KEY,
-                        first_name varchar(50) NOT NULL,
-                        last_name varchar(50) NOT NULL,
-                        vk_link varchar(100) UNIQUE NOT NULL);""")
+    def __init__(self, minconn: int = DB_POOL_MIN_CONNECTIONS, maxconn: int = DB_POOL_MAX_CONNECTIONS,
+                 **connect_kwargs):
+        self._minconn = minconn
+        self._maxconn = maxconn
+        self._connect_kwargs = connect_kwargs or {'dbname': DB_NAME, 'user': DB_USER}
+
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # ThreadedConnectionPool raises PoolError when all connections are taken, so callers wait here instead
+        self._free_connections = threading.BoundedSemaphore(maxconn)
+        self._local = threading.local()
+
+    def _get_pool(self) -> ThreadedConnectionPool:
+        # the pool is created on first use, so import of the module does not connect to the database
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadedConnectionPool(self._minconn, self._maxconn, **self._connect_kwargs)
+
+            return self._pool
+
+    @contextmanager
+    def _connection(self):
+        """
+        Take connection from the pool (wait for a free one) and commit (or rollback on error)
+        its transaction at the end
+        """
+
+        pool = self._get_pool()
+        with self._free_connections:
+            conn = pool.getconn()
+            try:
+                with conn:
+                    yield conn
+            finally:
+                pool.putconn(conn, close=bool(conn.closed))
+
+    @contextmanager
+    def cursor(self):
+        """
+        Give cursor of connection from the pool (or of connection of the current transaction)
+        """
+
+        conn = getattr(self._local, 'connection', None)
+        if conn is not None:
+            # we are inside of transaction(), it commits itself
+            with conn.cursor() as cur:
+                yield cur
+        else:
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    yield cur
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group all queries of the current thread into one transaction. Nested calls join the outer transaction
+        """
+
+        if getattr(self._local, 'connection', None) is not None:
+            yield
+            return
+
+        with self._connection() as conn:
+            self._local.connection = conn
+            try:
+                yield
+            finally:
+                self._local.connection = None
+
+    def close(self) -> None:
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+
+database = Database()
+
+
+def transaction():
+    """
+    Group calls of functions of this module into one transaction (see Database.transaction)
+    """
 
-            cur.execute("""CREATE TABLE IF NOT EXISTS tinder_black_list(
-            id serial PRIMARY KEY,
-            first_name varchar(50),
-            last_name varchar(50),
-            vk_link varchar(100) UNIQUE NOT NULL);""")
+    return database.transaction()
 
-            cur.execute("""CREATE TABLE IF NOT EXISTS tinder_favorite_list(
-                        id serial PRIMARY KEY,
-                        second_id INTEGER NOT NULL REFERENCES tinder_result(id));""")
 
-            cur.execute("""CREATE TABLE IF NOT EXISTS last_run_state(
-                        id serial PRIMARY KEY,
-                        vk_id INTEGER UNIQUE NOT NULL,
-                        desired_age_from INTEGER,
-                        desired_age_to INTEGER,
-                        current_offset INTEGER);""")
+_TABLES_OF_APP = ('tinder_result', 'tinder_black_list', 'tinder_favorite_list', 'last_run_state',
+                  'tinder_candidate_pool')
 
 
-def init_user_in_last_run_state(user_vk_id: StrOrInt) -> None:
+@metrics.timed('sql')
+def create_db() -> None:
     """
-    Initializes the TinderUser in the last_run_state table
-
-    :param user_vk_id: vk_id of TinderUser (vk_id from the VK site)
+    Create standard databases for the Tinder App. DDL is skipped when all tables (of the last version) exist
     """
 
-    with pg.connect(dbname=DB_NAME, user=DB_USER) as conn:
-        with conn.cursor() as cur:
-            cur.execute("""INSERT INTO last_run_state (vk_id, current_offset, desired_age_from,
-                            desired_age_to) VALUES (%s, %s, %s, %s) ON CONFLICT (vk_id) DO NOTHING """,
-                        (int(user_vk_id), int(STANDARD_SEARCH_OFFSET), 0, 0))
-
-
-def insert_result_to_db(liked_tinder_users: List[Dict]) -> None:
+    with database.cursor() as cur:
+        # one query instead of all DDL statements (and their locks) on every start
+        cur.execute("""SELECT (SELECT count(*) FROM information_schema.tables
+                               WHERE table_schema=current_schema() AND table_name=ANY(%s)) = %s
+                           AND EXISTS (SELECT 1 FROM information_schema.columns
+                                       WHERE table_schema=current_schema() AND table_name='tinder_candidate_pool'
+                                       AND column_name='signature')""",
+                    (list(_TABLES_OF_APP), len(_TABLES_OF_APP)))
+        if cur.fetchone()[0]:
+            return
+
+        cur.execute("""CREATE TABLE IF NOT EXISTS tinder_result(
+                    id serial PRIMARY KEY,
+                    first_name varchar(50) NOT NULL,
+                    last_name varchar(50) NOT NULL,
+                    vk_link varchar(100) UNIQUE NOT NULL);""")
+
+        cur.execute("""CREATE TABLE IF NOT EXISTS tinder_black_list(
+        id serial PRIMARY KEY,
+        first_name varchar(50),
+        last_name varchar(50),
+        vk_link varchar(100) UNIQUE NOT NULL);""")
+
+        cur.execute("""CREATE TABLE IF NOT EXISTS tinder_favorite_list(
+                    id serial PRIMARY KEY,
+                    second_id INTEGER NOT NULL REFERENCES tinder_result(id));""")
+
+        cur.execute("""CREATE TABLE IF NOT EXISTS last_run_state(
+                    id serial PRIMARY KEY,
+                    vk_id INTEGER UNIQUE NOT NULL,
+                    desired_age_from INTEGER,
+                    desired_age_to INTEGER,
+                    current_offset INTEGER);""")
+
+        cur.execute("""CREATE TABLE IF NOT EXISTS tinder_candidate_pool(
+                    vk_id INTEGER PRIMARY KEY,
+                    first_name varchar(50),
+                    last_name varchar(50),
+                    sex INTEGER,
+                    age INTEGER,
+                    city INTEGER,
+                    movies TEXT,
+                    music TEXT,
+                    books TEXT,
+                    friends INTEGER[] NOT NULL,
+                    groups INTEGER[] NOT NULL,
+                    signature INTEGER[],
+                    updated_at timestamp NOT NULL DEFAULT now());""")
+        # MinHash signatures (see minhash.py) are stored since the pool grew large
+        cur.execute("""ALTER TABLE tinder_candidate_pool ADD COLUMN IF NOT EXISTS signature INTEGER[];""")
+
+        # GIN indexes make "friends && array[...]" and "groups && array[...]" index lookups
+        cur.execute("""CREATE INDEX IF NOT EXISTS tinder_candidate_pool_friends
+                    ON tinder_candidate_pool USING GIN (friends);""")
+        cur.execute("""CREATE INDEX IF NOT EXISTS tinder_candidate_pool_groups
+                    ON tinder_candidate_pool USING GIN (groups);""")
+
+
+@metrics.timed('sql')
+def load_last_run_state(user_vk_id: StrOrInt) -> Tuple[int, int, int]:
     """
-    Insert result the result of the Tinder App
+    Return state of the last run of user from the table "last_run_state". The row of new user is created
+    with standard offset, everything is done with one statement
 
-    :param liked_tinder_users: List of dict of tinder user data
+    :param user_vk_id: vk_id of TinderUser (vk_id from the VK site)
+    :return: (desired_age_from, desired_age_to, current_offset)
     """
 
-    with pg.connect(dbname=DB_NAME, user=DB_USER) as conn:
-        with conn.cursor() as cur:
-            processed_users = [(user['first_name'], user['last_name'], user['vk_link']) for user in liked_tinder_users]
-            cur.executemany("""INSERT INTO tinder_result (first_name, last_name, vk_link)
-                                            VALUES (%s, %s, %s) ON CONFLICT (vk_link) DO NOTHING""",
-                            processed_users)
+    with database.cursor() as cur:
+        # "DO UPDATE" with the same value makes RETURNING give the existing row too
+        cur.execute("""INSERT INTO last_run_state (vk_id, current_offset, desired_age_from, desired_age_to)
+                    VALUES (%s, %s, %s, %s) ON CONFLICT (vk_id) DO UPDATE SET vk_id=EXCLUDED.vk_id
+                    RETURNING desired_age_from, desired_age_to, current_offset""",
+                    (int(user_vk_id), int(STANDARD_SEARCH_OFFSET), 0, 0))
 
+        return cur.fetchone()
 
-def add_to_black_list(person: Dict) -> None:
-    """
-    Add person to blacklist in database
 
-    :param person: Dict of user data
-    :return:
+@metrics.timed('sql')
+def save_last_run_state(user_vk_id: StrOrInt, desired_age_from: int, desired_age_to: int,
+                        current_offset: int) -> None:
     """
+    Insert or update state of the last run of user in the table "last_run_state" with one statement
 
-    with pg.connect(dbname=DB_NAME, user=DB_USER) as conn:
-        with conn.cursor() as cur:
-            cur.execute("""INSERT INTO tinder_black_list (first_name, last_name, vk_link) VALUES (%s, %s, %s)
-                        ON CONFLICT (vk_link) DO NOTHING""",
-                        (person['first_name'], person['last_name'], person['vk_link'],))
+    :param user_vk_id: vk_id of TinderUser (vk_id from the VK site)
+    :param desired_age_from: min age of search
+    :param desired_age_to: max age of search
+    :param current_offset: offset of search
+    """
 
-    print(f'person {person["first_name"]} added to black list')
+    with database.cursor() as cur:
+        cur.execute("""INSERT INTO last_run_state (vk_id, current_offset, desired_age_from, desired_age_to)
+                    VALUES (%s, %s, %s, %s) ON CONFLICT (vk_id) DO UPDATE SET
+                    current_offset=EXCLUDED.current_offset, desired_age_from=EXCLUDED.desired_age_from,
+                    desired_age_to=EXCLUDED.desired_age_to""",
+                    (int(user_vk_id), int(current_offset), int(desired_age_from), int(desired_age_to)))
 
 
-def add_to_favorite_list(person: Dict) -> None:
+@metrics.timed('sql')
+def insert_result_to_db(liked_tinder_users: List[Dict]) -> None:
     """
-    Add person to favorite list in database
+    Insert result the result of the Tinder App with one statement
 
-    :param person: Dict of user data
+    :param liked_tinder_users: List of dict of tinder user data
     """
 
-    with pg.connect(dbname=DB_NAME, user=DB_USER) as conn:
-        with conn.cursor() as cur:
-            cur.execute("""SELECT id FROM tinder_result WHERE vk_link=%s""", (person['vk_link'],))
-            id_user_from_table_tinder_result = cur.fetchone()[0]
+    processed_users = [(user['first_name'], user['last_name'], user['vk_link']) for user in liked_tinder_users]
+    if not processed_users:
+        return
 
-            cur.execute("""INSERT INTO tinder_favorite_list (second_id) VALUES (%s)""",
-                        (id_user_from_table_tinder_result,))
+    with database.cursor() as cur:
+        execute_values(cur, """INSERT INTO tinder_result (first_name, last_name, vk_link)
+                               VALUES %s ON CONFLICT (vk_link) DO NOTHING""",
+                       processed_users, page_size=len(processed_users))
 
-            print(f'person {person["first_name"]} added to favorite list')
 
-
-def get_last_desired_age_from(user_id: int) -> int:
+@metrics.timed('sql')
+def add_many_to_black_list(persons: List[Dict]) -> None:
     """
-    Return value of "desired_age_from" of particular user  from the "last_run_state" table in database
+    Add persons to blacklist in database with one statement
 
-    :param user_id: id (tinder_user_id) particular user
+    :param persons: List of dict of user data
     """
 
-    with pg.connect(dbname=DB_NAME, user=DB_USER) as conn:
-        with conn.cursor() as cur:
-            cur.execute("""SELECT desired_age_from FROM last_run_state WHERE vk_id=(%s)""",
-                        (user_id,))
-
+    processed_persons = [(person['first_name'], person['last_name'], person['vk_link']) for person in persons]
+    if not processed_persons:
+        return
 
-            return cur.fetchone()[0]
+    with database.cursor() as cur:
+        execute_values(cur, """INSERT INTO tinder_black_list (first_name, last_name, vk_link)
+                               VALUES %s ON CONFLICT (vk_link) DO NOTHING""",
+                       processed_persons, page_size=len(processed_persons))
 
 
-def get_last_desired_age_to(user_id: int) -> int:
+@metrics.timed('sql')
+def add_many_to_favorite_list(persons: List[Dict]) -> int:
     """
-    Return value of "desired_age_to" of particular user from the "last_run_state" table in database
+    Add persons to favorite list in database with one statement. Persons must be in the table "tinder_result"
 
-    :param user_id: id (tinder_user_id) particular user
+    :param persons: List of dict of user data
+    :return: count of added persons (persons which are not in results are skipped)
     """
 
-    with pg.connect(dbname=DB_NAME, user=DB_USER) as conn:
-        with conn.cursor() as cur:
-            cur.execute("""SELECT desired_age_to FROM last_run_state WHERE vk_id=(%s)""",
-                        (user_id,))
+    if not persons:
+        return 0
+
+    with database.cursor() as cur:
+        cur.execute("""INSERT INTO tinder_favorite_list (second_id)
+                    SELECT tinder_result.id FROM unnest(%s::varchar[]) AS favorite (vk_link)
+                    JOIN tinder_result USING (vk_link)""",
+                    ([person['vk_link'] for person in persons],))
 
-            return cur.fetchone()[0]
+        return cur.rowcount
 
 
-def get_current_offset(tinder_user_id: int) -> int:
+@metrics.timed('sql')
+def get_seen_vk_ids() -> List[int]:
     """
-    Gives current_offset a particular tinder user for search from table "last_run_state"
+    Return vk ids of users from tables "tinder_black_list" and "tinder_result"
     """
 
-    with pg.connect(dbname=DB_NAME, user=DB_USER) as conn:
-        with conn.cursor() as cur:
-            cur.execute("""SELECT current_offset FROM last_run_state WHERE vk_id=(%s)""", (tinder_user_id,))
+    with database.cursor() as cur:
+        cur.execute("""SELECT vk_link FROM tinder_black_list UNION SELECT vk_link FROM tinder_result""")
 
-            return cur.fetchone()[0]
+        return [get_vk_id_from_link(vk_link) for vk_link, in cur.fetchall()]
 
 
-def update_current_offset(offset: int, tinder_user_id: int) -> None:
+@metrics.timed('sql')
+def save_pool_candidates(candidates: Iterable[Tuple]) -> None:
     """
-    Updates current_offset for particular user in table "last_run_state"
+    Insert or update candidates of the candidate pool with one statement. A candidate without friends
+    (e.g. hydrated with common friends only) keeps its stored friends and their signature
 
-    :param offset: new value of offset to setup
-    :param tinder_user_id: id of particular tinder_user
+    :param candidates: tuples (vk_id, first_name, last_name, sex, age, city, movies, music, books, friends, groups,
+                       signature), signature is MinHash signature of candidate or None
     """
 
-    with pg.connect(dbname=DB_NAME, user=DB_USER) as conn:
-        with conn.cursor() as cur:
-            cur.execute("""UPDATE last_run_state SET current_offset=(%s) WHERE vk_id=(%s)""",
-                        (int(offset), int(tinder_user_id)))
-
-
-def update_desired_age_from(desired_age_from: int, tinder_user_id: int) -> None:
+    with database.cursor() as cur:
+        execute_values(cur, """INSERT INTO tinder_candidate_pool
+                               (vk_id, first_name, last_name, sex, age, city, movies, music, books, friends, groups,
+                               signature)
+                               VALUES %s
+                               ON CONFLICT (vk_id) DO UPDATE SET
+                               first_name=EXCLUDED.first_name, last_name=EXCLUDED.last_name, sex=EXCLUDED.sex,
+                               age=EXCLUDED.age, city=EXCLUDED.city, movies=EXCLUDED.movies,
+                               music=EXCLUDED.music, books=EXCLUDED.books,
+                               friends=CASE WHEN cardinality(EXCLUDED.friends)=0 THEN tinder_candidate_pool.friends
+                                            ELSE EXCLUDED.friends END,
+                               groups=EXCLUDED.groups,
+                               signature=CASE WHEN cardinality(EXCLUDED.friends)=0
+                                                   AND cardinality(tinder_candidate_pool.friends)>0
+                                              THEN tinder_candidate_pool.signature
+                                              ELSE EXCLUDED.signature END,
+                               updated_at=now()""",
+                       list(candidates))
+
+
+@metrics.timed('sql')
+def get_pool_candidates(friends: List[int] = None, groups: List[int] = None) -> List[Tuple]:
     """
-    Updates desired_age_from for particular user in table "last_run_state"
+    Return candidates of the candidate pool. If friends or groups are given, only candidates
+    with at least one common friend or group are returned (it is a lookup in GIN indexes)
 
-    :param desired_age_from: new value of desired_age_from to setup
-    :param tinder_user_id: id of particular tinder_user
+    :param friends: ids of friends of the main user
+    :param groups: ids of groups of the main user
+    :return: tuples like in save_pool_candidates
     """
 
-    with pg.connect(dbname=DB_NAME, user=DB_USER) as conn:
-        with conn.cursor() as cur:
-            cur.execute("""UPDATE last_run_state SET desired_age_from=(%s) WHERE vk_id=(%s)""",
-                        (int(desired_age_from), int(tinder_user_id)))
-
+    query = """SELECT vk_id, first_name, last_name, sex, age, city, movies, music, books, friends, groups,
+               signature FROM tinder_candidate_pool"""
 
-# todo: we can make only 1 method for update these fields
-def update_desired_age_to(desired_age_to: int, tinder_user_id: int) -> None:
-    """
-    Updates desired_age_from for particular user in table "last_run_state"
-
-    :param desired_age_to: new value of desired_age_from to setup
-    :param tinder_user_id: id of particular tinder_user
-    """
+    with database.cursor() as cur:
+        if friends is None and groups is None:
+            cur.execute(query)
+        else:
+            cur.execute(query + """ WHERE friends && %s::integer[] OR groups && %s::integer[]""",
+                        (list(friends or []), list(groups or [])))
 
-    with pg.connect(dbname=DB_NAME, user=DB_USER) as conn:
-        with conn.cursor() as cur:
-            cur.execute("""UPDATE last_run_state SET desired_age_to=(%s) WHERE vk_id=(%s)""",
-                        (int(desired_age_to), int(tinder_user_id)))
+        return cur.fetchall()
@@ -0,0 +1,89 @@
+from config.config_app import SESSION_STATE_CHECKPOINT_INTERVAL
+from database.db import load_last_run_state, save_last_run_state
+from typing import Optional
+
+import atexit
+import threading
+import time
+import weakref
+
+# states which have changes, they are saved at exit
+_open_states = weakref.WeakSet()
+
+
+class SessionState:
+    """
+    Row of the table "last_run_state" of the main user kept in memory: desired ages and offset of search.
+
+    The row is loaded (and created when it is missing) with one statement. Changes are saved with one UPSERT
+    when "checkpoint_interval" seconds passed since the last save, on close() and at exit.
+    """
+
+    def __init__(self, vk_id: int, desired_age_from: Optional[int], desired_age_to: Optional[int],
+                 current_offset: int, checkpoint_interval: float = SESSION_STATE_CHECKPOINT_INTERVAL):
+        """
+        :param vk_id: id of the main user
+        :param desired_age_from: min age of search from the last run
+        :param desired_age_to: max age of search from the last run
+        :param current_offset: offset of search from the last run
+        :param checkpoint_interval: min time in seconds between saves (0 saves every change)
+        """
+
+        self.vk_id = int(vk_id)
+        self.desired_age_from = desired_age_from
+        self.desired_age_to = desired_age_to
+        self.current_offset = current_offset
+        self.checkpoint_interval = checkpoint_interval
+
+        self._lock = threading.Lock()
+        self._is_changed = False
+        self._saved_at = time.monotonic()
+
+    @classmethod
+    def load(cls, vk_id: int, checkpoint_interval: float = SESSION_STATE_CHECKPOINT_INTERVAL) -> 'SessionState':
+        """
+        Load state of the main user from the database
+        """
+
+        return cls(vk_id, *load_last_run_state(vk_id), checkpoint_interval=checkpoint_interval)
+
+    def update(self, **fields) -> None:
+        """
+        Change fields of state (desired_age_from, desired_age_to, current_offset),
+        they are saved by the next checkpoint
+        """
+
+        with self._lock:
+            for field, value in fields.items():
+                if field not in ('desired_age_from', 'desired_age_to', 'current_offset'):
+                    raise AttributeError(f'Session state has no field "{field}"')
+                setattr(self, field, value)
+
+            self._is_changed = True
+            _open_states.add(self)
+
+        if time.monotonic() - self._saved_at >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        """
+        Save changes to the database
+        """
+
+        with self._lock:
+            if not self._is_changed:
+                return
+
+            save_last_run_state(self.vk_id, self.desired_age_from, self.desired_age_to, self.current_offset)
+            self._is_changed = False
+            self._saved_at = time.monotonic()
+            _open_states.discard(self)
+
+    def close(self) -> None:
+        self.checkpoint()
+
+
+@atexit.register
+def _checkpoint_all() -> None:
+    for state in list(_open_states):
+        state.checkpoint()
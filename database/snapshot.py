@@ -0,0 +1,71 @@
+from config.config_app import PATH_TO_PROFILE_CACHE, MAIN_USER_SNAPSHOT_TTL
+from typing import Any, Dict, Optional
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def _hash_token(access_token: str) -> str:
+    # tokens are not stored, only their hashes
+    return hashlib.sha256(access_token.encode('utf8')).hexdigest()
+
+
+class MainUserSnapshots:
+    """
+    Local (SQLite) snapshots of main users: profile from users.get, friends and groups. They are keyed
+    by vk id and found by the access token of the last run, so a warm start needs no requests to VK API
+    before the first search.
+
+    A snapshot is used while it is younger than "ttl" seconds, the main user refreshes it in background
+    (see MainUser)
+    """
+
+    def __init__(self, path: str = PATH_TO_PROFILE_CACHE, ttl: float = MAIN_USER_SNAPSHOT_TTL):
+        """
+        :param path: path to file (':memory:' keeps snapshots only in memory)
+        :param ttl: time to live of snapshot in seconds
+        """
+
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS main_user_snapshot(
+                           vk_id INTEGER PRIMARY KEY,
+                           token_hash TEXT NOT NULL,
+                           data TEXT NOT NULL,
+                           fetched_at REAL NOT NULL);""")
+        self._conn.execute("""CREATE INDEX IF NOT EXISTS main_user_snapshot_token_hash
+                           ON main_user_snapshot (token_hash);""")
+        self._conn.commit()
+
+    def get(self, access_token: str) -> Optional[Dict[str, Any]]:
+        """
+        Return fresh snapshot of the owner of token: {'profile': ..., 'friends': [...], 'groups': [...]}
+        or None if there is no fresh snapshot
+        """
+
+        with self._lock:
+            row = self._conn.execute("""SELECT data FROM main_user_snapshot WHERE token_hash=? AND fetched_at>=?
+                                        ORDER BY fetched_at DESC LIMIT 1""",
+                                     (_hash_token(access_token), time.time() - self.ttl)).fetchone()
+
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, vk_id: int, access_token: str, snapshot: Dict[str, Any]) -> None:
+        """
+        Save snapshot of main user (see get)
+        """
+
+        with self._lock:
+            self._conn.execute("""INSERT OR REPLACE INTO main_user_snapshot (vk_id, token_hash, data, fetched_at)
+                                  VALUES (?, ?, ?, ?)""",
+                               (int(vk_id), _hash_token(access_token), json.dumps(snapshot), time.time()))
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,201 @@
+from config.config_app import WRITE_BEHIND_FLUSH_INTERVAL, WRITE_BEHIND_MAX_BUFFERED, WRITE_BEHIND_MAX_FAILED_FLUSHES
+from config.config_app import WRITE_BEHIND_BUFFER_LIMIT
+from database.db import transaction, insert_result_to_db, add_many_to_black_list, add_many_to_favorite_list
+from typing import Dict, List, Optional
+
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindWriter:
+    """
+    Buffer of writes of results, blacklist and favorites. They are flushed in bulk (one statement per table
+    in one transaction) from a background thread every "flush_interval" seconds, or at once when
+    "max_buffered" persons are waiting. Everything which is buffered is flushed on close() and on exit.
+
+    Results are flushed before favorites, so a person can be added to favorites right after its round.
+    A failed flush keeps its persons in the buffer, they are written by the next flush. After
+    "max_failed_flushes" failures in a row persons are written one by one, so a broken person does not
+    block the others: persons which fail alone are logged and dropped
+    """
+
+    def __init__(self, flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL,
+                 max_buffered: int = WRITE_BEHIND_MAX_BUFFERED,
+                 max_failed_flushes: int = WRITE_BEHIND_MAX_FAILED_FLUSHES,
+                 buffer_limit: int = WRITE_BEHIND_BUFFER_LIMIT):
+        """
+        :param flush_interval: max time in seconds which a write waits in the buffer
+        :param max_buffered: count of buffered persons which are flushed without waiting
+        :param max_failed_flushes: count of failed flushes in a row after which persons are written one by one
+        :param buffer_limit: max count of persons in every buffer, the oldest ones are dropped
+        """
+
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.max_failed_flushes = max_failed_flushes
+        self.buffer_limit = buffer_limit
+
+        self._condition = threading.Condition()
+        # flushes go one by one, so favorites never overtake their results
+        self._flush_lock = threading.Lock()
+        self._results: List[Dict] = []
+        self._black_list: List[Dict] = []
+        self._favorites: List[Dict] = []
+        self._failed_flushes = 0
+
+        self._thread: Optional[threading.Thread] = None
+        self._is_stopping = False
+        self._is_registered_at_exit = False
+        self.last_error: Optional[Exception] = None
+
+    def _count_buffered(self) -> int:
+        return len(self._results) + len(self._black_list) + len(self._favorites)
+
+    def _limit_buffer(self, buffer: List[Dict]) -> None:
+        # the database is unavailable for long, memory must not grow without end
+        count_of_dropped = len(buffer) - self.buffer_limit
+        if count_of_dropped > 0:
+            logger.error('Write-behind buffer is full, %d persons are dropped: %s', count_of_dropped,
+                         [person.get('vk_link') for person in buffer[:count_of_dropped]])
+            del buffer[:count_of_dropped]
+
+    def _add(self, buffer: List[Dict], persons: List[Dict]) -> None:
+        with self._condition:
+            buffer.extend(persons)
+            self._limit_buffer(buffer)
+
+            if self._thread is None:
+                if not self._is_registered_at_exit:
+                    atexit.register(self.close)
+                    self._is_registered_at_exit = True
+
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+            if self._count_buffered() >= self.max_buffered:
+                self._condition.notify_all()
+
+    def add_results(self, liked_tinder_users: List[Dict]) -> None:
+        """
+        Buffer results of round (see db.insert_result_to_db)
+        """
+
+        self._add(self._results, liked_tinder_users)
+
+    def add_to_black_list(self, person: Dict) -> None:
+        self._add(self._black_list, [person])
+
+    def add_to_favorite_list(self, person: Dict) -> None:
+        self._add(self._favorites, [person])
+
+    @staticmethod
+    def _write(results: List[Dict], black_list: List[Dict], favorites: List[Dict]) -> int:
+        with transaction():
+            insert_result_to_db(results)
+            add_many_to_black_list(black_list)
+            return add_many_to_favorite_list(favorites)
+
+    def _write_one_by_one(self, results: List[Dict], black_list: List[Dict], favorites: List[Dict]) -> int:
+        """
+        Write every person in its own transaction. When no person is written the database is unavailable
+        and the error is raised, otherwise persons which failed are logged and dropped
+
+        :return: count of added favorites
+        """
+
+        writes = ([([person], [], []) for person in results] + [([], [person], []) for person in black_list]
+                  + [([], [], [person]) for person in favorites])
+        failed_writes = []
+        count_of_added_favorites = 0
+        for write in writes:
+            try:
+                count_of_added_favorites += self._write(*write)
+            except Exception as e:
+                failed_writes.append((write, e))
+
+        if failed_writes and len(failed_writes) == len(writes):
+            raise failed_writes[-1][1]
+
+        for (results_of_write, black_list_of_write, favorites_of_write), error in failed_writes:
+            person, = results_of_write + black_list_of_write + favorites_of_write
+            logger.error('Person %s is dropped from write-behind buffer: %s', person.get('vk_link'), error)
+
+        return count_of_added_favorites
+
+    def flush(self) -> int:
+        """
+        Write all buffered persons now. On error they stay in the buffer and the error is raised
+
+        :return: count of added favorites (favorites which are not in results are skipped)
+        """
+
+        with self._flush_lock:
+            with self._condition:
+                results, black_list, favorites = self._results, self._black_list, self._favorites
+                self._results, self._black_list, self._favorites = [], [], []
+
+            if not (results or black_list or favorites):
+                return 0
+
+            try:
+                if self._failed_flushes >= self.max_failed_flushes:
+                    count_of_added_favorites = self._write_one_by_one(results, black_list, favorites)
+                else:
+                    count_of_added_favorites = self._write(results, black_list, favorites)
+            except Exception:
+                self._failed_flushes += 1
+                with self._condition:
+                    self._results[:0] = results
+                    self._black_list[:0] = black_list
+                    self._favorites[:0] = favorites
+                    for buffer in (self._results, self._black_list, self._favorites):
+                        self._limit_buffer(buffer)
+                raise
+
+            self._failed_flushes = 0
+            if count_of_added_favorites < len(favorites):
+                logger.warning('%d persons are not in results, so they are not added to favorite list',
+                               len(favorites) - count_of_added_favorites)
+
+            return count_of_added_favorites
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._is_stopping or self._count_buffered() >= self.max_buffered,
+                                         timeout=self.flush_interval)
+                if self._is_stopping:
+                    return
+
+            try:
+                self.flush()
+                self.last_error = None
+            except Exception as e:  # the database can be back by the next flush
+                logger.warning('Flush of write-behind buffer failed, %d persons wait for the next one: %s',
+                               self._count_buffered(), e)
+                self.last_error = e
+
+    def close(self) -> None:
+        """
+        Stop the background thread and flush the buffer. The writer can be used again after it
+        """
+
+        with self._condition:
+            thread = self._thread
+            self._is_stopping = True
+            self._condition.notify_all()
+
+        if thread is not None:
+            thread.join()
+
+        with self._condition:
+            self._thread = None
+            self._is_stopping = False
+
+        self.flush()
+
+
+write_behind = WriteBehindWriter()
@@ -1,42 +1,106 @@
 from vk.vk_machinery import VkMachinery
-from tinder_users import TinderUser, MainUser
-from config.config_app import PATH_TO_OUTPUT_RESULT
+from vk.async_vk_machinery import AsyncVkMachinery
+from tinder_users import TinderUser, MainUser, select_top_tinder_users
+from scoring import score_candidates
+from pipeline import SearchPipeline
+from prefetch import SearchPrefetcher
+from seen_filter import SeenUsersFilter
+from candidate_pool import CandidatePool
+from config.config_app import PATH_TO_OUTPUT_RESULT, USE_ASYNC_PIPELINE, PREFETCH_PAGES, MAX_COUNT_OF_EMPTY_PAGES
+from config.config_app import METRICS_DUMP_PATH, METRICS_PORT, PATH_TO_PROFILE_CACHE
 from database.db import create_db
-from database.db import insert_result_to_db, add_to_black_list, add_to_favorite_list
-from utils import TinderException
-
+from database.cache import ProfileCache
+from database.snapshot import MainUserSnapshots
+from database.write_behind import write_behind
+from metrics import metrics, start_metrics_server
+from vocabulary import vocabulary
+from utils import TinderException, get_vk_id_from_link
+
+from functools import partial
 from pprint import pprint
 from typing import Dict, List
 
+import atexit
 import json
 
 
-def tact_of_app(main_user, tinder_users: List) -> List[Dict]:
+def fetch_next_page(vk_client, main_user, main_user_config: Dict, async_vk_client=None,
+                    seen_filter: SeenUsersFilter = None, verbose: bool = True,
+                    candidate_pool: CandidatePool = None) -> List[TinderUser]:
+    """
+    Advance offset of search, search users and return them hydrated and scored.
+    Pages where all users have closed profiles are skipped
+
+    :param vk_client: Instance of VkMachinery
+    :param main_user: Instance of class MainUser(TinderUser)
+    :param main_user_config: config of search, its offset is advanced
+    :param async_vk_client: Instance of AsyncVkMachinery, if it is given users are hydrated concurrently
+    :param seen_filter: users from this filter are skipped right after search, before hydration
+    :param verbose: print messages about waiting
+    :param candidate_pool: all hydrated users are added to it
+    :return: List of instances of Tinder User, it is empty when we did not find any suitable user
+    """
+
+    is_excluded = seen_filter.__contains__ if seen_filter is not None else None
+    search_pipeline = SearchPipeline(vk_client, main_user, main_user_config, is_excluded=is_excluded,
+                                     verbose=verbose, candidate_pool=candidate_pool, async_vk_client=async_vk_client)
+
+    for _ in range(MAX_COUNT_OF_EMPTY_PAGES):
+        list_of_tinder_users = list(search_pipeline.stream(max_pages=1))
+
+        # all received users can be with closed profiles, then we have to repeat request
+        if list_of_tinder_users:
+            return list_of_tinder_users
+
+    return []
+
+
+def tact_of_app(main_user, tinder_users: List, scored: bool = False,
+                seen_filter: SeenUsersFilter = None) -> List[Dict]:
     """
     Do one round of the Tinder app.
 
     :param main_user: Instance of class MainUser(TinderUser)
     :param tinder_users: List of instances of Tinder User
+    :param scored: score of users is already calculated
+    :param seen_filter: shown users are added to it
     """
 
-    list_tinder_users = []
+    result_of_matching = match_tinder_users(main_user, tinder_users, scored=scored)
+
+    write_behind.add_results(result_of_matching)
+    if seen_filter is not None:
+        seen_filter.add_many(get_vk_id_from_link(data_of_user['vk_link']) for data_of_user in result_of_matching)
+
+    return result_of_matching
+
 
-    for tinder_user in tinder_users:
-        tinder_user.calculate_matching_score(main_user)
-        list_tinder_users.append(tinder_user)
+def match_tinder_users(main_user, tinder_users: List, scored: bool = False) -> List[Dict]:
+    """
+    Select the best matches of round and get their photos. Nothing is saved
 
-    list_tinder_users.sort(key=lambda usr: usr.score)
+    :param main_user: Instance of class MainUser(TinderUser)
+    :param tinder_users: List of instances of Tinder User
+    :param scored: score of users is already calculated
+    :return: List of data of the best Tinder Users
+    """
 
-    top10_tinder_users = list_tinder_users[-11:]
+    if not scored:
+        score_candidates(main_user, tinder_users)
+    top10_tinder_users = select_top_tinder_users(tinder_users)
 
     # that problem is on the vk side
     # top10.pop(-1)  # we found our self when use vk method users.search
 
+    # photos are fetched only for the selected users and in batch
+    photos_of_users = main_user.vk_client.get_photos_of_users(
+        [tinder_user.tinder_user_id for tinder_user in top10_tinder_users])
+
     result_of_matching = []
     for tinder_user in top10_tinder_users:
+        tinder_user.set_top3_photos(photos_of_users[tinder_user.tinder_user_id])
         result_of_matching.append(tinder_user.get_user_in_dict())
 
-    insert_result_to_db(result_of_matching)
     return result_of_matching
 
 
@@ -54,17 +118,28 @@ def output_tinder_users(data_of_top10_matching: List[Dict]) -> None:
               f'vk:{data_of_user["vk_link"]}, Photos: {links_photos}')
 
 
-def interface_for_black_list(data_of_persons: List[Dict]) -> None:
+def interface_for_black_list(data_of_persons: List[Dict], seen_filter: SeenUsersFilter = None) -> None:
     """
     Add chosen body to blacklist
 
     :param data_of_persons: List of data of Tinder Users
+    :param seen_filter: blacklisted person is added to it
     """
 
     explain_line = 'Get number of person why you want to add to black list'
     chosen_id = _interface_to_add_list(data_of_persons, explain_line)
 
-    add_to_black_list(data_of_persons[chosen_id])
+    write_behind.add_to_black_list(data_of_persons[chosen_id])
+    if seen_filter is not None:
+        seen_filter.add(get_vk_id_from_link(data_of_persons[chosen_id]['vk_link']))
+
+    try:
+        write_behind.flush()
+    except Exception:  # the person stays in the buffer of write_behind
+        print(f'person {data_of_persons[chosen_id]["first_name"]} is not saved yet, it will be added to black list '
+              f'when the database is available')
+    else:
+        print(f'person {data_of_persons[chosen_id]["first_name"]} added to black list')
 
 
 def interface_for_favorite_list(data_of_persons: List[Dict]) -> None:
@@ -77,7 +152,19 @@ def interface_for_favorite_list(data_of_persons: List[Dict]) -> None:
     explain_line = 'Get number of person why you want to add to favorite list'
     chosen_id = _interface_to_add_list(data_of_persons, explain_line)
 
-    add_to_favorite_list(data_of_persons[chosen_id])
+    write_behind.add_to_favorite_list(data_of_persons[chosen_id])
+
+    try:
+        count_of_added_favorites = write_behind.flush()
+    except Exception:  # the person stays in the buffer of write_behind
+        print(f'person {data_of_persons[chosen_id]["first_name"]} is not saved yet, it will be added to favorite list '
+              f'when the database is available')
+    else:
+        if count_of_added_favorites:
+            print(f'person {data_of_persons[chosen_id]["first_name"]} added to favorite list')
+        else:
+            print(f'person {data_of_persons[chosen_id]["first_name"]} is not in results, '
+                  f'so it is not added to favorite list')
 
 
 def _interface_to_add_list(data_of_persons: List[Dict], explanatory_line: str) -> int:
@@ -114,41 +201,50 @@ def output_result_to_json(data_of_top10_matching: List[Dict]) -> None:
         json.dump(data_of_top10_matching, json_output, indent=2)
 
 
-def run_app(vk_client):
-    main_user = MainUser(vk_client=vk_client)
+def run_app(vk_client, use_async: bool = USE_ASYNC_PIPELINE, prefetch_pages: int = PREFETCH_PAGES,
+            snapshots: MainUserSnapshots = None):
+    async_vk_client = AsyncVkMachinery(vk_client=vk_client) if use_async else None
+
+    main_user = MainUser(vk_client=vk_client, snapshots=snapshots)
     main_user_config = main_user.get_search_config_obj()
 
-    turn_on_the_app = True
-    while turn_on_the_app:
-        main_user_config['offset_for_search'] += main_user.count_for_search
+    # blacklisted and already shown users are skipped before hydration
+    seen_filter = SeenUsersFilter.load()
 
-        searched_tinder_users = vk_client.users_search(config=main_user_config)
+    prefetcher = None
+    if prefetch_pages:
+        prefetcher = SearchPrefetcher(partial(fetch_next_page, vk_client, main_user, async_vk_client=async_vk_client,
+                                              seen_filter=seen_filter, verbose=False),
+                                      pages=prefetch_pages)
 
-        processed_data_of_tinder_users = vk_client.get_processed_data_of_tinder_users(
-            searched_users=searched_tinder_users, main_user_config=main_user_config)
+    turn_on_the_app = True
+    while turn_on_the_app:
+        prefetched_page = prefetcher.take(main_user_config) if prefetcher is not None else None
+        if prefetched_page is not None:
+            main_user_config, list_of_tinder_users = prefetched_page
+        else:
+            list_of_tinder_users = fetch_next_page(vk_client, main_user, main_user_config,
+                                                   async_vk_client=async_vk_client, seen_filter=seen_filter)
 
-        count = 0
         # todo : make here restart of app
-        while not processed_data_of_tinder_users:  # from example all received users with closed profiles
-            # we have no any user so we have to repeat request
-            if count > 10:
-                print('We did not find any suitable user.So your session has been restarted')
-                run_app(vk_client=vk_client)
-            count += 1
-
-            main_user_config['offset_for_search'] += main_user.count_for_search
-            searched_tinder_users = vk_client.users_search(config=main_user_config)
-            processed_data_of_tinder_users = vk_client.get_processed_data_of_tinder_users(
-                searched_users=searched_tinder_users, main_user_config=main_user_config)
-
-        list_of_tinder_users = []
-        for data_of_tinder_user in processed_data_of_tinder_users:
-            list_of_tinder_users.append(TinderUser(vk_client=vk_client, init_obj=data_of_tinder_user))
+        if not list_of_tinder_users:
+            print('We did not find any suitable user.So your session has been restarted')
+            if prefetcher is not None:
+                prefetcher.close()
+            main_user.close()
+            return run_app(vk_client=vk_client, use_async=use_async, prefetch_pages=prefetch_pages,
+                           snapshots=snapshots)
 
         main_user.update_search_offset(main_user_config['offset_for_search'])
-        data_of_top10_matching = tact_of_app(main_user=main_user, tinder_users=list_of_tinder_users)
+
+        data_of_top10_matching = tact_of_app(main_user=main_user, tinder_users=list_of_tinder_users, scored=True,
+                                             seen_filter=seen_filter)
         output_tinder_users(data_of_top10_matching)
 
+        if prefetcher is not None:
+            # the next pages are fetched while the user reads results
+            prefetcher.start(main_user_config)
+
         while True:
             try:
                 command = int(input('What are you want to do?\n'
@@ -165,7 +261,7 @@ def run_app(vk_client):
                 elif command == 2:
                     interface_for_favorite_list(data_of_top10_matching)
                 elif command == 3:
-                    interface_for_black_list(data_of_top10_matching)
+                    interface_for_black_list(data_of_top10_matching, seen_filter=seen_filter)
                 elif command == 4:
                     pprint(json.dumps(data_of_top10_matching))
                 elif command == 5:
@@ -173,6 +269,11 @@ def run_app(vk_client):
                 elif command == 6:
                     turn_on_the_app = False
                     output_result_to_json(data_of_top10_matching)
+                    if prefetcher is not None:
+                        prefetcher.close()
+                    if async_vk_client is not None:
+                        async_vk_client.close()
+                    main_user.close()
                     break
                 else:
                     raise ValueError('Invalid input')
@@ -181,11 +282,23 @@ def run_app(vk_client):
 
 
 if __name__ == '__main__':
+    if METRICS_DUMP_PATH:
+        atexit.register(metrics.dump, METRICS_DUMP_PATH)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+
     create_db()
     # There is entry point of program. And here we initialize instance of VkMachinery.
     # So those who will import VkMachinery
     # will use it initialized
 
-    vk_client = VkMachinery()
-    vk_client.initialize_vk_api()
-    run_app(vk_client=vk_client)
+    vocabulary.open(PATH_TO_PROFILE_CACHE)
+    profile_cache = ProfileCache()
+    main_user_snapshots = MainUserSnapshots()
+    with VkMachinery(cache=profile_cache) as vk_client:
+        vk_client.initialize_vk_api()
+        run_app(vk_client=vk_client, snapshots=main_user_snapshots)
+    main_user_snapshots.close()
+    profile_cache.close()
+    vocabulary.close()
+    write_behind.close()
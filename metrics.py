@@ -0,0 +1,220 @@
+from config.config_app import METRICS_LATENCY_BUCKETS
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from functools import wraps
+from typing import Dict, Optional, Sequence, Tuple
+
+import bisect
+import json
+import threading
+import time
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies with fixed buckets (upper bounds in seconds), like histograms of Prometheus
+    """
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, bounds: Sequence[float] = METRICS_LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def get_quantile(self, quantile: float) -> float:
+        """
+        Estimate of quantile: upper bound of the bucket where it is (max for the +Inf bucket)
+        """
+
+        if not self.count:
+            return 0.0
+
+        rank, seen = quantile * self.count, 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+
+        return self.max
+
+    def get_cumulative_buckets(self) -> Tuple[Tuple[str, int], ...]:
+        buckets, seen = [], 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            seen += count
+            buckets.append((str(bound), seen))
+
+        return tuple(buckets)
+
+
+class _CallStats:
+    __slots__ = ('latency', 'payload_bytes', 'retries', 'errors')
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.payload_bytes = 0
+        self.retries = 0
+        self.errors = {}  # count per code of error
+
+
+class Metrics:
+    """
+    Counters and latency histograms of calls per kind ('vk' for methods of VK API, 'sql' for functions of database)
+    and name of call. It is shared by threads
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[Tuple[str, str], _CallStats] = {}
+
+    def _get_stats(self, kind: str, name: str) -> _CallStats:
+        key = (kind, name)
+        if key not in self._stats:
+            self._stats[key] = _CallStats()
+
+        return self._stats[key]
+
+    def observe(self, kind: str, name: str, seconds: float, payload_bytes: int = 0,
+                error_code: Optional[str] = None, retry: bool = False) -> None:
+        """
+        Record a finished call
+
+        :param kind: kind of call, like 'vk' or 'sql'
+        :param name: method of VK API or function of database
+        :param seconds: duration of call
+        :param payload_bytes: size of response
+        :param error_code: code of error if the call failed
+        :param retry: the call failed and it will be repeated
+        """
+
+        with self._lock:
+            stats = self._get_stats(kind, name)
+            stats.latency.observe(seconds)
+            stats.payload_bytes += payload_bytes
+            stats.retries += retry
+            if error_code is not None:
+                stats.errors[str(error_code)] = stats.errors.get(str(error_code), 0) + 1
+
+    def timed(self, kind: str):
+        """
+        Decorator which records every call of function, an exception is recorded as error with name of its class
+        """
+
+        def decor(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                started_at = time.perf_counter()
+                try:
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    self.observe(kind, func.__name__, time.perf_counter() - started_at, error_code=type(e).__name__)
+                    raise
+
+                self.observe(kind, func.__name__, time.perf_counter() - started_at)
+                return result
+
+            return wrapper
+
+        return decor
+
+    def snapshot(self) -> Dict[str, Dict[str, Dict]]:
+        """
+        Current values of metrics, like {'vk': {'users.get': {'count': 3, 'p50': 0.1, ...}}}
+        """
+
+        with self._lock:
+            snapshot = {}
+            for (kind, name), stats in sorted(self._stats.items()):
+                latency = stats.latency
+                snapshot.setdefault(kind, {})[name] = {
+                    'count': latency.count,
+                    'seconds_total': latency.sum,
+                    'seconds_max': latency.max,
+                    'p50': latency.get_quantile(0.5),
+                    'p90': latency.get_quantile(0.9),
+                    'p99': latency.get_quantile(0.99),
+                    'payload_bytes': stats.payload_bytes,
+                    'retries': stats.retries,
+                    'errors': dict(stats.errors)}
+
+        return snapshot
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def to_prometheus(self) -> str:
+        """
+        Metrics in text format of Prometheus
+        """
+
+        lines = ['# TYPE tinder_call_seconds histogram',
+                 '# TYPE tinder_call_payload_bytes_total counter',
+                 '# TYPE tinder_call_retries_total counter',
+                 '# TYPE tinder_call_errors_total counter']
+
+        with self._lock:
+            for (kind, name), stats in sorted(self._stats.items()):
+                labels = f'kind="{kind}",name="{name}"'
+                for bound, count in stats.latency.get_cumulative_buckets():
+                    lines.append(f'tinder_call_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'tinder_call_seconds_sum{{{labels}}} {stats.latency.sum}')
+                lines.append(f'tinder_call_seconds_count{{{labels}}} {stats.latency.count}')
+                lines.append(f'tinder_call_payload_bytes_total{{{labels}}} {stats.payload_bytes}')
+                lines.append(f'tinder_call_retries_total{{{labels}}} {stats.retries}')
+                for code, count in sorted(stats.errors.items()):
+                    lines.append(f'tinder_call_errors_total{{{labels},code="{code}"}} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str) -> None:
+        """
+        Save snapshot of metrics to json file
+
+        :param path: path to file
+        """
+
+        with open(path, encoding='utf8', mode='w') as output:
+            json.dump(self.snapshot(), output, indent=2)
+
+
+metrics = Metrics()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.to_prometheus().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = '127.0.0.1', registry: Metrics = metrics) -> ThreadingHTTPServer:
+    """
+    Serve metrics in text format of Prometheus on http://host:port/metrics from a daemon thread
+
+    :return: server, call its shutdown() to stop it
+    """
+
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    server.metrics = registry
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
@@ -0,0 +1,152 @@
+from config.config_app import MINHASH_PERMUTATIONS, MINHASH_BANDS, MINHASH_SEED
+from typing import Callable, Dict, Iterable, List, Set
+
+from array import array
+
+import heapq
+import random
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, without it signatures are calculated with python ints
+    np = None
+
+# hashes are (a * x + b) mod prime, products of 31-bit ints fit in int64 of numpy
+_PRIME = (1 << 31) - 1
+
+# groups, friends and terms are different features even with the same id
+_KIND_OF_GROUP, _KIND_OF_FRIEND, _KIND_OF_TERM = range(3)
+
+
+def get_minhash_features(groups: Iterable[int], friends: Iterable[int], *terms: Iterable[int]) -> Set[int]:
+    """
+    Pack ids of groups, friends and terms (ids of the vocabulary) in one set of features
+
+    :param groups: ids of groups
+    :param friends: ids of friends
+    :param terms: ids of terms of music, books, etc.
+    """
+
+    features = {group_id * 3 + _KIND_OF_GROUP for group_id in groups}
+    features.update(friend_id * 3 + _KIND_OF_FRIEND for friend_id in friends)
+    for ids_of_terms in terms:
+        features.update(term_id * 3 + _KIND_OF_TERM for term_id in ids_of_terms)
+
+    return features
+
+
+class MinHasher:
+    """
+    MinHash signatures of sets of features. Share of equal positions of two signatures is an estimate
+    of Jaccard similarity of the sets. Signatures are the same for the same seed, so they can be stored
+    """
+
+    def __init__(self, permutations: int = MINHASH_PERMUTATIONS, seed: int = MINHASH_SEED):
+        """
+        :param permutations: length of signature
+        :param seed: seed of hash functions
+        """
+
+        rnd = random.Random(seed)
+        self.permutations = permutations
+        self._a = [rnd.randrange(1, _PRIME) for _ in range(permutations)]
+        self._b = [rnd.randrange(0, _PRIME) for _ in range(permutations)]
+
+        if np is not None:
+            self._np_a = np.array(self._a, dtype=np.int64)[:, None]
+            self._np_b = np.array(self._b, dtype=np.int64)[:, None]
+
+    def signature(self, features: Iterable[int]) -> array:
+        """
+        Return signature of set of features (array of 32-bit ints). Signature of empty set is filled with _PRIME
+        """
+
+        features = [feature % _PRIME for feature in set(features)]
+        if not features:
+            return array('i', [_PRIME] * self.permutations)
+
+        if np is None:
+            return array('i', [min((a * feature + b) % _PRIME for feature in features)
+                               for a, b in zip(self._a, self._b)])
+
+        hashes = (self._np_a * np.array(features, dtype=np.int64) + self._np_b) % _PRIME
+        return array('i', hashes.min(axis=1).astype(np.int32).tobytes())
+
+
+def estimate_similarity(first_signature: array, second_signature: array) -> float:
+    """
+    Estimate of Jaccard similarity of sets by their signatures
+    """
+
+    return sum(first == second for first, second in zip(first_signature, second_signature)) / len(first_signature)
+
+
+class LshIndex:
+    """
+    Locality-sensitive hashing index of MinHash signatures. A signature is split in bands, keys which
+    have the same values in at least one band with the query are likely to have a large overlap with it
+    """
+
+    def __init__(self, permutations: int = MINHASH_PERMUTATIONS, bands: int = MINHASH_BANDS):
+        """
+        :param permutations: length of signatures
+        :param bands: count of bands, more bands find pairs with smaller similarity (and more false ones)
+        """
+
+        if permutations % bands:
+            raise ValueError('Count of permutations must be divisible by count of bands')
+
+        self.rows = permutations // bands
+        self._buckets: List[Dict[bytes, Set[int]]] = [{} for _ in range(bands)]
+        self._signatures: Dict[int, array] = {}
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def _get_band_keys(self, signature: array) -> Iterable[bytes]:
+        rows = self.rows
+        return (signature[start:start + rows].tobytes() for start in range(0, len(signature), rows))
+
+    def add(self, key: int, signature: array) -> None:
+        """
+        Add signature (a known key is replaced). Signature of empty set is not indexed, it is similar to nothing
+        """
+
+        self.remove(key)
+        if signature[0] == _PRIME:  # hashes are less than _PRIME, so it is signature of empty set
+            return
+
+        self._signatures[key] = signature
+        for buckets, band_key in zip(self._buckets, self._get_band_keys(signature)):
+            buckets.setdefault(band_key, set()).add(key)
+
+    def remove(self, key: int) -> None:
+        signature = self._signatures.pop(key, None)
+        if signature is None:
+            return
+
+        for buckets, band_key in zip(self._buckets, self._get_band_keys(signature)):
+            buckets[band_key].discard(key)
+            if not buckets[band_key]:
+                del buckets[band_key]
+
+    def get_signature(self, key: int) -> array:
+        return self._signatures.get(key)
+
+    def query(self, signature: array, count: int, is_excluded: Callable[[int], bool] = None) -> List[int]:
+        """
+        Return keys which share a band with signature, the most similar ones first
+
+        :param signature: signature of query
+        :param count: max count of keys
+        :param is_excluded: function which says if key must be skipped
+        """
+
+        keys = set()
+        for buckets, band_key in zip(self._buckets, self._get_band_keys(signature)):
+            keys.update(buckets.get(band_key, ()))
+
+        if is_excluded is not None:
+            keys = [key for key in keys if not is_excluded(key)]
+
+        return heapq.nlargest(count, keys, key=lambda key: estimate_similarity(signature, self._signatures[key]))
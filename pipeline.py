@@ -0,0 +1,297 @@
+"""
+Search as a chain of streaming stages:
+
+search pager -> closed-profile filter -> dedup/blacklist filter -> hydrator -> [pool writer] -> scorer -> top-k sink
+
+Every stage is a generator which takes the previous stage. Stages can be run in background threads
+(run_in_thread), then they are connected with bounded queues and work concurrently.
+"""
+
+from config.config_app import COUNT_OF_TOP_MATCHES, PIPELINE_BATCH_SIZE, PIPELINE_QUEUE_SIZE
+from tinder_users import TinderUser, select_top_tinder_users, add_terms_to_vocabulary
+from scoring import score_candidates
+from typing import Callable, Dict, Iterable, Iterator, List
+
+import asyncio
+import queue
+import threading
+
+_END_OF_STAGE = object()
+
+
+class _ErrorOfStage:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def _batched(items: Iterable, batch_size: int) -> Iterator[List]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def init_tinder_users(vk_client, processed_data_of_tinder_users: List[Dict],
+                      async_vk_client=None) -> List[TinderUser]:
+    """
+    Create Tinder Users from data of users.get. Friends and groups of all users are fetched in batch
+
+    :param vk_client: Instance of VkMachinery
+    :param processed_data_of_tinder_users: List of dict of data of Tinder Users
+    :param async_vk_client: Instance of AsyncVkMachinery, if it is given "execute" batches are sent concurrently
+    :return: List of instances of Tinder User
+    """
+
+    user_ids = [data_of_tinder_user['id'] for data_of_tinder_user in processed_data_of_tinder_users]
+    if async_vk_client is not None:
+        friends_and_groups = asyncio.run(async_vk_client.get_friends_and_groups_of_users(user_ids))
+    else:
+        friends_and_groups = vk_client.get_friends_and_groups_of_users(user_ids)
+    # new terms of the whole page are written to the vocabulary at once
+    add_terms_to_vocabulary((data_of_tinder_user.get('music', 'closed')
+                             for data_of_tinder_user in processed_data_of_tinder_users),
+                            (data_of_tinder_user.get('books', 'closed')
+                             for data_of_tinder_user in processed_data_of_tinder_users))
+
+    list_of_tinder_users = []
+    for data_of_tinder_user in processed_data_of_tinder_users:
+        init_obj = dict(data_of_tinder_user, **friends_and_groups[data_of_tinder_user['id']])
+        list_of_tinder_users.append(TinderUser(vk_client=vk_client, init_obj=init_obj))
+
+    return list_of_tinder_users
+
+
+def run_in_thread(stage: Iterable, queue_size: int = PIPELINE_QUEUE_SIZE) -> Iterator:
+    """
+    Run stage in a background thread and give its items through a bounded queue.
+    When the queue is full the stage waits for the consumer (backpressure). Errors of the stage are raised
+    in the consumer. When the consumer stops, the stage is stopped too
+
+    :param stage: Iterable (usually generator of the previous stage)
+    :param queue_size: max count of items between the stage and its consumer
+    """
+
+    items = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def produce() -> None:
+        try:
+            for item in stage:
+                if not put(item):
+                    return
+            put(_END_OF_STAGE)
+        except Exception as e:
+            put(_ErrorOfStage(e))
+        finally:
+            close = getattr(stage, 'close', None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _END_OF_STAGE:
+                return
+            if isinstance(item, _ErrorOfStage):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
+
+
+def search_pager(vk_client, main_user_config: Dict, max_pages: int = None, verbose: bool = True) -> Iterator[Dict]:
+    """
+    Give searched users page by page. Offset of config is advanced before every page.
+    It stops after "max_pages" pages or when VK has no more results
+
+    :param vk_client: Instance of VkMachinery
+    :param main_user_config: config of search (see MainUser.get_search_config_obj)
+    :param max_pages: max count of pages, None means all pages
+    :param verbose: print message about waiting
+    """
+
+    count_of_pages = 0
+    while max_pages is None or count_of_pages < max_pages:
+        main_user_config['offset_for_search'] += main_user_config['count_for_search']
+        searched_users = vk_client.users_search(config=main_user_config, verbose=verbose)
+        count_of_pages += 1
+
+        if not searched_users:
+            return
+
+        yield from searched_users
+
+
+def sharded_search(vk_client, main_user_config: Dict, shard_by_birth_month: bool = False) -> Iterator[Dict]:
+    """
+    Give users of high-volume search as shards of search finish (see VkMachinery.iter_users_search_sharded)
+
+    :param vk_client: Instance of VkMachinery
+    :param main_user_config: config of search (see MainUser.get_search_config_obj)
+    :param shard_by_birth_month: split every age into 12 shards by month of birth
+    """
+
+    for found_users in vk_client.iter_users_search_sharded(main_user_config,
+                                                           shard_by_birth_month=shard_by_birth_month):
+        yield from found_users
+
+
+def closed_profile_filter(searched_users: Iterable[Dict]) -> Iterator[Dict]:
+    """
+    Drop users with closed profiles
+    """
+
+    for searched_user in searched_users:
+        if searched_user['is_closed'] is False:
+            yield searched_user
+
+
+def dedup_filter(searched_users: Iterable[Dict], is_excluded: Callable[[int], bool] = None) -> Iterator[Dict]:
+    """
+    Drop users which were already given by this stage and users which are excluded
+
+    :param searched_users: Iterable of searched users
+    :param is_excluded: function which says if user with this id must be dropped (e.g. blacklisted users)
+    """
+
+    seen_ids = set()
+    for searched_user in searched_users:
+        user_id = searched_user['id']
+        if user_id in seen_ids or (is_excluded is not None and is_excluded(user_id)):
+            continue
+
+        seen_ids.add(user_id)
+        yield searched_user
+
+
+def hydrator(vk_client, searched_users: Iterable[Dict], batch_size: int = PIPELINE_BATCH_SIZE,
+             async_vk_client=None) -> Iterator[TinderUser]:
+    """
+    Create Tinder Users from searched users. Profiles, friends and groups are fetched in batches
+
+    :param vk_client: Instance of VkMachinery
+    :param searched_users: Iterable of searched users with opened profiles
+    :param batch_size: count of users which are fetched together
+    :param async_vk_client: Instance of AsyncVkMachinery, friends and groups are fetched concurrently with it
+    """
+
+    for batch in _batched(searched_users, batch_size):
+        processed_data_of_tinder_users = vk_client.get_processed_data_of_tinder_users(
+            searched_users=batch, main_user_config=None)
+
+        if processed_data_of_tinder_users:
+            yield from init_tinder_users(vk_client, processed_data_of_tinder_users, async_vk_client)
+
+
+def pool_writer(tinder_users: Iterable[TinderUser], candidate_pool,
+                batch_size: int = PIPELINE_BATCH_SIZE) -> Iterator[TinderUser]:
+    """
+    Add hydrated Tinder Users to the candidate pool in batches and pass them further
+
+    :param candidate_pool: Instance of CandidatePool
+    """
+
+    for batch in _batched(tinder_users, batch_size):
+        candidate_pool.add_many(batch)
+        yield from batch
+
+
+def scorer(main_user, tinder_users: Iterable[TinderUser],
+           batch_size: int = PIPELINE_BATCH_SIZE) -> Iterator[TinderUser]:
+    """
+    Calculate matching score of Tinder Users in batches (see scoring.score_candidates)
+    """
+
+    for batch in _batched(tinder_users, batch_size):
+        score_candidates(main_user, batch)
+        yield from batch
+
+
+class SearchPipeline:
+    """
+    Search of Tinder Users for the main user, built from streaming stages of this module.
+
+    It can be used by the interactive app (one page per round) and by headless callers (long crawls).
+    Memory does not depend on count of pages: only the queues between stages and the top-k heap are kept
+    """
+
+    def __init__(self, vk_client, main_user, main_user_config: Dict, is_excluded: Callable[[int], bool] = None,
+                 batch_size: int = PIPELINE_BATCH_SIZE, queue_size: int = PIPELINE_QUEUE_SIZE,
+                 threaded: bool = True, verbose: bool = True, sharded: bool = False,
+                 shard_by_birth_month: bool = False, candidate_pool=None, async_vk_client=None):
+        """
+        :param vk_client: Instance of VkMachinery
+        :param main_user: Instance of class MainUser(TinderUser)
+        :param main_user_config: config of search, its offset is advanced by the pipeline
+        :param is_excluded: function which says if user with this id must be skipped before hydration
+        :param batch_size: count of users which are hydrated and scored together
+        :param queue_size: max count of items between stages
+        :param threaded: run search and hydration in background threads
+        :param verbose: print messages about waiting
+        :param sharded: use high-volume search sharded by age instead of pages (see sharded_search)
+        :param shard_by_birth_month: shard high-volume search by month of birth too
+        :param candidate_pool: Instance of CandidatePool, all hydrated users are added to it
+        :param async_vk_client: Instance of AsyncVkMachinery, if it is given users are hydrated concurrently
+        """
+
+        self.vk_client = vk_client
+        self.main_user = main_user
+        self.main_user_config = main_user_config
+        self.is_excluded = is_excluded
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.threaded = threaded
+        self.verbose = verbose
+        self.sharded = sharded
+        self.shard_by_birth_month = shard_by_birth_month
+        self.candidate_pool = candidate_pool
+        self.async_vk_client = async_vk_client
+
+    def _in_thread(self, stage: Iterable) -> Iterable:
+        return run_in_thread(stage, self.queue_size) if self.threaded else stage
+
+    def stream(self, max_pages: int = None) -> Iterator[TinderUser]:
+        """
+        Give scored Tinder Users one by one
+
+        :param max_pages: max count of pages of search, None means all pages (it is ignored by sharded search)
+        """
+
+        if self.sharded:
+            stage = sharded_search(self.vk_client, self.main_user_config, self.shard_by_birth_month)
+        else:
+            stage = search_pager(self.vk_client, self.main_user_config, max_pages=max_pages, verbose=self.verbose)
+        stage = closed_profile_filter(stage)
+        stage = dedup_filter(stage, self.is_excluded)
+        stage = hydrator(self.vk_client, self._in_thread(stage), self.batch_size, self.async_vk_client)
+        if self.candidate_pool is not None:
+            stage = pool_writer(stage, self.candidate_pool, self.batch_size)
+
+        return scorer(self.main_user, self._in_thread(stage), self.batch_size)
+
+    def top(self, count: int = COUNT_OF_TOP_MATCHES, max_pages: int = None) -> List[TinderUser]:
+        """
+        Return "count" Tinder Users with the highest score (see select_top_tinder_users)
+
+        :param count: how many users to select
+        :param max_pages: max count of pages of search, None means all pages
+        """
+
+        return select_top_tinder_users(self.stream(max_pages), count)
@@ -0,0 +1,140 @@
+from config.config_app import PREFETCH_PAGES
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import threading
+
+# settings of search which make prefetched pages useless when they change
+_SEARCH_SETTINGS = ('vk_id', 'count_for_search', 'sex', 'city', 'desired_age_from', 'desired_age_to')
+
+
+def _get_settings_of_search(main_user_config: Dict) -> Tuple:
+    return tuple(main_user_config.get(setting) for setting in _SEARCH_SETTINGS)
+
+
+def _get_key_of_page(main_user_config: Dict) -> Tuple:
+    return _get_settings_of_search(main_user_config) + (main_user_config['offset_for_search'],)
+
+
+class SearchPrefetcher:
+    """
+    Fetches the next pages of search in a background thread while the user reads results.
+
+    "fetch_page" takes config of search, advances its offset and returns users of the next page.
+    It is called with copies of config, so the config of caller is never changed. A page is given back
+    only when it follows the current config of caller, otherwise all prefetched pages are discarded.
+    While the caller goes on with the same settings, pages which are already fetched are kept and
+    only the missing pages ahead are fetched.
+    """
+
+    def __init__(self, fetch_page: Callable[[Dict], List], pages: int = PREFETCH_PAGES):
+        self._fetch_page = fetch_page
+        self._pages = pages
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._is_running = False
+        self._settings_of_search = None
+        self._prefetched_pages: Dict[Tuple, Tuple[Dict, List]] = {}
+        # config of the next page which is not fetched yet, None when the search is exhausted
+        self._next_config: Optional[Dict] = None
+
+    def _follows_prefetched_pages(self, main_user_config: Dict) -> bool:
+        if _get_settings_of_search(main_user_config) != self._settings_of_search:
+            return False
+
+        key_of_page = _get_key_of_page(main_user_config)
+        return key_of_page in self._prefetched_pages or (self._next_config is not None
+                                                         and key_of_page == _get_key_of_page(self._next_config))
+
+    def start(self, main_user_config: Dict) -> None:
+        """
+        Start fetching of pages which follow the offset of config
+        """
+
+        with self._condition:
+            if self._follows_prefetched_pages(main_user_config):
+                # pages before the offset of config are already taken by the caller
+                offset = main_user_config['offset_for_search']
+                for key_of_page in [key for key in self._prefetched_pages if key[-1] < offset]:
+                    del self._prefetched_pages[key_of_page]
+            else:
+                self._discard()
+                self._settings_of_search = _get_settings_of_search(main_user_config)
+                self._next_config = dict(main_user_config)
+
+            if not self._is_running and self._next_config is not None:
+                self._is_running = True
+                self._executor.submit(self._prefetch, self._generation)
+
+    def _prefetch(self, generation: int) -> None:
+        try:
+            while True:
+                with self._condition:
+                    if (generation != self._generation or self._next_config is None
+                            or len(self._prefetched_pages) >= self._pages):
+                        return
+                    main_user_config = dict(self._next_config)
+
+                key_of_page = _get_key_of_page(main_user_config)
+                users = self._fetch_page(main_user_config)
+
+                with self._condition:
+                    if generation != self._generation:
+                        return
+                    self._prefetched_pages[key_of_page] = (main_user_config, users)
+                    self._next_config = dict(main_user_config) if users else None
+                    self._condition.notify_all()
+        except Exception:
+            # speculative work must not break the app, the page will be fetched again when it is needed
+            pass
+        finally:
+            with self._condition:
+                if generation == self._generation:
+                    self._is_running = False
+                    self._condition.notify_all()
+
+    def take(self, main_user_config: Dict) -> Optional[Tuple[Dict, List]]:
+        """
+        Return prefetched page which follows the config: (copy of config with advanced offset, users of page).
+        Waits if the page is being fetched right now. Returns None when there is no such page
+
+        :param main_user_config: current config of search
+        """
+
+        with self._condition:
+            if _get_settings_of_search(main_user_config) != self._settings_of_search:
+                self._discard()
+                return None
+
+            key_of_page = _get_key_of_page(main_user_config)
+            while key_of_page not in self._prefetched_pages and self._is_running:
+                self._condition.wait()
+
+            page = self._prefetched_pages.pop(key_of_page, None)
+            if page is None:
+                self._discard()
+
+            return page
+
+    def _discard(self) -> None:
+        # pages of the previous generation are dropped even if they are being fetched right now
+        self._generation += 1
+        self._is_running = False
+        self._settings_of_search = None
+        self._next_config = None
+        self._prefetched_pages.clear()
+        self._condition.notify_all()
+
+    def discard(self) -> None:
+        """
+        Drop all prefetched pages (e.g. when settings of search are changed)
+        """
+
+        with self._condition:
+            self._discard()
+
+    def close(self) -> None:
+        self.discard()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,92 @@
+from config.config_app import POINT_OF_GROUP_UNIT, POINT_OF_FRIEND_UNIT, POINT_OF_MUSIC, POINT_OF_BOOKS
+from tinder_users import get_feature_profile
+from typing import Iterable, List, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, without it overlaps are counted with python sets
+    np = None
+
+
+def _sorted_unique(array):
+    """
+    Sort array and drop duplicates (a plain sort is faster than np.unique on large arrays of ints)
+    """
+
+    array = np.sort(array)
+    if array.size:
+        array = array[np.concatenate(([True], array[1:] != array[:-1]))]
+
+    return array
+
+
+def count_common_ids(main_ids: Iterable[int], lists_of_ids: Sequence[Iterable[int]]) -> List[int]:
+    """
+    Count how many ids of every list are in main_ids. Duplicates in a list are counted once (like in set intersection)
+
+    With numpy all lists are flattened in one array and looked up in sorted main_ids at once
+
+    :param main_ids: ids of the main user (friends or groups)
+    :param lists_of_ids: ids of every candidate
+    :return: count of common ids for every candidate
+    """
+
+    if np is None:
+        main_ids = set(main_ids)
+        return [len(main_ids.intersection(ids)) for ids in lists_of_ids]
+
+    count_of_lists = len(lists_of_ids)
+    main_sorted = _sorted_unique(np.fromiter(main_ids, dtype=np.int64))
+    lengths = np.fromiter((len(ids) for ids in lists_of_ids), dtype=np.int64, count=count_of_lists)
+    total_length = int(lengths.sum())
+    if main_sorted.size == 0 or total_length == 0:
+        return [0] * count_of_lists
+
+    # arrays of ids of TinderUser are converted through the buffer protocol without copying to python ints
+    ids = np.concatenate([np.asarray(ids_of_list, dtype=np.int64) for ids_of_list in lists_of_ids])
+    owners = np.repeat(np.arange(count_of_lists, dtype=np.int64), lengths)
+
+    # pack (owner, id) in one key to drop duplicated ids of the same candidate
+    min_id = ids.min()
+    span = ids.max() - min_id + 1
+    keys = _sorted_unique(owners * span + (ids - min_id))
+    owners, ids = keys // span, keys % span + min_id
+
+    positions = np.minimum(np.searchsorted(main_sorted, ids), main_sorted.size - 1)
+    is_common = main_sorted[positions] == ids
+
+    return np.bincount(owners[is_common], minlength=count_of_lists).tolist()
+
+
+def score_candidates(main_user, candidates: Sequence, assign: bool = True) -> List[float]:
+    """
+    Calculate matching scores of many candidates at once. Result is the same as
+    candidate.calculate_matching_score(main_user) for every candidate, but the main user is encoded only once
+
+    :param main_user: Instance of class MainUser(TinderUser)
+    :param candidates: Sequence of instances of TinderUser
+    :param assign: put scores in field "score" of candidates
+    :return: List of scores in order of candidates
+    """
+
+    profile = get_feature_profile(main_user)
+
+    common_groups = count_common_ids(profile.groups, [candidate.groups for candidate in candidates])
+    common_friends = count_common_ids(profile.friends,
+                                      [candidate.get_friends_for_matching() for candidate in candidates])
+
+    scores = []
+    for candidate, count_of_groups, count_of_friends in zip(candidates, common_groups, common_friends):
+        groups_score = POINT_OF_GROUP_UNIT * count_of_groups
+        friends_score = POINT_OF_FRIEND_UNIT * count_of_friends
+        books_score = POINT_OF_BOOKS * len(profile.book_terms.intersection(candidate.record.book_terms))
+        music_score = POINT_OF_MUSIC * len(profile.music_terms.intersection(candidate.record.music_terms))
+        age_score = candidate._get_points_of_age(profile.desired_age_from, profile.desired_age_to)
+
+        scores.append(groups_score + friends_score + books_score + music_score + age_score)
+
+    if assign:
+        for candidate, score in zip(candidates, scores):
+            candidate.score = score
+
+    return scores
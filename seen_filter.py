@@ -0,0 +1,93 @@
+from config.config_app import SEEN_FILTER_BLOOM_THRESHOLD, SEEN_FILTER_FALSE_POSITIVE_RATE
+from database import db
+from typing import Iterable
+
+import hashlib
+import math
+import threading
+
+
+class BloomFilter:
+    """
+    Compact probabilistic set of ints. It can say that an id was added when it was not
+    (with probability about "false_positive_rate"), but never misses an added id
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float = SEEN_FILTER_FALSE_POSITIVE_RATE):
+        capacity = max(capacity, 1)
+        self.size_in_bits = max(8, int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.count_of_hashes = max(1, round(self.size_in_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.size_in_bits + 7) // 8)
+
+    def _get_positions(self, item: int) -> Iterable[int]:
+        # double hashing: two halves of one digest give all positions
+        digest = hashlib.blake2b(str(item).encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+
+        return ((first + ind * second) % self.size_in_bits for ind in range(self.count_of_hashes))
+
+    def add(self, item: int) -> None:
+        for position in self._get_positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: int) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._get_positions(item))
+
+    def copy(self) -> 'BloomFilter':
+        bloom_filter = BloomFilter.__new__(BloomFilter)
+        bloom_filter.size_in_bits, bloom_filter.count_of_hashes = self.size_in_bits, self.count_of_hashes
+        bloom_filter._bits = bytearray(self._bits)
+
+        return bloom_filter
+
+
+class SeenUsersFilter:
+    """
+    Ids of users which must not be shown again: blacklisted users and users from results of previous rounds.
+
+    It is loaded once at start. Small histories are kept in a set, large ones (more than
+    SEEN_FILTER_BLOOM_THRESHOLD ids) in a Bloom filter
+    """
+
+    def __init__(self, vk_ids: Iterable[int] = (), bloom_threshold: int = SEEN_FILTER_BLOOM_THRESHOLD):
+        vk_ids = list(vk_ids)
+        self._lock = threading.Lock()
+
+        if len(vk_ids) > bloom_threshold:
+            # room for growth of history during the session
+            self._seen_ids = BloomFilter(capacity=2 * len(vk_ids))
+        else:
+            self._seen_ids = set()
+
+        self.add_many(vk_ids)
+
+    @classmethod
+    def load(cls, bloom_threshold: int = SEEN_FILTER_BLOOM_THRESHOLD) -> 'SeenUsersFilter':
+        """
+        Create filter from the tables "tinder_black_list" and "tinder_result"
+        """
+
+        return cls(db.get_seen_vk_ids(), bloom_threshold=bloom_threshold)
+
+    def add(self, vk_id: int) -> None:
+        with self._lock:
+            self._seen_ids.add(int(vk_id))
+
+    def add_many(self, vk_ids: Iterable[int]) -> None:
+        with self._lock:
+            for vk_id in vk_ids:
+                self._seen_ids.add(int(vk_id))
+
+    def __contains__(self, vk_id: int) -> bool:
+        return int(vk_id) in self._seen_ids
+
+    def copy(self) -> 'SeenUsersFilter':
+        """
+        Return independent filter with the same ids, ids added to one of them are not seen by the other
+        """
+
+        seen_filter = SeenUsersFilter()
+        with self._lock:
+            seen_filter._seen_ids = self._seen_ids.copy()
+
+        return seen_filter
@@ -0,0 +1,344 @@
+"""
+Long-running match service. Main users, their compiled features and prefetched pages of search stay warm
+between requests, profiles of candidates are shared by all main users through one cache.
+
+Example: python server.py --port 8000
+
+Endpoints (bodies and answers are JSON):
+POST   /sessions                     {"access_token": ..., "desired_age_from": 20, "desired_age_to": 30}
+GET    /sessions/<vk_id>/matches     the next page of matches
+POST   /sessions/<vk_id>/blacklist   {"index": 0}, index of person in the last page of matches
+POST   /sessions/<vk_id>/favorite    {"index": 0}
+GET    /sessions/<vk_id>/pool        the best candidates from the candidate pool, without requests to VK API
+DELETE /sessions/<vk_id>
+GET    /stats
+"""
+from vk.vk_machinery import VkMachinery
+from tinder_users import MainUser
+from prefetch import SearchPrefetcher
+from seen_filter import SeenUsersFilter
+from candidate_pool import CandidatePool
+from database.db import create_db
+from database.write_behind import write_behind
+from database.cache import ProfileCache
+from database.snapshot import MainUserSnapshots
+from main import fetch_next_page, tact_of_app
+from metrics import metrics
+from vocabulary import vocabulary
+from config.config_app import SERVER_HOST, SERVER_PORT, SERVER_WORKERS, PREFETCH_PAGES, VK_API_URL
+from config.config_app import PATH_TO_PROFILE_CACHE
+from utils import HttpException, VkException, get_vk_id_from_link
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http import HTTPStatus
+from typing import Dict, List, Optional, Tuple
+
+import argparse
+import asyncio
+import json
+import re
+
+_session_path_pattern = re.compile(r'^/sessions/(?P<vk_id>\d+)(?:/(?P<action>matches|blacklist|favorite|pool))?$')
+
+
+def _parse_body(raw_body: bytes) -> Dict:
+    try:
+        body = json.loads(raw_body) if raw_body else {}
+    except ValueError:
+        body = None
+
+    if not isinstance(body, dict):
+        raise HttpException(HTTPStatus.BAD_REQUEST, 'Body must be JSON object')
+
+    return body
+
+
+class MatchSession:
+    """
+    Warm state of one main user: client of VK API, main user with compiled features, config of search,
+    users shown to the main user, prefetched pages and the last page of matches
+    """
+
+    def __init__(self, vk_client: VkMachinery, main_user: MainUser, seen_filter: SeenUsersFilter,
+                 prefetcher: Optional[SearchPrefetcher]):
+        self.vk_client = vk_client
+        self.main_user = main_user
+        self.main_user_config = main_user.get_search_config_obj()
+        self.seen_filter = seen_filter
+        self.prefetcher = prefetcher
+        self.last_matches: List[Dict] = []
+        # requests of one main user are served one by one
+        self.lock = asyncio.Lock()
+        self.is_closed = False
+
+    def close(self) -> None:
+        self.is_closed = True
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        self.main_user.close()
+        self.vk_client.close()
+
+
+class MatchServer:
+    """
+    HTTP server (asyncio) of matches. Requests to VK API and to the database go to a pool of threads,
+    so slow requests of one main user do not block the others
+    """
+
+    def __init__(self, cache: ProfileCache = None, seen_filter: SeenUsersFilter = None,
+                 prefetch_pages: int = PREFETCH_PAGES, workers: int = SERVER_WORKERS, api_url: str = VK_API_URL,
+                 candidate_pool: CandidatePool = None, snapshots: MainUserSnapshots = None):
+        """
+        :param cache: cache of profiles shared by all main users
+        :param seen_filter: history of shown and blacklisted users, every session starts with its copy
+        :param prefetch_pages: count of pages of search which are fetched in advance for every main user
+        :param workers: count of threads for requests to VK API and to the database
+        :param api_url: base url of methods of VK API
+        :param candidate_pool: pool where all hydrated candidates are added, the best of them can be queried
+        :param snapshots: snapshots of main users, sessions of known users are created without requests to VK API
+        """
+
+        self.cache = cache
+        self.seen_filter = seen_filter if seen_filter is not None else SeenUsersFilter()
+        self.prefetch_pages = prefetch_pages
+        self.api_url = api_url
+        self.candidate_pool = candidate_pool
+        self.snapshots = snapshots
+        self.sessions: Dict[int, MatchSession] = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    async def _run_in_executor(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args))
+
+    def _create_session(self, settings: Dict) -> MatchSession:
+        vk_client = VkMachinery(cache=self.cache, api_url=self.api_url)
+        vk_client.initialize_vk_api(access_token=settings['access_token'])
+
+        main_user = MainUser(vk_client=vk_client, desired_age_from=settings.get('desired_age_from'),
+                             desired_age_to=settings.get('desired_age_to'), interactive=False,
+                             snapshots=self.snapshots)
+
+        # a new session of the same main user keeps users shown by the old one
+        previous_session = self.sessions.get(main_user.tinder_user_id)
+        seen_filter = (previous_session.seen_filter if previous_session is not None else self.seen_filter).copy()
+
+        prefetcher = None
+        if self.prefetch_pages:
+            prefetcher = SearchPrefetcher(partial(fetch_next_page, vk_client, main_user, seen_filter=seen_filter,
+                                                  verbose=False, candidate_pool=self.candidate_pool),
+                                          pages=self.prefetch_pages)
+
+        return MatchSession(vk_client, main_user, seen_filter, prefetcher)
+
+    def _get_next_matches(self, session: MatchSession) -> List[Dict]:
+        prefetched_page = session.prefetcher.take(session.main_user_config) if session.prefetcher else None
+        if prefetched_page is not None:
+            session.main_user_config, list_of_tinder_users = prefetched_page
+        else:
+            list_of_tinder_users = fetch_next_page(session.vk_client, session.main_user, session.main_user_config,
+                                                   seen_filter=session.seen_filter, verbose=False,
+                                                   candidate_pool=self.candidate_pool)
+        if not list_of_tinder_users:
+            return []
+
+        session.main_user.update_search_offset(session.main_user_config['offset_for_search'])
+        matches = tact_of_app(main_user=session.main_user, tinder_users=list_of_tinder_users, scored=True,
+                              seen_filter=session.seen_filter)
+
+        if session.prefetcher is not None:
+            # the next pages are fetched while the client reads matches
+            session.prefetcher.start(session.main_user_config)
+
+        return matches
+
+    def _get_session(self, vk_id: int) -> MatchSession:
+        if vk_id not in self.sessions:
+            raise HttpException(HTTPStatus.NOT_FOUND, f'There is no session of user {vk_id}')
+
+        return self.sessions[vk_id]
+
+    async def _close_session(self, session: MatchSession) -> None:
+        # the running request of the session is finished first
+        async with session.lock:
+            await self._run_in_executor(session.close)
+
+    @staticmethod
+    def _get_chosen_person(session: MatchSession, body: Dict) -> Dict:
+        index = body.get('index')
+        if not isinstance(index, int) or not 0 <= index < len(session.last_matches):
+            raise HttpException(HTTPStatus.BAD_REQUEST, f'"index" must be from 0 to {len(session.last_matches) - 1}')
+
+        return session.last_matches[index]
+
+    async def dispatch(self, method: str, path: str, body: Dict) -> Tuple[HTTPStatus, Dict]:
+        """
+        Serve request
+
+        :param method: HTTP method
+        :param path: path of url
+        :param body: parsed JSON body of request
+        :return: status and JSON answer
+        """
+
+        if path == '/stats' and method == 'GET':
+            size_of_pool = len(self.candidate_pool) if self.candidate_pool is not None else None
+            return HTTPStatus.OK, {'sessions': len(self.sessions),
+                                   'candidate_pool': size_of_pool,
+                                   'cache': self.cache.stats() if self.cache is not None else None,
+                                   'metrics': metrics.snapshot()}
+
+        if path == '/sessions' and method == 'POST':
+            if 'access_token' not in body:
+                raise HttpException(HTTPStatus.BAD_REQUEST, '"access_token" is required')
+
+            session = await self._run_in_executor(self._create_session, body)
+            vk_id = session.main_user.tinder_user_id
+            previous_session = self.sessions.get(vk_id)
+            # the old session of this user is replaced (e.g. with new token or ages)
+            self.sessions[vk_id] = session
+            if previous_session is not None:
+                await self._close_session(previous_session)
+
+            return HTTPStatus.CREATED, {'vk_id': vk_id,
+                                        'first_name': session.main_user.first_name,
+                                        'last_name': session.main_user.last_name,
+                                        'desired_age_from': session.main_user.desired_age_from,
+                                        'desired_age_to': session.main_user.desired_age_to}
+
+        match_of_path = _session_path_pattern.match(path)
+        if match_of_path is None:
+            raise HttpException(HTTPStatus.NOT_FOUND, 'Unknown path')
+
+        vk_id = int(match_of_path.group('vk_id'))
+        session = self._get_session(vk_id)
+        action = match_of_path.group('action')
+
+        if action is None and method == 'DELETE':
+            del self.sessions[vk_id]
+            await self._close_session(session)
+            return HTTPStatus.OK, {}
+
+        async with session.lock:
+            if session.is_closed:
+                # the session was deleted or replaced while the request waited for it
+                raise HttpException(HTTPStatus.NOT_FOUND, f'There is no session of user {vk_id}')
+
+            if action == 'matches' and method == 'GET':
+                session.last_matches = await self._run_in_executor(self._get_next_matches, session)
+                return HTTPStatus.OK, {'matches': session.last_matches}
+
+            if action == 'blacklist' and method == 'POST':
+                person = self._get_chosen_person(session, body)
+                write_behind.add_to_black_list(person)
+                session.seen_filter.add(get_vk_id_from_link(person['vk_link']))
+                return HTTPStatus.OK, {'blacklisted': person}
+
+            if action == 'pool' and method == 'GET':
+                if self.candidate_pool is None:
+                    raise HttpException(HTTPStatus.NOT_FOUND, 'The server has no candidate pool')
+
+                best_candidates = await self._run_in_executor(self.candidate_pool.best_candidates, session.main_user)
+                return HTTPStatus.OK, {'candidates': [{'first_name': candidate.first_name,
+                                                       'last_name': candidate.last_name,
+                                                       'vk_link': f'https://vk.com/id{candidate.tinder_user_id}',
+                                                       'score': candidate.score}
+                                                      for candidate in reversed(best_candidates)]}
+
+            if action == 'favorite' and method == 'POST':
+                person = self._get_chosen_person(session, body)
+                write_behind.add_to_favorite_list(person)
+                return HTTPStatus.OK, {'favorite': person}
+
+        raise HttpException(HTTPStatus.METHOD_NOT_ALLOWED, f'{method} is not allowed for {path}')
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Serve requests of one connection (HTTP/1.1 with keep-alive)
+        """
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+
+                method, path, version = request_line.decode('latin1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                raw_body = await reader.readexactly(int(headers.get('content-length', 0)))
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                try:
+                    status, answer = await self.dispatch(method, path.split('?')[0], _parse_body(raw_body))
+                except HttpException as e:
+                    status, answer = HTTPStatus(e.status), {'error': str(e)}
+                except VkException as e:
+                    status, answer = HTTPStatus.BAD_GATEWAY, {'error': str(e)}
+                except Exception as e:  # the server keeps serving other requests
+                    status, answer = HTTPStatus.INTERNAL_SERVER_ERROR, {'error': f'{type(e).__name__}: {e}'}
+
+                payload = json.dumps(answer).encode('utf8')
+                writer.write(f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+                             f'Content-Type: application/json; charset=utf-8\r\n'
+                             f'Content-Length: {len(payload)}\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin1')
+                             + payload)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = SERVER_HOST, port: int = SERVER_PORT) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self._handle_connection, host, port)
+
+    def close(self) -> None:
+        for session in self.sessions.values():
+            session.close()
+        self.sessions.clear()
+        self._executor.shutdown(wait=False)
+
+
+async def serve(host: str, port: int, cache: ProfileCache, snapshots: MainUserSnapshots = None) -> None:
+    match_server = MatchServer(cache=cache, seen_filter=SeenUsersFilter.load(), candidate_pool=CandidatePool.load(),
+                               snapshots=snapshots)
+    server = await match_server.start(host, port)
+    print(f'Matches are served on http://{host}:{port}')
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        match_server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Long-running match service')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    args = parser.parse_args()
+
+    create_db()
+
+    vocabulary.open(PATH_TO_PROFILE_CACHE)
+    profile_cache = ProfileCache()
+    main_user_snapshots = MainUserSnapshots()
+    try:
+        asyncio.run(serve(args.host, args.port, profile_cache, main_user_snapshots))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        main_user_snapshots.close()
+        profile_cache.close()
+        vocabulary.close()
+        write_behind.close()
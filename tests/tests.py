@@ -3,8 +3,39 @@ import os
 os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from vk.vk_machinery import VkMachinery
-from tinder_users import TinderUser, MainUser
+from vk.rate_limiter import TokenBucket, set_rate_limit
+from vk.async_vk_machinery import AsyncVkMachinery
+from tinder_users import TinderUser, MainUser, select_top_tinder_users, count_common_sorted, to_sorted_ids
+from scoring import score_candidates
+from database.cache import ProfileCache
+from prefetch import SearchPrefetcher
+from pipeline import closed_profile_filter, dedup_filter, run_in_thread, init_tinder_users
+from seen_filter import SeenUsersFilter
+from database import write_behind as write_behind_module
+from database.db import Database
+from database import session_state as session_state_module
+from database.snapshot import MainUserSnapshots
+from candidate_pool import CandidatePool
+from minhash import MinHasher, LshIndex, get_minhash_features, estimate_similarity
+from benchmarks.mock_vk_server import MockVkApi, MockVkServer
+from metrics import Metrics
+from server import MatchServer
+from main import fetch_next_page
+import batch
+from utils import retry_on_error, RetryException, RetryLimitException, VkException, get_vk_id_from_link
+from utils import HttpException
+from vocabulary import TokenVocabulary
 
+from types import SimpleNamespace
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import asyncio
+import random
+import contextlib
+import tempfile
+import time
 import unittest
 
 vk_client = VkMachinery()
@@ -52,6 +83,671 @@ class TestTinderUser(unittest.TestCase):
         except BaseException:
             self.fail("Create TinderUser() raised anyException unexpectedly!")
 
+    def test_select_top_tinder_users(self):
+        tinder_users = []
+        for score in [3, 1, 7, 5, 2]:
+            tinder_user = TinderUser(vk_client=vk_client)
+            tinder_user.score = score
+            tinder_users.append(tinder_user)
+
+        top_users = select_top_tinder_users(iter(tinder_users), count=3)
+        self.assertEqual([usr.score for usr in top_users], [3, 5, 7])
+
+    def test_user_without_photos_is_not_requested_again(self):
+        tinder_user = TinderUser(vk_client=mock.MagicMock())
+        tinder_user.set_top3_photos([])
+
+        self.assertEqual(tinder_user.get_user_in_dict()['photos'], [])
+        tinder_user.vk_client.get_photos_of_user.assert_not_called()
+
+
+class TestScoring(unittest.TestCase):
+    def test_score_candidates_is_the_same_as_calculate_matching_score(self):
+        main_user = SimpleNamespace(groups=[1, 2, 3, 4], friends=[10, 20, 30],
+                                    music='rocker metal jazzy', books='War and Peace',
+                                    desired_age_from=20, desired_age_to=30)
+
+        candidates = []
+        for groups, friends, age in [([1, 2, 2, 9], [10], 25), ([], [20, 30, 40], 'closed'), ([5], [], 31)]:
+            candidate = TinderUser(vk_client=vk_client)
+            candidate.groups, candidate.friends, candidate.age = groups, friends, age
+            candidate.music, candidate.books = 'metal pop', '"War" and Peace, Idiot'
+            candidates.append(candidate)
+
+        scores = score_candidates(main_user, candidates, assign=False)
+        self.assertEqual(len(set(scores)), len(scores))
+        for candidate, score in zip(candidates, scores):
+            candidate.calculate_matching_score(main_user)
+            self.assertEqual(candidate.score, score)
+
+
+class TestCandidatePool(unittest.TestCase):
+    def test_best_candidates_are_found_by_index(self):
+        main_user = SimpleNamespace(tinder_user_id=1, vk_client=vk_client, groups=[1, 2, 3], friends=[10, 20],
+                                    music='', books='', desired_age_from=20, desired_age_to=30)
+
+        candidates = []
+        for vk_id, groups, friends in [(1, [1, 2, 3], [10]), (2, [1], []), (3, [1, 2], [20]), (4, [7], [70]),
+                                       (5, [2, 3], [10, 20])]:
+            candidate = TinderUser(vk_client=vk_client)
+            candidate._tinder_user_id, candidate.groups, candidate.friends, candidate.age = vk_id, groups, friends, 25
+            candidates.append(candidate)
+
+        candidate_pool = CandidatePool(persist=False)
+        candidate_pool.add_many(candidates)
+        # fresh data of a known candidate replaces the old one in indexes
+        candidates[1].groups = [2, 3]
+        candidate_pool.add_many(candidates[1:2])
+
+        best_candidates = candidate_pool.best_candidates(main_user, count=3, is_excluded=lambda vk_id: vk_id == 3)
+        self.assertEqual([candidate.tinder_user_id for candidate in best_candidates], [2, 5])
+        self.assertEqual(len(candidate_pool), 5)
+
+    def test_candidate_without_friends_keeps_known_friends(self):
+        main_user = SimpleNamespace(tinder_user_id=1, vk_client=vk_client, groups=[], friends=[10, 20],
+                                    music='', books='', desired_age_from=20, desired_age_to=30)
+        candidate_pool = CandidatePool(persist=False)
+        for friends in [[10, 20, 30], []]:  # the second time it is hydrated with common friends only
+            candidate = TinderUser(vk_client=vk_client)
+            candidate._tinder_user_id, candidate.groups, candidate.friends, candidate.age = 2, [5], friends, 25
+            candidate_pool.add_many([candidate])
+
+        self.assertEqual(list(candidate_pool._records[2].friends), [10, 20, 30])
+        self.assertEqual(list(candidate_pool.count_overlaps(main_user)), [2])
+
+    def test_lsh_shortlist_finds_the_same_best_candidates(self):
+        rnd = random.Random(0)
+        main_user = SimpleNamespace(tinder_user_id=0, vk_client=vk_client, groups=rnd.sample(range(10000), 200),
+                                    friends=rnd.sample(range(10 ** 6), 300), music='', books='',
+                                    desired_age_from=20, desired_age_to=30)
+
+        candidates = []
+        for vk_id in range(1, 3001):
+            candidate = TinderUser(vk_client=vk_client)
+            candidate._tinder_user_id, candidate.age = vk_id, 25
+            candidate.groups = rnd.sample(range(10000), 50)
+            candidate.friends = rnd.sample(range(10 ** 6), 5)
+            if vk_id <= 30:  # planted candidates with a large overlap, but a small Jaccard similarity
+                candidate.groups = list(candidate.groups) + rnd.sample(main_user.groups, 10 + vk_id)
+                candidate.friends = rnd.sample(main_user.friends, 5)
+            candidates.append(candidate)
+
+        candidate_pool = CandidatePool(persist=False)
+        candidate_pool.add_many(candidates)
+        exact_candidates = candidate_pool.best_candidates(main_user, count=11)
+
+        candidate_pool.lsh_min_size = 0
+        lsh_candidates = candidate_pool.best_candidates(main_user, count=11)
+
+        self.assertEqual(len(lsh_candidates), 11)
+        self.assertEqual({candidate.tinder_user_id for candidate in lsh_candidates},
+                         {candidate.tinder_user_id for candidate in exact_candidates})
+
+    def test_lsh_hits_are_ranked_without_scan_of_indexes(self):
+        main_user = SimpleNamespace(tinder_user_id=0, vk_client=vk_client, groups=list(range(100)),
+                                    friends=list(range(50)), music='', books='',
+                                    desired_age_from=20, desired_age_to=30)
+
+        candidates = []
+        for vk_id in range(1, 21):
+            candidate = TinderUser(vk_client=vk_client)
+            candidate._tinder_user_id, candidate.age = vk_id, 25
+            # the first candidates are almost the main user, the others have one common group
+            candidate.groups = list(range(vk_id, 100)) if vk_id <= 5 else [0, 1000 + vk_id]
+            candidate.friends = main_user.friends if vk_id <= 5 else []
+            candidates.append(candidate)
+
+        candidate_pool = CandidatePool(persist=False, lsh_min_size=0)
+        candidate_pool.add_many(candidates)
+        with mock.patch.object(candidate_pool, '_get_overlapping_candidates') as get_overlapping_candidates:
+            best_candidates = candidate_pool.best_candidates(main_user, count=3)
+
+        get_overlapping_candidates.assert_not_called()
+        self.assertEqual([candidate.tinder_user_id for candidate in best_candidates], [3, 2, 1])
+
+
+class TestMinHash(unittest.TestCase):
+    def test_similar_sets_have_similar_signatures(self):
+        hasher = MinHasher()
+        features = get_minhash_features(range(100), range(1000, 1100))
+
+        self.assertEqual(hasher.signature(features), hasher.signature(set(features)))
+        self.assertGreater(estimate_similarity(hasher.signature(features),
+                                               hasher.signature(features - set(range(10)))), 0.8)
+        self.assertLess(estimate_similarity(hasher.signature(features),
+                                            hasher.signature(get_minhash_features(range(500, 600), []))), 0.2)
+
+    def test_lsh_index_finds_the_most_similar_keys(self):
+        hasher = MinHasher()
+        lsh_index = LshIndex(permutations=hasher.permutations)
+        for key, groups in [(1, range(100)), (2, range(5, 100)), (3, range(50, 150)), (4, range(1000, 1100)), (5, [])]:
+            lsh_index.add(key, hasher.signature(get_minhash_features(groups, [])))
+
+        query = hasher.signature(get_minhash_features(range(100), []))
+        self.assertEqual(lsh_index.query(query, count=2), [1, 2])
+        self.assertEqual(lsh_index.query(query, count=5, is_excluded=lambda key: key == 1)[0], 2)
+        self.assertNotIn(4, lsh_index.query(query, count=5))
+        self.assertEqual(len(lsh_index), 4, 'Signature of empty set must not be indexed')
+
+
+class TestCandidateRecord(unittest.TestCase):
+    def test_ids_are_sorted_arrays_without_duplicates(self):
+        tinder_user = TinderUser(vk_client=vk_client)
+        tinder_user.friends = [30, 10, 20, 10]
+
+        self.assertEqual(list(tinder_user.friends), [10, 20, 30])
+        self.assertEqual(tinder_user.record.friends.itemsize, 4)
+
+    def test_count_common_sorted(self):
+        self.assertEqual(count_common_sorted(to_sorted_ids([5, 1, 3, 9]), to_sorted_ids([3, 4, 5, 10])), 2)
+        self.assertEqual(count_common_sorted(to_sorted_ids([]), to_sorted_ids([1])), 0)
+
+
+class TestTokenVocabulary(unittest.TestCase):
+    def test_ids_are_stable_across_runs(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'vocabulary.sqlite3')
+
+            vocabulary = TokenVocabulary().open(path)
+            ids = vocabulary.get_ids(['rock', 'jazz', 'rock'])
+            self.assertEqual(len(ids), 2)
+            vocabulary.close()
+
+            vocabulary = TokenVocabulary().open(path)
+            self.assertEqual(vocabulary.get_ids(['jazz', 'rock']), ids)
+            self.assertEqual(len(vocabulary.get_ids(['blues'])), 1)
+            self.assertEqual(len(vocabulary), 3)
+            vocabulary.close()
+
+    def test_vocabularies_sharing_file_give_the_same_ids(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'vocabulary.sqlite3')
+            # like two processes (e.g. batch and server) with one file of profile cache
+            first_vocabulary, second_vocabulary = TokenVocabulary().open(path), TokenVocabulary().open(path)
+
+            rock_id, = first_vocabulary.get_ids(['rock'])
+            jazz_id, = second_vocabulary.get_ids(['jazz'])
+            self.assertNotEqual(rock_id, jazz_id)
+            self.assertEqual(list(second_vocabulary.get_ids(['rock'])), [rock_id])
+            self.assertEqual(list(first_vocabulary.get_ids(['jazz'])), [jazz_id])
+
+            first_vocabulary.close()
+            second_vocabulary.close()
+
+    def test_terms_of_page_are_added_with_one_transaction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            vocabulary = TokenVocabulary().open(os.path.join(directory, 'vocabulary.sqlite3'))
+            statements = []
+            vocabulary._conn.set_trace_callback(statements.append)
+
+            page_vk_client = mock.MagicMock()
+            page_vk_client.get_friends_and_groups_of_users.side_effect = \
+                lambda user_ids: {user_id: {'friends': [], 'groups': []} for user_id in user_ids}
+            data_of_users = [{'id': vk_id, 'first_name': 'Name', 'bdate': '1.1.2000',
+                              'music': f'rock{vk_id} jazz', 'books': f'book{vk_id}'} for vk_id in range(5)]
+
+            with mock.patch('tinder_users.vocabulary', vocabulary):
+                tinder_users = init_tinder_users(page_vk_client, data_of_users)
+
+            self.assertEqual(statements.count('BEGIN IMMEDIATE'), 1)
+            self.assertEqual(len(tinder_users[0].record.music_terms), 2)
+            vocabulary.close()
+
+
+class TestProfileCache(unittest.TestCase):
+    def test_cache_returns_fresh_values_and_counts_hits(self):
+        cache = ProfileCache(':memory:', ttl={'groups': -1})
+        cache.put_many('friends', {1: [2, 3]})
+        cache.put_many('groups', {1: [4]})
+
+        self.assertEqual(cache.get_many('friends', [1, 5]), {1: [2, 3]})
+        self.assertEqual(cache.get_many('groups', [1]), {}, 'Expired value must not be returned')
+        self.assertEqual(cache.stats()['hits']['friends'], 1)
+        self.assertEqual(cache.stats()['misses']['friends'], 1)
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = ProfileCache(':memory:', max_entries=10)
+        cache.put_many('friends', {vk_id: [] for vk_id in range(20)})
+
+        self.assertLessEqual(cache.stats()['size'], 10)
+        self.assertIn(19, cache.get_many('friends', [19]))
+
+    def test_reads_do_not_write_but_keep_entries_recently_used(self):
+        cache = ProfileCache(':memory:', max_entries=10)
+        cache.put_many('friends', {vk_id: [] for vk_id in range(10)})
+        statements = []
+        cache._conn.set_trace_callback(statements.append)
+
+        time.sleep(0.01)
+        self.assertIn(0, cache.get_many('friends', [0]))
+        self.assertFalse([statement for statement in statements if not statement.startswith('SELECT')])
+
+        cache.put_many('friends', {vk_id: [] for vk_id in range(10, 15)})
+        self.assertIn(0, cache.get_many('friends', [0]), 'Entry which was read must not be evicted')
+        self.assertNotIn(1, cache.get_many('friends', [1]))
+
+    def test_failed_calls_are_not_cached(self):
+        cache = ProfileCache(':memory:')
+        cached_vk_client = VkMachinery(cache=cache)
+
+        def execute_batched(calls):
+            # user 2 is private, VK gives false for its calls
+            return [None if 2 in params.values() else
+                    {'items': [{'likes': {'count': 1}, 'sizes': [{}]}]} if method == 'photos.get' else
+                    {'groups': {'items': [7]}} if method == 'users.getSubscriptions' else {'items': [8]}
+                    for method, params in calls]
+
+        with mock.patch.object(cached_vk_client, 'execute_batched', side_effect=execute_batched):
+            friends_and_groups = cached_vk_client.get_friends_and_groups_of_users([1, 2], mutual_friends=False)
+            photos = cached_vk_client.get_photos_of_users([1, 2])
+
+        self.assertEqual(friends_and_groups[2], {'friends': [], 'groups': []})
+        self.assertEqual(photos[2], [])
+        for field in ['friends', 'groups', 'photos']:
+            self.assertEqual(list(cache.get_many(field, [1, 2])), [1])
+
+
+class TestSearchPrefetcher(unittest.TestCase):
+    @staticmethod
+    def fetch_page(config):
+        config['offset_for_search'] += config['count_for_search']
+        return [config['offset_for_search']]
+
+    def test_pages_follow_config_and_are_discarded_on_change(self):
+        prefetcher = SearchPrefetcher(self.fetch_page, pages=2)
+        config = dict(main_user_config, count_for_search=15, offset_for_search=30)
+
+        prefetcher.start(config)
+        config_of_page, users = prefetcher.take(config)
+        self.assertEqual(users, [45])
+        self.assertEqual(config['offset_for_search'], 30, 'Config of caller must not be changed')
+
+        self.assertEqual(prefetcher.take(config_of_page)[1], [60])
+
+        prefetcher.start(config)
+        self.assertIsNone(prefetcher.take(dict(config, desired_age_to=40)))
+        prefetcher.close()
+
+    def test_every_page_is_fetched_once(self):
+        fetched_offsets = []
+
+        def fetch_page(config):
+            fetched_offsets.append(config['offset_for_search'])
+            return self.fetch_page(config)
+
+        prefetcher = SearchPrefetcher(fetch_page, pages=2)
+        config = dict(main_user_config, count_for_search=15, offset_for_search=0)
+        for _ in range(4):
+            prefetcher.start(config)
+            config, users = prefetcher.take(config)
+            self.assertEqual(users, [config['offset_for_search']])
+
+        prefetcher.close()
+        fetched_offsets = list(fetched_offsets)
+        # the pages ahead can still be fetched, but no page is fetched twice
+        self.assertEqual(fetched_offsets[:4], [0, 15, 30, 45])
+        self.assertEqual(len(fetched_offsets), len(set(fetched_offsets)))
+        self.assertLessEqual(len(fetched_offsets), 6)
+
+
+class TestPipeline(unittest.TestCase):
+    def test_filters_drop_closed_duplicated_and_excluded_users(self):
+        searched_users = [{'id': 1, 'is_closed': False}, {'id': 2, 'is_closed': True},
+                          {'id': 1, 'is_closed': False}, {'id': 3, 'is_closed': False}]
+
+        stage = dedup_filter(closed_profile_filter(searched_users), is_excluded=lambda user_id: user_id == 3)
+        self.assertEqual([user['id'] for user in run_in_thread(stage, queue_size=1)], [1])
+
+    def test_errors_of_stage_are_raised_in_consumer(self):
+        def broken_stage():
+            yield 1
+            raise VkException('broken')
+
+        with self.assertRaises(VkException):
+            list(run_in_thread(broken_stage()))
+
+    def test_sharded_search_pages_every_age_and_drops_duplicates(self):
+        def send_request(method, params_of_query):
+            # 1500 users of every age (VK gives at most 1000 of them), ids of neighbouring ages overlap
+            first_id = params_of_query['age_from'] * 500 + params_of_query['offset']
+            count = min(params_of_query['count'], 1500 - params_of_query['offset'])
+            return {'response': {'items': [{'id': user_id} for user_id in range(first_id, first_id + count)]}}
+
+        vk_client = VkMachinery()
+        vk_client.send_request = send_request
+        config = {'sex': 1, 'city': 1, 'desired_age_from': 25, 'desired_age_to': 27}
+
+        found_users = vk_client.users_search_sharded(config, page_size=500)
+        self.assertEqual(sorted(user['id'] for user in found_users), list(range(12500, 14500)))
+
+    def test_async_hydration_gives_the_same_page(self):
+        set_rate_limit('mock', rate=1000, capacity=10)
+        main_user = SimpleNamespace(tinder_user_id=1, groups=[], friends=[], music='', books='',
+                                    desired_age_from=20, desired_age_to=30)
+        with MockVkServer(MockVkApi(count_of_users=60)) as server, \
+                VkMachinery(api_url=server.api_url) as mock_vk_client:
+            mock_vk_client.initialize_vk_api(access_token='mock')
+            async_vk_client = AsyncVkMachinery(vk_client=mock_vk_client)
+
+            pages = []
+            for client_of_hydration in [None, async_vk_client]:
+                candidate_pool = CandidatePool(persist=False)
+                config = dict(main_user_config, count_for_search=20, desired_age_from=20, desired_age_to=30)
+                tinder_users = fetch_next_page(mock_vk_client, main_user, config, async_vk_client=client_of_hydration,
+                                               verbose=False, candidate_pool=candidate_pool)
+                pages.append(sorted((tinder_user.tinder_user_id, tinder_user.score) for tinder_user in tinder_users))
+                self.assertEqual(len(candidate_pool), len(tinder_users))
+            async_vk_client.close()
+
+        self.assertTrue(pages[0])
+        self.assertEqual(pages[0], pages[1])
+
+
+class TestSeenUsersFilter(unittest.TestCase):
+    def test_set_and_bloom_filter_find_added_ids(self):
+        for bloom_threshold in [10, 0]:
+            seen_filter = SeenUsersFilter([1, 2, 3], bloom_threshold=bloom_threshold)
+            seen_filter.add(get_vk_id_from_link('https://vk.com/id42'))
+
+            self.assertTrue(all(vk_id in seen_filter for vk_id in [1, 2, 3, 42]))
+            self.assertNotIn(7, seen_filter)
+
+
+class TestDatabase(unittest.TestCase):
+    def test_callers_wait_for_free_connection(self):
+        class FakePool:
+            # like ThreadedConnectionPool it fails instead of waiting when all connections are taken
+            taken = 0
+
+            def getconn(self):
+                if self.taken == 1:
+                    raise RuntimeError('connection pool exhausted')
+                self.taken += 1
+                return mock.MagicMock(closed=0)
+
+            def putconn(self, conn, close=False):
+                self.taken -= 1
+
+        database = Database(minconn=1, maxconn=1)
+        database._pool = FakePool()
+
+        def query(_):
+            with database.cursor():
+                time.sleep(0.01)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(query, range(8)))
+
+
+class TestWriteBehindWriter(unittest.TestCase):
+    def test_writes_are_flushed_in_bulk_and_in_order(self):
+        calls = []
+        with mock.patch.multiple(write_behind_module, transaction=contextlib.nullcontext,
+                                 insert_result_to_db=lambda persons: calls.append(('result', len(persons))),
+                                 add_many_to_black_list=lambda persons: calls.append(('black', len(persons))),
+                                 add_many_to_favorite_list=lambda persons: calls.append(('favorite', len(persons)))
+                                 or len(persons)):
+            writer = write_behind_module.WriteBehindWriter(flush_interval=60, max_buffered=100)
+            writer.add_to_favorite_list({'vk_link': 'https://vk.com/id1'})
+            for vk_id in range(3):
+                writer.add_results([{'vk_link': f'https://vk.com/id{vk_id}'}])
+            writer.add_to_black_list({'vk_link': 'https://vk.com/id5'})
+            self.assertEqual(calls, [], 'Writes must wait in the buffer')
+
+            writer.close()
+            self.assertEqual(calls, [('result', 3), ('black', 1), ('favorite', 1)])
+
+    def test_failed_flush_keeps_buffer(self):
+        with mock.patch.object(write_behind_module, 'transaction', side_effect=ConnectionError):
+            writer = write_behind_module.WriteBehindWriter(flush_interval=60)
+            writer.add_results([{'vk_link': 'https://vk.com/id1'}])
+            with self.assertRaises(ConnectionError):
+                writer.close()
+
+        self.assertEqual(writer._count_buffered(), 1)
+        writer._results.clear()  # the writer is flushed at exit too
+
+    def test_broken_person_is_dropped_after_repeated_failures(self):
+        written_links = []
+
+        def insert_result_to_db(persons):
+            if any(person['vk_link'] == 'broken' for person in persons):
+                raise ValueError('value too long')
+            written_links.extend(person['vk_link'] for person in persons)
+
+        with mock.patch.multiple(write_behind_module, transaction=contextlib.nullcontext,
+                                 insert_result_to_db=insert_result_to_db, add_many_to_black_list=lambda persons: None,
+                                 add_many_to_favorite_list=lambda persons: len(persons)):
+            writer = write_behind_module.WriteBehindWriter(flush_interval=60, max_failed_flushes=2, buffer_limit=3)
+            with self.assertLogs(write_behind_module.logger, 'ERROR'):
+                writer.add_results([{'vk_link': link} for link in ['dropped', 'first', 'broken', 'second']])
+            self.assertEqual(writer._count_buffered(), 3, 'The oldest person must be dropped from the full buffer')
+
+            for _ in range(2):
+                with self.assertRaises(ValueError):
+                    writer.flush()
+            with self.assertLogs(write_behind_module.logger, 'ERROR'):
+                writer.close()
+
+        self.assertEqual(written_links, ['first', 'second'])
+        self.assertEqual(writer._count_buffered(), 0)
+
+
+class TestSessionState(unittest.TestCase):
+    def test_state_is_loaded_once_and_saved_by_checkpoints(self):
+        saved_rows = []
+        with mock.patch.multiple(session_state_module, load_last_run_state=lambda vk_id: (20, 30, 45),
+                                 save_last_run_state=lambda *row: saved_rows.append(row)):
+            session_state = session_state_module.SessionState.load(1, checkpoint_interval=60)
+            self.assertEqual((session_state.desired_age_from, session_state.current_offset), (20, 45))
+
+            for offset in [60, 75, 90]:
+                session_state.update(current_offset=offset)
+            self.assertEqual(saved_rows, [], 'Changes must wait for checkpoint')
+
+            session_state.close()
+            session_state.close()
+            self.assertEqual(saved_rows, [(1, 20, 30, 90)])
+
+            session_state.checkpoint_interval = 0
+            session_state.update(desired_age_to=35)
+            self.assertEqual(saved_rows[-1], (1, 20, 35, 90))
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_token_bucket_spreads_requests(self):
+        bucket = TokenBucket(rate=50, capacity=1)
+        started_at = time.monotonic()
+        for _ in range(11):
+            bucket.acquire()
+
+        self.assertGreaterEqual(time.monotonic() - started_at, 0.18)
+
+    def test_retry_raises_when_attempts_are_exhausted(self):
+        @retry_on_error(2, base_delay=0.001)
+        def always_fails():
+            raise RetryException
+
+        with self.assertRaises(RetryLimitException):
+            always_fails()
+
+
+class TestMockVkServer(unittest.TestCase):
+    def test_client_works_with_mock_server(self):
+        set_rate_limit('mock', rate=1000, capacity=10)
+        with MockVkServer(MockVkApi(count_of_users=20, closed_rate=0)) as server, \
+                VkMachinery(api_url=server.api_url) as mock_vk_client:
+            mock_vk_client.initialize_vk_api(access_token='mock')
+
+            searched_users = mock_vk_client.users_search(dict(main_user_config, count_for_search=5), verbose=False)
+            self.assertEqual(len(searched_users), 5)
+
+            user_ids = [searched_user['id'] for searched_user in searched_users]
+            friends_and_groups = mock_vk_client.get_friends_and_groups_of_users(user_ids, mutual_friends=False)
+            self.assertEqual(set(friends_and_groups), set(user_ids))
+            self.assertTrue(all(data['friends'] and data['groups'] for data in friends_and_groups.values()))
+
+            # common friends with the main user are the part of full lists which is counted by scoring
+            friends_of_main_user = set(mock_vk_client.get_friend_list(1))
+            common_friends = mock_vk_client.get_friends_and_groups_of_users(user_ids, mutual_friends=True)
+            for user_id in user_ids:
+                self.assertEqual(set(common_friends[user_id]['common_friends']),
+                                 friends_of_main_user.intersection(friends_and_groups[user_id]['friends']))
+
+            self.assertEqual(server.api.stats()['calls']['friends.getMutual'], 1)
+
+            # common friends are valid only for this main user, so they are not in the record of candidate
+            candidate = TinderUser(vk_client=mock_vk_client,
+                                   init_obj=dict(searched_users[0], **common_friends[user_ids[0]]))
+            self.assertEqual(list(candidate.record.friends), [])
+            self.assertEqual(list(candidate.get_friends_for_matching()),
+                             sorted(common_friends[user_ids[0]]['common_friends']))
+
+
+class TestBatch(unittest.TestCase):
+    def test_broken_account_does_not_stop_others(self):
+        for access_token in ['first', 'second']:
+            set_rate_limit(access_token, rate=1000, capacity=10)
+        list_of_settings = [{'access_token': 'first'}, {'access_token': 'invalid'}, {'access_token': 'second'}]
+
+        with mock.patch.multiple(session_state_module, load_last_run_state=lambda vk_id: (20, 30, 0),
+                                 save_last_run_state=lambda *row: None), \
+                mock.patch('database.db.get_seen_vk_ids', return_value=[]), \
+                mock.patch('main.write_behind'), \
+                MockVkServer(MockVkApi(count_of_users=60, invalid_tokens=['invalid'])) as server, \
+                mock.patch.object(batch, 'VkMachinery', partial(VkMachinery, api_url=server.api_url)):
+            results = {result['index']: result for result in batch.run_batch(list_of_settings, pages=2, workers=1)}
+
+        self.assertEqual(sorted(results), [0, 1, 2])
+        self.assertIn('error', results[1])
+        # both accounts belong to the same mock user, so they get the same matches: users matched
+        # for one main user are not hidden from the other
+        self.assertTrue(results[0]['matches'])
+        self.assertEqual(results[0]['matches'], results[2]['matches'])
+
+
+class TestMainUserSnapshots(unittest.TestCase):
+    def test_warm_start_needs_no_requests(self):
+        set_rate_limit('mock', rate=1000, capacity=10)
+        snapshots = MainUserSnapshots(':memory:')
+        with mock.patch.object(session_state_module, 'load_last_run_state', lambda vk_id: (20, 30, 0)), \
+                MockVkServer(MockVkApi(count_of_users=20)) as server, \
+                VkMachinery(api_url=server.api_url, metrics=Metrics()) as mock_vk_client:
+            mock_vk_client.initialize_vk_api(access_token='mock')
+
+            cold_main_user = MainUser(vk_client=mock_vk_client, interactive=False, snapshots=snapshots)
+            count_of_requests = mock_vk_client.metrics.snapshot()['vk']['users.get']['count']
+
+            warm_main_user = MainUser(vk_client=mock_vk_client, interactive=False, snapshots=snapshots)
+            self.assertEqual(mock_vk_client.metrics.snapshot()['vk']['users.get']['count'], count_of_requests)
+            self.assertEqual(warm_main_user.tinder_user_id, cold_main_user.tinder_user_id)
+            self.assertEqual(list(warm_main_user.friends), list(cold_main_user.friends))
+
+            # the snapshot is refreshed in background
+            warm_main_user.refresh_thread.join()
+            self.assertEqual(mock_vk_client.metrics.snapshot()['vk']['users.get']['count'], count_of_requests + 1)
+
+        self.assertIsNone(snapshots.get('unknown token'))
+
+    def test_refresh_swaps_whole_profile(self):
+        set_rate_limit('mock', rate=1000, capacity=10)
+        snapshots = MainUserSnapshots(':memory:')
+        with mock.patch.object(session_state_module, 'load_last_run_state', lambda vk_id: (20, 30, 0)), \
+                MockVkServer(MockVkApi(count_of_users=20)) as server, \
+                VkMachinery(api_url=server.api_url) as mock_vk_client:
+            mock_vk_client.initialize_vk_api(access_token='mock')
+            MainUser(vk_client=mock_vk_client, interactive=False, snapshots=snapshots)
+            main_user = MainUser(vk_client=mock_vk_client, interactive=False, snapshots=snapshots)
+            main_user.refresh_thread.join()
+            record, feature_profile = main_user.record, main_user.feature_profile
+
+            with mock.patch.object(mock_vk_client, 'get_group_list', side_effect=ConnectionError), \
+                    self.assertLogs('tinder_users', 'WARNING'):
+                main_user._refresh_profile()
+            self.assertIs(main_user.record, record, 'Failed refresh must keep the profile')
+            self.assertIs(main_user.feature_profile, feature_profile)
+
+            main_user._refresh_profile()
+            self.assertIsNot(main_user.record, record)
+            self.assertEqual(list(main_user.friends), list(record.friends))
+            self.assertEqual(main_user.feature_profile, feature_profile)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_calls_are_counted_with_latency_and_errors(self):
+        metrics = Metrics()
+
+        @metrics.timed('sql')
+        def broken_query():
+            raise ValueError
+
+        for seconds in [0.001, 0.002, 0.3]:
+            metrics.observe('vk', 'users.get', seconds, payload_bytes=100)
+        metrics.observe('vk', 'users.get', 0.01, error_code=6, retry=True)
+        with self.assertRaises(ValueError):
+            broken_query()
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['vk']['users.get']['count'], 4)
+        self.assertEqual(snapshot['vk']['users.get']['payload_bytes'], 300)
+        self.assertEqual(snapshot['vk']['users.get']['retries'], 1)
+        self.assertEqual(snapshot['vk']['users.get']['errors'], {'6': 1})
+        self.assertLessEqual(snapshot['vk']['users.get']['p50'], 0.005)
+        self.assertEqual(snapshot['sql']['broken_query']['errors'], {'ValueError': 1})
+
+        self.assertIn('tinder_call_seconds_count{kind="vk",name="users.get"} 4', metrics.to_prometheus())
+
+
+class TestMatchServer(unittest.TestCase):
+    def test_unknown_sessions_and_paths_are_not_found(self):
+        match_server = MatchServer(prefetch_pages=0, workers=1)
+
+        status, answer = asyncio.run(match_server.dispatch('GET', '/stats', {}))
+        self.assertEqual((status, answer['sessions']), (200, 0))
+
+        for path in ['/sessions/42/matches', '/unknown']:
+            with self.assertRaises(HttpException) as error:
+                asyncio.run(match_server.dispatch('GET', path, {}))
+            self.assertEqual(error.exception.status, 404)
+
+        match_server.close()
+
+    def test_session_serves_matches_blacklist_and_favorite(self):
+        set_rate_limit('mock', rate=1000, capacity=10)
+        with mock.patch.multiple(session_state_module, load_last_run_state=lambda vk_id: (20, 30, 0),
+                                 save_last_run_state=lambda *row: None), \
+                mock.patch('main.write_behind'), mock.patch('server.write_behind') as server_write_behind, \
+                MockVkServer(MockVkApi(count_of_users=60)) as server:
+            match_server = MatchServer(prefetch_pages=1, workers=2, api_url=server.api_url)
+
+            async def serve():
+                status, session = await match_server.dispatch('POST', '/sessions', {'access_token': 'mock'})
+                self.assertEqual(status, 201)
+                path = f'/sessions/{session["vk_id"]}'
+
+                status, answer = await match_server.dispatch('GET', f'{path}/matches', {})
+                self.assertEqual(status, 200)
+                self.assertTrue(answer['matches'])
+
+                _, blacklisted = await match_server.dispatch('POST', f'{path}/blacklist', {'index': 0})
+                _, favorite = await match_server.dispatch('POST', f'{path}/favorite', {'index': 1})
+                server_write_behind.add_to_black_list.assert_called_once_with(blacklisted['blacklisted'])
+                server_write_behind.add_to_favorite_list.assert_called_once_with(favorite['favorite'])
+
+                # users shown to the main user are hidden only in its session
+                blacklisted_id = get_vk_id_from_link(blacklisted['blacklisted']['vk_link'])
+                self.assertIn(blacklisted_id, match_server.sessions[session['vk_id']].seen_filter)
+                self.assertNotIn(blacklisted_id, match_server.seen_filter)
+
+                self.assertEqual(await match_server.dispatch('DELETE', path, {}), (200, {}))
+                with self.assertRaises(HttpException):
+                    await match_server.dispatch('GET', f'{path}/matches', {})
+
+            try:
+                asyncio.run(serve())
+            finally:
+                match_server.close()
+
 
 if __name__ == '__main__':
     unittest.main()
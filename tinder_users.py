@@ -1,22 +1,144 @@
 from config.config_app import POINT_OF_AGE, POINT_OF_MUSIC, POINT_OF_BOOKS, \
     POINT_OF_FRIEND_UNIT, POINT_OF_GROUP_UNIT, DEBUG
-from config.config_app import SERVICE_TOKEN, PATH_TO_DATA_FOR_TEST
-from database import db
+from config.config_app import SERVICE_TOKEN, PATH_TO_DATA_FOR_TEST, COUNT_OF_TOP_MATCHES
+from database.session_state import SessionState
+from database.snapshot import MainUserSnapshots
+from vocabulary import vocabulary
 
-from typing import Dict, List
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Sequence, Set, Union
+from array import array
 
 import datetime
+import heapq
+import logging
+import threading
 
+logger = logging.getLogger(__name__)
 
-class TinderUser:
+
+def tokenize_music(music: str) -> Set[str]:
     """
-    Common user class in the application
+    Split string with music of user into terms for matching (endings of words are dropped)
     """
 
-    def __init__(self, vk_client, init_obj: Dict = None, service_token: str = SERVICE_TOKEN):
-        self.vk_client = vk_client
-        self.service_token = service_token
-        self._tinder_user_id = None
+    return {word[:-2] for word in set(music.split())}
+
+
+def tokenize_books(books: str) -> Set[str]:
+    """
+    Split string with books of user into terms for matching
+    """
+
+    return set(books.replace(',', '').replace('\"', '').strip().split())
+
+
+def add_terms_to_vocabulary(music: Iterable[str], books: Iterable[str]) -> None:
+    """
+    Add terms of music and books of many users to the vocabulary with one transaction,
+    so records of these users are created without writes to the vocabulary
+
+    :param music: music of users
+    :param books: books of users
+    """
+
+    terms = set()
+    for music_of_user in music:
+        terms.update(tokenize_music(music_of_user))
+    for books_of_user in books:
+        terms.update(tokenize_books(books_of_user))
+
+    vocabulary.add_many(terms)
+
+
+class FeatureProfile(NamedTuple):
+    """
+    Immutable features of the user for whom we calculate the similarity. It is built once and reused by all scoring
+    """
+
+    groups: FrozenSet[int]
+    friends: FrozenSet[int]
+    music_terms: FrozenSet[int]  # ids of terms in the vocabulary
+    book_terms: FrozenSet[int]
+    desired_age_from: int
+    desired_age_to: int
+
+    @classmethod
+    def from_user(cls, user) -> 'FeatureProfile':
+        """
+        Build profile of user. User must have desired_age_from and desired_age_to
+        """
+
+        return cls(groups=frozenset(user.groups),
+                   friends=frozenset(user.friends),
+                   music_terms=frozenset(vocabulary.get_ids(tokenize_music(user.music))),
+                   book_terms=frozenset(vocabulary.get_ids(tokenize_books(user.books))),
+                   desired_age_from=int(user.desired_age_from),
+                   desired_age_to=int(user.desired_age_to))
+
+
+def get_feature_profile(user) -> FeatureProfile:
+    """
+    Return precompiled profile of user (see MainUser.feature_profile) or build a new one
+    """
+
+    if isinstance(user, MainUser):
+        return user.feature_profile
+
+    return FeatureProfile.from_user(user)
+
+
+def to_sorted_ids(ids: Iterable[int]) -> array:
+    """
+    Pack ids into sorted array of 32-bit ints without duplicates
+    """
+
+    return array('i', sorted(set(ids)))
+
+
+def count_common_sorted(first_ids: Sequence[int], second_ids: Sequence[int]) -> int:
+    """
+    Count common ids of two sorted sequences without duplicates by merging them
+    """
+
+    count = ind_first = ind_second = 0
+    len_first, len_second = len(first_ids), len(second_ids)
+
+    while ind_first < len_first and ind_second < len_second:
+        first, second = first_ids[ind_first], second_ids[ind_second]
+        if first == second:
+            count += 1
+            ind_first += 1
+            ind_second += 1
+        elif first < second:
+            ind_first += 1
+        else:
+            ind_second += 1
+
+    return count
+
+
+def _count_common_ids(sorted_ids: array, other_ids: Union[FrozenSet[int], array]) -> int:
+    if isinstance(other_ids, array):
+        return count_common_sorted(sorted_ids, other_ids)
+
+    return len(other_ids.intersection(sorted_ids))
+
+
+class CandidateRecord:
+    """
+    Compact storage of data of Tinder User.
+
+    Ids of friends and groups are kept in sorted arrays of 32-bit ints (4 bytes per id instead of
+    about 36 bytes in a list of ints). Music and books are tokenized once, their terms are kept
+    as sorted arrays of ids of the global vocabulary (see vocabulary.TokenVocabulary). Movies are not matched,
+    they are kept as text
+    """
+
+    __slots__ = ('vk_id', 'first_name', 'last_name', 'sex', 'age', 'country', 'city',
+                 'movies', '_music', '_books', 'music_terms', 'book_terms', '_friends', '_groups')
+
+    def __init__(self):
+        self.vk_id = None
 
         self.first_name = None
         self.last_name = None
@@ -26,19 +148,105 @@ class TinderUser:
         self.country = None
         self.city = None
 
-        self.groups = []
-        self.friends = []
-        self.top3_photos = []
+        self.friends = ()
+        self.groups = ()
 
         self.movies = ''
         self.music = ''
         self.books = ''
 
+    @property
+    def friends(self) -> array:
+        return self._friends
+
+    @friends.setter
+    def friends(self, ids: Iterable[int]) -> None:
+        self._friends = to_sorted_ids(ids)
+
+    @property
+    def groups(self) -> array:
+        return self._groups
+
+    @groups.setter
+    def groups(self, ids: Iterable[int]) -> None:
+        self._groups = to_sorted_ids(ids)
+
+    @property
+    def music(self) -> str:
+        return self._music
+
+    @music.setter
+    def music(self, music: str) -> None:
+        self._music = music
+        self.music_terms = vocabulary.get_ids(tokenize_music(music))
+
+    @property
+    def books(self) -> str:
+        return self._books
+
+    @books.setter
+    def books(self, books: str) -> None:
+        self._books = books
+        self.book_terms = vocabulary.get_ids(tokenize_books(books))
+
+
+class _RecordField:
+    """
+    Attribute of TinderUser which is stored in its CandidateRecord
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        return getattr(instance._record, self.field)
+
+    def __set__(self, instance, value) -> None:
+        setattr(instance._record, self.field, value)
+
+
+class TinderUser:
+    """
+    Common user class in the application. It is a thin view over CandidateRecord
+    """
+
+    __slots__ = ('vk_client', 'service_token', '_record', 'top3_photos', 'score', 'common_friends')
+
+    _tinder_user_id = _RecordField('vk_id')
+    first_name = _RecordField('first_name')
+    last_name = _RecordField('last_name')
+    sex = _RecordField('sex')
+    age = _RecordField('age')
+    country = _RecordField('country')
+    city = _RecordField('city')
+    groups = _RecordField('groups')
+    friends = _RecordField('friends')
+    movies = _RecordField('movies')
+    music = _RecordField('music')
+    books = _RecordField('books')
+
+    def __init__(self, vk_client, init_obj: Dict = None, service_token: str = SERVICE_TOKEN,
+                 record: CandidateRecord = None):
+        self.vk_client = vk_client
+        self.service_token = service_token
+        self._record = record if record is not None else CandidateRecord()
+
+        # None until photos are fetched, a user without photos has an empty list
+        self.top3_photos = None
         self.score = 0
+        # friends in common with the main user who found this user (see VkMachinery.get_friends_and_groups_of_users)
+        self.common_friends = None
 
         if init_obj is not None:
             self.init_tinder_user_from_obj(init_obj)
 
+    @property
+    def record(self) -> CandidateRecord:
+        return self._record
+
     def init_tinder_user_from_obj(self, obj: Dict) -> None:
         """
         initialize instance of Tinder User from received data of type of dict
@@ -57,8 +265,11 @@ class TinderUser:
         self.books = obj.get('books', 'closed')
         self.music = obj.get('music', 'closed')
 
-        self.friends = self.get_friend_list()
-        self.groups = self.get_group_list()
+        # friends and groups can be already fetched in batch (see VkMachinery.get_friends_and_groups_of_users)
+        self.friends = obj['friends'] if 'friends' in obj else self.get_friend_list()
+        self.groups = obj['groups'] if 'groups' in obj else self.get_group_list()
+        if obj.get('common_friends') is not None:
+            self.common_friends = to_sorted_ids(obj['common_friends'])
 
         try:
             # if user have full birth date (like '17.12.1977') we attempt their data
@@ -67,16 +278,22 @@ class TinderUser:
         except (KeyError, ValueError):
             self.age = 'closed'
 
+    @property
+    def tinder_user_id(self):
+        """
+        id of Tinder User from the VK site
+        """
+
+        return self._tinder_user_id
+
     def get_friend_list(self):
         """
-        Send request to VK API to get groups and return result
+        Send request to VK API to get friends and return result
 
         :return: response from VK API
         """
 
-        params = {'user_id': self._tinder_user_id}
-        return self.vk_client.send_request(method='friends.get',
-                                           params_of_query=params)['response']['items']
+        return self.vk_client.get_friend_list(self._tinder_user_id)
 
     def get_group_list(self):
         """
@@ -85,9 +302,7 @@ class TinderUser:
         :return: response from VK API
         """
 
-        params = {'user_id': self._tinder_user_id}
-        return self.vk_client.send_request(method='users.getSubscriptions',
-                                           params_of_query=params)['response']['groups']['items']
+        return self.vk_client.get_group_list(self._tinder_user_id)
 
     def calculate_matching_score(self, target_user) -> None:
         """
@@ -96,57 +311,62 @@ class TinderUser:
         :param target_user: User for who calculate the similarity
         """
 
-        groups_score = self._get_points_of_groups(target_user.groups)
-        friends_score = self._get_points_of_friends(target_user.friends)
-        books_score = self._get_points_of_books(target_user.books)
-        music_score = self._get_points_of_music(target_user.music)
-        age_score = self._get_points_of_age(target_user.desired_age_from, target_user.desired_age_to)
+        profile = get_feature_profile(target_user)
+
+        groups_score = self._get_points_of_groups(profile.groups)
+        friends_score = self._get_points_of_friends(profile.friends)
+        books_score = self._get_points_of_books(profile.book_terms)
+        music_score = self._get_points_of_music(profile.music_terms)
+        age_score = self._get_points_of_age(profile.desired_age_from, profile.desired_age_to)
 
         self.score = groups_score + friends_score + books_score + music_score + age_score
 
-    def _get_points_of_groups(self, other_group_list: List) -> float:
+    def get_friends_for_matching(self) -> array:
+        """
+        Common friends with the main user when only they are known, otherwise all friends
+        """
+
+        return self.friends if self.common_friends is None else self.common_friends
+
+    def _get_points_of_groups(self, other_groups: Union[FrozenSet[int], array]) -> float:
         """
         Calculate similarity by common groups
 
-        :param other_group_list: List of group of another user
+        :param other_groups: Set (or sorted array) of groups of another user
         :return: score of similarity
         """
 
-        return POINT_OF_GROUP_UNIT * len((set(self.groups).intersection(set(other_group_list))))
+        return POINT_OF_GROUP_UNIT * _count_common_ids(self.groups, other_groups)
 
-    def _get_points_of_friends(self, other_friend_list: List) -> float:
+    def _get_points_of_friends(self, other_friends: Union[FrozenSet[int], array]) -> float:
         """
         Calculate similarity by common friends
 
-        :param other_friend_list: List of friends of another user
+        :param other_friends: Set (or sorted array) of friends of another user
         :return: score of similarity
         """
 
-        return POINT_OF_FRIEND_UNIT * len((set(self.friends).intersection(set(other_friend_list))))
+        return POINT_OF_FRIEND_UNIT * _count_common_ids(self.get_friends_for_matching(), other_friends)
 
-    def _get_points_of_music(self, other_music: str) -> float:
+    def _get_points_of_music(self, other_music_terms: FrozenSet[int]) -> float:
         """
         Calculate similarity by common music
 
-        :param other_music: String with music of another user
+        :param other_music_terms: Set of ids of music terms of another user (see FeatureProfile)
         :return: score of similarity
         """
-        other_music = {word[:-2] for word in set(other_music.split())}
-        other_music2 = {word[:-2] for word in set(self.music.split())}
-        return POINT_OF_MUSIC * len(other_music.intersection(other_music2))
 
-    def _get_points_of_books(self, other_books: str) -> float:
+        return POINT_OF_MUSIC * len(other_music_terms.intersection(self._record.music_terms))
+
+    def _get_points_of_books(self, other_book_terms: FrozenSet[int]) -> float:
         """
         Calculate similarity by common books
 
-        :param other_books: String with books of another user
+        :param other_book_terms: Set of ids of book terms of another user (see FeatureProfile)
         :return: score of similarity
         """
 
-        other_books = set(other_books.replace(',', '').replace('\"', '').strip().split())
-
-        other_books2 = set(self.books.replace(',', '').replace('\"', '').strip().split())
-        return POINT_OF_BOOKS * len(other_books.intersection(other_books2))
+        return POINT_OF_BOOKS * len(other_book_terms.intersection(self._record.book_terms))
 
     def _get_points_of_age(self, age_from: int, age_to: int) -> float:
         """
@@ -171,14 +391,20 @@ class TinderUser:
         Get photos of particular user by id with VK API and put they in field of instance
         """
 
-        params = {'owner_id': self._tinder_user_id, 'album_id': 'profile', 'extended': 1}
+        self.set_top3_photos(self.vk_client.get_photos_of_user(self._tinder_user_id))
 
-        photos = self.vk_client.send_request(method='photos.get', params_of_query=params)['response']['items']
-        photos.sort(key=lambda photo: int(photo['likes']['count']))
+    def set_top3_photos(self, photos: List[Dict]) -> None:
+        """
+        Put 3 most liked photos in field of instance
+
+        :param photos: List of photos from VK API method photos.get (with extended=1)
+        """
+
+        # partial selection instead of sorting of all photos, the most liked photo is the last one
+        top3_photos = heapq.nlargest(3, photos, key=lambda photo: int(photo['likes']['count']))
 
         size = 0
-        for ph in photos[-3:]:
-            self.top3_photos.append(ph['sizes'][size]['url'])
+        self.top3_photos = [ph['sizes'][size]['url'] for ph in reversed(top3_photos)]
 
     def get_user_in_dict(self) -> Dict[str, str]:
         """
@@ -187,7 +413,8 @@ class TinderUser:
         :return: Dict with configuration of instance
         """
 
-        self._get_photos_of_user()
+        if self.top3_photos is None:  # photos can be already fetched (see set_top3_photos)
+            self._get_photos_of_user()
 
         return {
             'first_name': self.first_name,
@@ -200,20 +427,50 @@ class TinderUser:
         return f'Tinder User: name: {self.first_name}, uid: {self._tinder_user_id}'
 
 
+def select_top_tinder_users(tinder_users: Iterable[TinderUser],
+                            count: int = COUNT_OF_TOP_MATCHES) -> List[TinderUser]:
+    """
+    Select Tinder Users with the highest score. Users are consumed one by one and only "count" of them
+    are kept in a heap, so the whole list is never sorted
+
+    :param tinder_users: Iterable of Tinder Users with calculated score
+    :param count: how many users to select
+    :return: List of selected users sorted by score, the best user is the last one
+    """
+
+    return list(reversed(heapq.nlargest(count, tinder_users, key=lambda usr: usr.score)))
+
+
 class MainUser(TinderUser):
     """
     The main class in our application. For it, we will search for similar users, etc.
     """
 
-    def __init__(self, vk_client, count_for_search: int = 15, debug=DEBUG):
+    def __init__(self, vk_client, count_for_search: int = 15, debug=DEBUG, desired_age_from: int = None,
+                 desired_age_to: int = None, interactive: bool = True, snapshots: MainUserSnapshots = None):
+        """
+        :param desired_age_from: min age of search. A missing age is taken from the last run
+        :param desired_age_to: max age of search
+        :param interactive: ask ages when both of them are not given
+        :param snapshots: snapshots of main users. With a fresh snapshot the main user is created without
+                          requests to VK API, its profile, friends and groups are refreshed in background
+        """
+
         super().__init__(vk_client=vk_client)
+        # the profile is swapped by the background refresh while features of it can be compiled
+        self._profile_lock = threading.Lock()
         self._user_token = None
+        self._feature_profile = None
+        self.snapshots = snapshots
+        self.refresh_thread = None
 
         self.screen_name = None
-        self.desired_age_from = None
-        self.desired_age_to = None
+        self.desired_age_from = desired_age_from
+        self.desired_age_to = desired_age_to
+        self.interactive = interactive
         self.count_for_search = count_for_search
         self.offset_for_search = 0
+        self.session_state = None
 
         self._init_main_user(debug=debug)
 
@@ -222,76 +479,176 @@ class MainUser(TinderUser):
         It initializes instance of Main user
         """
 
-        profile_info = self._get_profile_info()
-        self._init_default_params(profile_info)
+        snapshot = None
+        if self.snapshots is not None and self.vk_client.access_token is not None:
+            snapshot = self.snapshots.get(self.vk_client.access_token)
 
-        db.init_user_in_last_run_state(self._tinder_user_id)
+        if snapshot is not None:
+            self._init_default_params(snapshot['profile'], friends=snapshot['friends'], groups=snapshot['groups'])
+            self.refresh_thread = threading.Thread(target=self._refresh_profile, daemon=True)
+            self.refresh_thread.start()
+        else:
+            self._init_default_params(self._get_profile_info())
+            self._save_snapshot()
+
+        self.session_state = SessionState.load(self._tinder_user_id)
         self._set_additional_params(debug=debug)
 
+        with self._profile_lock:
+            self._feature_profile = FeatureProfile.from_user(self)
+
+    @property
+    def feature_profile(self) -> FeatureProfile:
+        """
+        Compiled features of the main user for scoring. It is rebuilt only after change of profile or desired age
+        """
+
+        with self._profile_lock:
+            if self._feature_profile is None:
+                self._feature_profile = FeatureProfile.from_user(self)
+
+            return self._feature_profile
+
+    def invalidate_feature_profile(self) -> None:
+        with self._profile_lock:
+            self._feature_profile = None
+
+    @property
+    def desired_age_from(self):
+        return self._desired_age_from
+
+    @desired_age_from.setter
+    def desired_age_from(self, value) -> None:
+        self._desired_age_from = value
+        self.invalidate_feature_profile()
+
+    @property
+    def desired_age_to(self):
+        return self._desired_age_to
+
+    @desired_age_to.setter
+    def desired_age_to(self, value) -> None:
+        self._desired_age_to = value
+        self.invalidate_feature_profile()
+
     def get_desired_age_from_from_db(self):
         """
         get the "desired_age_from"  from the last run of the app
         """
 
-        return db.get_last_desired_age_from(self._tinder_user_id)
+        return self.session_state.desired_age_from
 
     def get_desired_age_to_from_db(self) -> int:
         """
         get the "desired_age_to" from the last run of the app
         """
 
-        return db.get_last_desired_age_to(self._tinder_user_id)
+        return self.session_state.desired_age_to
 
     def _set_additional_params(self, debug) -> None:
         """
-        It ask desired age and put current offset to db. It use this method like additional initialization of instance
+        It ask desired age (when it is not given) and put current offset to db.
+        It use this method like additional initialization of instance
         """
 
-        print('There are search settings save only for session')
         if debug:
+            print('There are search settings save only for session')
             with open(PATH_TO_DATA_FOR_TEST, encoding='utf8') as f:
                 f.readline()
                 self.desired_age_from = f.readline()
                 self.desired_age_to = f.readline()
-        else:
+        elif self.interactive and self.desired_age_from is None and self.desired_age_to is None:
+            print('There are search settings save only for session')
             print('You can skip follow prompts.Then we will get values from last running ')
             self.desired_age_from = input('Give number for desired min of search age: ')
             self.desired_age_to = input('Give number for desired max of search age: ')
 
+        # the state of the last run is already loaded, new ages are saved by its checkpoint
+        if not debug:
             if not self.desired_age_from:
                 self.desired_age_from = self.get_desired_age_from_from_db()
-            else:
-                db.update_desired_age_from(int(self.desired_age_from), self._tinder_user_id)
             if not self.desired_age_to:
                 self.desired_age_to = self.get_desired_age_to_from_db()
-            else:
-                db.update_desired_age_to(int(self.desired_age_to), self._tinder_user_id)
 
             self.desired_age_from = int(self.desired_age_from)
             self.desired_age_to = int(self.desired_age_to)
+            if (self.desired_age_from, self.desired_age_to) != (self.session_state.desired_age_from,
+                                                                self.session_state.desired_age_to):
+                self.session_state.update(desired_age_from=self.desired_age_from,
+                                          desired_age_to=self.desired_age_to)
+
+        self.offset_for_search = self.session_state.current_offset
+
+    def _build_record(self, profile_info: Dict, friends: List[int] = None,
+                      groups: List[int] = None) -> CandidateRecord:
+        """
+        Build record of the main user without changing the instance
 
-        self.offset_for_search = db.get_current_offset(self._tinder_user_id)
+        :param profile_info: Dict with data for initialization of instance
+        :param friends: ids of friends, they are requested from VK API when they are not given
+        :param groups: ids of groups, they are requested from VK API when they are not given
+        """
+
+        record = CandidateRecord()
+        record.vk_id = profile_info['id']
+        record.first_name = profile_info.get('first_name', 'first name')
+        record.last_name = profile_info.get('last_name', 'last name')
+        record.sex = profile_info.get('sex', 'unknown gender')
+        record.city = '' if 'city' not in profile_info else profile_info['city']['id']
+        record.movies = profile_info.get('movies', '')
+        record.music = profile_info.get('music', '')
+        record.books = profile_info.get('books', '')
+        record.age = self._calculate_age(datetime.datetime.strptime(profile_info['bdate'], '%d.%m.%Y'))
+
+        record.friends = self.vk_client.get_friend_list(record.vk_id) if friends is None else friends
+        record.groups = self.vk_client.get_group_list(record.vk_id) if groups is None else groups
+
+        return record
 
-    def _init_default_params(self, profile_info: Dict) -> None:
+    def _set_profile(self, profile_info: Dict, record: CandidateRecord) -> None:
+        # the whole profile is replaced at once, so compiled features never mix the old and the new one
+        with self._profile_lock:
+            self._record = record
+            self._profile_info = profile_info
+            self._feature_profile = None
+
+    def _init_default_params(self, profile_info: Dict, friends: List[int] = None, groups: List[int] = None) -> None:
         """
         This is an auxiliary method for the main method with initialization.
         Initializes additional parameters of instance
 
         :param profile_info: Dict with data for initialization of instance
+        :param friends: ids of friends, they are requested from VK API when they are not given
+        :param groups: ids of groups, they are requested from VK API when they are not given
         """
 
-        self._tinder_user_id = profile_info['id']
-        self.first_name = profile_info.get('first_name', 'first name')
-        self.last_name = profile_info.get('last_name', 'last name')
-        self.sex = profile_info.get('sex', 'unknown gender')
-        self.city = '' if 'city' not in profile_info else profile_info['city']['id']
-        self.movies = profile_info.get('movies', '')
-        self.music = profile_info.get('music', '')
-        self.books = profile_info.get('books', '')
-        self.age = self._calculate_age(datetime.datetime.strptime(profile_info['bdate'], '%d.%m.%Y'))
+        self._set_profile(profile_info, self._build_record(profile_info, friends=friends, groups=groups))
+
+    def _save_snapshot(self) -> None:
+        if self.snapshots is not None and self.vk_client.access_token is not None:
+            with self._profile_lock:
+                record, profile_info = self._record, self._profile_info
 
-        self.friends = self.get_friend_list()
-        self.groups = self.get_group_list()
+            self.snapshots.put(record.vk_id, self.vk_client.access_token,
+                               {'profile': profile_info,
+                                'friends': list(record.friends),
+                                'groups': list(record.groups)})
+
+    def _refresh_profile(self) -> None:
+        """
+        Request profile, friends and groups from VK API and swap in the new profile of the main user and its snapshot
+        """
+
+        try:
+            profile_info = self._get_profile_info()
+            record = self._build_record(profile_info)
+        except Exception:
+            # the snapshot is still fresh, it will be refreshed by the next start
+            logger.warning('Profile of main user %s is not refreshed', self._tinder_user_id, exc_info=True)
+            return
+
+        self._set_profile(profile_info, record)
+        self._save_snapshot()
 
     def _get_profile_info(self) -> Dict:
         """
@@ -309,10 +666,18 @@ class MainUser(TinderUser):
 
     def update_search_offset(self, offset_for_setup) -> None:
         """
-        Update current offset for search in database
+        Update current offset for search, it is saved to database by checkpoint of session state
+        """
+
+        self.session_state.update(current_offset=int(offset_for_setup))
+
+    def close(self) -> None:
+        """
+        Save state of session to database
         """
 
-        db.update_current_offset(offset_for_setup, self._tinder_user_id)
+        if self.session_state is not None:
+            self.session_state.close()
 
     def get_search_config_obj(self) -> Dict:
         """
@@ -1,14 +1,27 @@
+from config.config_app import RETRY_BASE_DELAY, RETRY_MAX_DELAY
 from functools import wraps
 from typing import TypeVar
+import asyncio
+import random
 import re
 import time
 
 reg_exp_pattern_access_token = re.compile(
     r'https://oauth\.vk\.com/blank\.html\#access_token=(?P<user_token>\w*)\&\w*=\w*&\w*=\d*')
 
+reg_exp_pattern_vk_link = re.compile(r'https://vk\.com/id(?P<vk_id>\d+)$')
+
 StrOrInt = TypeVar('StrOrInt', str, int)
 
 
+def get_vk_id_from_link(vk_link: str) -> int:
+    """
+    Return id of user from link like "https://vk.com/id123"
+    """
+
+    return int(re.match(reg_exp_pattern_vk_link, vk_link).group('vk_id'))
+
+
 class RetryException(Exception):
     pass
 
@@ -21,20 +34,73 @@ class TinderException(Exception):
     pass
 
 
-def retry_on_error(arg: int = 5):
+class RetryLimitException(VkException):
+    pass
+
+
+class HttpException(TinderException):
+    """
+    Error of request to the match server, it is answered with its HTTP status
+    """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def get_backoff_delay(attempt: int, base_delay: float = RETRY_BASE_DELAY, max_delay: float = RETRY_MAX_DELAY) -> float:
+    """
+    Exponential backoff with full jitter: random delay from 0 to base_delay * 2^attempt (but not more than max_delay)
+
+    :param attempt: number of failed attempt, from 0
+    """
+
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def retry_on_error(arg: int = 5, base_delay: float = RETRY_BASE_DELAY, max_delay: float = RETRY_MAX_DELAY):
+    """
+    Repeat call of function when it raises RetryException, at most "arg" times, with exponential backoff.
+    RetryLimitException is raised when retries are exhausted
+    """
+
     def decor(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            countdown = arg
+            attempt = 0
             while True:
                 try:
                     return func(*args, **kwargs)
-                except RetryException:
+                except RetryException as e:
+                    print('Please wait.We are sending request')
+                    if attempt >= arg:
+                        raise RetryLimitException(f'{func.__name__} failed after {attempt + 1} attempts') from e
+                    time.sleep(get_backoff_delay(attempt, base_delay, max_delay))
+                    attempt += 1
+
+        return wrapper
+
+    return decor
+
+
+def async_retry_on_error(arg: int = 5, base_delay: float = RETRY_BASE_DELAY, max_delay: float = RETRY_MAX_DELAY):
+    """
+    The same as retry_on_error, but for coroutine functions
+    """
+
+    def decor(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            attempt = 0
+            while True:
+                try:
+                    return await func(*args, **kwargs)
+                except RetryException as e:
                     print('Please wait.We are sending request')
-                    if countdown <= 0:
-                        break
-                    countdown -= 1
-                    time.sleep(1)
+                    if attempt >= arg:
+                        raise RetryLimitException(f'{func.__name__} failed after {attempt + 1} attempts') from e
+                    await asyncio.sleep(get_backoff_delay(attempt, base_delay, max_delay))
+                    attempt += 1
 
         return wrapper
 
@@ -0,0 +1,86 @@
+from config.config_app import ASYNC_VK_MAX_CONCURRENCY, MAX_CALLS_IN_EXECUTE, USE_MUTUAL_FRIENDS
+from utils import StrOrInt, async_retry_on_error
+from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import asyncio
+
+
+class AsyncVkMachinery:
+    """
+    Asyncio client for the VK API. It has the same methods as VkMachinery, but they are coroutines.
+
+    Requests are sent by the wrapped VkMachinery in a pool of threads, so the client shares its token
+    and settings. The size of the pool bounds the count of requests in flight.
+    """
+
+    def __init__(self, vk_client, max_concurrency: int = ASYNC_VK_MAX_CONCURRENCY):
+        self.vk_client = vk_client
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    async def _run_in_executor(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    @async_retry_on_error(4)
+    async def send_request(self, method: str, params_of_query: Dict[str, str] = None):
+        """
+        Send request to the VK API and return a result (see VkMachinery.send_request).
+        The coroutine waits for the rate limiter without holding a thread of the pool
+        """
+
+        await self.vk_client.rate_limiter.acquire_async()
+        return await self._run_in_executor(self.vk_client.send_request_once, method, params_of_query)
+
+    async def users_search(self, config: Dict[str, StrOrInt]) -> List[Dict]:
+        """
+        Send request user.search to VK API and return its result (see VkMachinery.users_search)
+        """
+
+        return await self._run_in_executor(self.vk_client.users_search, config=config)
+
+    async def get_processed_data_of_tinder_users(self, searched_users: List[Dict],
+                                                 main_user_config: Dict) -> List[Dict]:
+        """
+        Get List of Tinder users and return it processed (see VkMachinery.get_processed_data_of_tinder_users)
+        """
+
+        return await self._run_in_executor(self.vk_client.get_processed_data_of_tinder_users,
+                                           searched_users=searched_users, main_user_config=main_user_config)
+
+    async def get_friend_list(self, user_id: StrOrInt) -> List[int]:
+        params = {'user_id': user_id}
+        return (await self.send_request(method='friends.get', params_of_query=params))['response']['items']
+
+    async def get_group_list(self, user_id: StrOrInt) -> List[int]:
+        params = {'user_id': user_id}
+        return (await self.send_request(method='users.getSubscriptions',
+                                        params_of_query=params))['response']['groups']['items']
+
+    async def get_photos_of_user(self, user_id: StrOrInt) -> List[Dict]:
+        params = {'owner_id': user_id, 'album_id': 'profile', 'extended': 1}
+        return (await self.send_request(method='photos.get', params_of_query=params))['response']['items']
+
+    async def get_friends_and_groups_of_users(self, user_ids: List[StrOrInt]) -> Dict[int, Dict[str, List[int]]]:
+        """
+        Get friends and groups of many users. Users are split in "execute" batches which are sent concurrently
+
+        :param user_ids: List of ids of users from the VK site
+        :return: Dict like {user_id: {'friends': [...], 'groups': [...]}}
+        """
+
+        # every user costs a call of users.getSubscriptions and a call of friends.get (or a share of one call
+        # of friends.getMutual for the whole batch), so every batch fits in one "execute" request
+        users_in_batch = MAX_CALLS_IN_EXECUTE - 1 if USE_MUTUAL_FRIENDS else MAX_CALLS_IN_EXECUTE // 2
+        batches = [user_ids[start:start + users_in_batch] for start in range(0, len(user_ids), users_in_batch)]
+
+        friends_and_groups = {}
+        for result_of_batch in await asyncio.gather(
+                *(self._run_in_executor(self.vk_client.get_friends_and_groups_of_users, batch) for batch in batches)):
+            friends_and_groups.update(result_of_batch)
+
+        return friends_and_groups
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,98 @@
+from config.config_app import VK_REQUESTS_PER_SECOND, VK_RATE_LIMIT_BURST
+from typing import Dict, Optional
+
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Client-side rate limiter (token bucket). It can be shared by threads and coroutines.
+
+    Every request takes a token. Tokens come back with constant rate, so requests converge on
+    "rate" requests per second. A caller which finds the bucket empty reserves the next token and
+    waits for it, so callers are served in order of arrival.
+    """
+
+    def __init__(self, rate: float = VK_REQUESTS_PER_SECOND, capacity: int = VK_RATE_LIMIT_BURST):
+        self.rate = rate
+        self.capacity = capacity
+
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """
+        Take a token and return how many seconds we have to wait before it can be used
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self) -> None:
+        """
+        Block the current thread until a token is available
+        """
+
+        delay = self._reserve()
+        if delay:
+            time.sleep(delay)
+
+    async def acquire_async(self) -> None:
+        """
+        Suspend the current coroutine until a token is available
+        """
+
+        delay = self._reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+    def penalize(self) -> None:
+        """
+        Drop saved tokens. It is called when the server said that we sent too many requests
+        """
+
+        with self._lock:
+            self._tokens = min(self._tokens, 0.0)
+
+
+_rate_limiters: Dict[Optional[str], TokenBucket] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(access_token: Optional[str]) -> TokenBucket:
+    """
+    Return the rate limiter of access token. VK limits requests per token, so all clients with
+    the same token share one limiter
+
+    :param access_token: access token of user
+    """
+
+    with _rate_limiters_lock:
+        if access_token not in _rate_limiters:
+            _rate_limiters[access_token] = TokenBucket()
+
+        return _rate_limiters[access_token]
+
+
+def set_rate_limit(access_token: Optional[str], rate: float,
+                   capacity: int = VK_RATE_LIMIT_BURST) -> TokenBucket:
+    """
+    Replace the rate limiter of access token, e.g. for a token with other limits
+
+    :param access_token: access token of user
+    :param rate: requests per second
+    :param capacity: max count of requests which can be sent at once
+    """
+
+    with _rate_limiters_lock:
+        _rate_limiters[access_token] = TokenBucket(rate=rate, capacity=capacity)
+
+        return _rate_limiters[access_token]
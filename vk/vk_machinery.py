@@ -1,8 +1,18 @@
-from config.config_app import VERSION_VK_API, PATH_TO_DATA_FOR_TEST, OAUTH_LINK
+from config.config_app import VERSION_VK_API, PATH_TO_DATA_FOR_TEST, OAUTH_LINK, MAX_CALLS_IN_EXECUTE
+from config.config_app import VK_RETRY_ERROR_CODES, VK_TOO_MANY_REQUESTS_ERROR_CODE
+from config.config_app import VK_API_URL, VK_HTTP_POOL_SIZE, VK_HTTP_TIMEOUT
+from config.config_app import VK_SEARCH_MAX_RESULTS, SEARCH_SHARD_WORKERS
+from config.config_app import USE_MUTUAL_FRIENDS, MAX_TARGETS_OF_GET_MUTUAL
 from utils import reg_exp_pattern_access_token, StrOrInt, retry_on_error, RetryException, VkException
-from typing import Dict, List, Union
+from vk.rate_limiter import TokenBucket, get_rate_limiter
+from database.cache import ProfileCache
+from metrics import Metrics, metrics as default_metrics
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from requests.adapters import HTTPAdapter
 
+import json
 import re
 import requests
 import time
@@ -11,13 +21,57 @@ import time
 class VkMachinery:
     _version_vk_api = VERSION_VK_API
 
-    def __init__(self):
+    def __init__(self, pool_size: int = VK_HTTP_POOL_SIZE, timeout: Tuple[float, float] = VK_HTTP_TIMEOUT,
+                 cache: ProfileCache = None, api_url: str = VK_API_URL, metrics: Metrics = None):
+        """
+        :param pool_size: max count of kept-alive connections to api.vk.com
+        :param timeout: (connect timeout, read timeout) of request in seconds
+        :param cache: cache of data of users which is consulted before requests to VK API
+        :param api_url: base url of methods of VK API (a local mock server can be given for benchmarks)
+        :param metrics: registry where latency, size of response and errors of every request are recorded
+        """
+
         self._access_token_of_user = None
+        self.api_url = api_url.rstrip('/')
+        self.metrics = metrics if metrics is not None else default_metrics
+        self.timeout = timeout
+        self.cache = cache
+        self._session = self._create_session(pool_size)
+
+    @staticmethod
+    def _create_session(pool_size: int) -> requests.Session:
+        """
+        Create HTTP session which keeps connections alive, so TCP and TLS handshakes are done once per connection
+        """
+
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        return session
+
+    def close(self) -> None:
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def initialize_vk_api(self, debug=False, access_token: str = None):
+        """
+        :param access_token: token of user, if it is not given it is asked through OAuth link
+        """
 
-    def initialize_vk_api(self, debug=False):
-        access_token = self._get_access_token(debug=debug)
+        if access_token is None:
+            access_token = self._get_access_token(debug=debug)
         self._access_token_of_user = access_token
 
+    @property
+    def access_token(self) -> Optional[str]:
+        return self._access_token_of_user
+
     def _get_access_token(self, debug) -> Union[str, bytes]:
         """
         It get users's token and put it in field of instance
@@ -42,31 +96,71 @@ class VkMachinery:
             params.update(require_params)
             return params
 
+    @property
+    def rate_limiter(self) -> TokenBucket:
+        """
+        Rate limiter shared by all clients with the same access token
+        """
+
+        return get_rate_limiter(self._access_token_of_user)
+
     @retry_on_error(4)
     def send_request(self, method: str, params_of_query: Dict[str, str] = None):
         """
-        Send request to the VK API and return a result
+        Send request to the VK API and return a result. Requests are throttled by the rate limiter of token.
+        Too many requests, internal errors of VK and transient HTTP errors are retried with exponential backoff
 
         :param str method: Any method from VK API
         :param dict params_of_query: additional params for request
-        :return: result of requests.get(...).json()
+        :return: result of the response in json
+        """
+
+        self.rate_limiter.acquire()
+        return self.send_request_once(method, params_of_query)
+
+    def send_request_once(self, method: str, params_of_query: Dict[str, str] = None):
+        """
+        Send request to the VK API without throttling and retries
+
+        :raises RetryException: when the request can be repeated later
+        :raises VkException: when VK returned an error
         """
+
         params_of_query = self._get_updated_params(params=params_of_query)
 
-        req = requests.get(f'https://api.vk.com/method/{method}', params=params_of_query).json()
-        if 'error' in req and req['error']['error_code'] == 6:
-            # Error 6 is to many request.There is can be more errors
-            time.sleep(0.2)
-            raise RetryException
+        started_at = time.perf_counter()
+        try:
+            response = self._session.get(f'{self.api_url}/{method}', params=params_of_query,
+                                         timeout=self.timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            self.metrics.observe('vk', method, time.perf_counter() - started_at, error_code=type(e).__name__,
+                                 retry=True)
+            raise RetryException(f'{method}: {e}') from e
+        seconds = time.perf_counter() - started_at
+
+        if response.status_code >= 500:
+            self.metrics.observe('vk', method, seconds, error_code=f'HTTP {response.status_code}', retry=True)
+            raise RetryException(f'{method}: HTTP {response.status_code}')
+
+        req = response.json()
+        error_code = req['error']['error_code'] if 'error' in req else None
+        self.metrics.observe('vk', method, seconds, payload_bytes=len(response.content), error_code=error_code,
+                             retry=error_code in VK_RETRY_ERROR_CODES)
+
+        if 'error' in req and req['error']['error_code'] in VK_RETRY_ERROR_CODES:
+            if req['error']['error_code'] == VK_TOO_MANY_REQUESTS_ERROR_CODE:
+                self.rate_limiter.penalize()
+            raise RetryException(req['error']['error_msg'])
         elif 'error' in req:
             raise VkException(req['error']['error_msg'])
         return req
 
-    def users_search(self, config: Dict[str, StrOrInt]) -> List[Dict]:
+    def users_search(self, config: Dict[str, StrOrInt], verbose: bool = True) -> List[Dict]:
         """
         Send request user.search to VK API and return its result
 
         :param config: config which use for search similar people
+        :param verbose: print message about waiting
         :return: List of dict of data similar people
         """
 
@@ -79,11 +173,90 @@ class VkMachinery:
                              }
 
         params_of_request = self._get_updated_params(params=params_of_request)
-        print('Waiting please.. We are searching')
+        if verbose:
+            print('Waiting please.. We are searching')
 
         req = self.send_request(method='users.search', params_of_query=params_of_request)
         return req['response']['items']
 
+    def _search_shard(self, config: Dict[str, StrOrInt], shard: Dict[str, int], page_size: int) -> List[Dict]:
+        """
+        Page through results of one shard of search. VK gives at most VK_SEARCH_MAX_RESULTS results of one query
+
+        :param config: config which use for search similar people
+        :param shard: params which narrow the search, like {'age_from': 25, 'age_to': 25, 'birth_month': 3}
+        :param page_size: count of users in one request
+        """
+
+        params_of_request = {'count': page_size, 'sex': config['sex'] % 2 + 1}
+        if config['city']:
+            params_of_request['city'] = config['city']
+        params_of_request.update(shard)
+
+        found_users = []
+        for offset in range(0, VK_SEARCH_MAX_RESULTS, page_size):
+            items = self.send_request(method='users.search',
+                                      params_of_query=dict(params_of_request, offset=offset))['response']['items']
+            found_users.extend(items)
+
+            if len(items) < page_size:
+                break
+
+        return found_users
+
+    def iter_users_search_sharded(self, config: Dict[str, StrOrInt], page_size: int = VK_SEARCH_MAX_RESULTS,
+                                  shard_by_birth_month: bool = False,
+                                  max_workers: int = SEARCH_SHARD_WORKERS) -> Iterator[List[Dict]]:
+        """
+        High-volume search. The desired age range is split into shards (one age, and optionally one month
+        of birth), so every shard stays under the limit of VK on results of one query. Shards are searched
+        in parallel with big pages, requests are throttled by the rate limiter of token.
+
+        :param config: config which use for search similar people
+        :param page_size: count of users in one request (at most VK_SEARCH_MAX_RESULTS)
+        :param shard_by_birth_month: split every age into 12 shards by month of birth
+        :param max_workers: count of shards which are searched at the same time
+        :return: Iterator of lists of new (not given before) users, a list per finished shard
+        """
+
+        shards = []
+        for age in range(int(config['desired_age_from']), int(config['desired_age_to']) + 1):
+            if shard_by_birth_month:
+                shards.extend({'age_from': age, 'age_to': age, 'birth_month': month} for month in range(1, 13))
+            else:
+                shards.append({'age_from': age, 'age_to': age})
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = [executor.submit(self._search_shard, config, shard, page_size) for shard in shards]
+        try:
+            found_ids = set()
+            for future in as_completed(futures):
+                new_users = [user for user in future.result() if user['id'] not in found_ids]
+                found_ids.update(user['id'] for user in new_users)
+
+                yield new_users
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def users_search_sharded(self, config: Dict[str, StrOrInt], page_size: int = VK_SEARCH_MAX_RESULTS,
+                             shard_by_birth_month: bool = False,
+                             max_workers: int = SEARCH_SHARD_WORKERS) -> List[Dict]:
+        """
+        High-volume search, see iter_users_search_sharded
+
+        :return: List of dict of data similar people without duplicates
+        """
+
+        found_users = []
+        for new_users in self.iter_users_search_sharded(config, page_size=page_size,
+                                                        shard_by_birth_month=shard_by_birth_month,
+                                                        max_workers=max_workers):
+            found_users.extend(new_users)
+
+        return found_users
+
     def get_processed_data_of_tinder_users(self, searched_users: List[Dict], main_user_config: Dict) -> List[Dict]:
         """
         Get List of Tinder users and return it processed
@@ -98,12 +271,187 @@ class VkMachinery:
 
         for searched_user in searched_users:
             if searched_user['is_closed'] is False:
-                opened_tinder_user_ids.append(str(searched_user['id']))
+                opened_tinder_user_ids.append(searched_user['id'])
 
-        get_users_param = {
-            'user_ids': ','.join(opened_tinder_user_ids),
-            'fields': 'sex,bdate,city,country,activities,interests,music,movies,books'
-        }
+        cached_profiles = self._get_from_cache('profile', opened_tinder_user_ids)
+        not_cached_ids = [user_id for user_id in opened_tinder_user_ids if user_id not in cached_profiles]
 
-        data_of_tinder_users = self.send_request('users.get', params_of_query=get_users_param)['response']
+        if not_cached_ids:
+            get_users_param = {
+                'user_ids': ','.join(str(user_id) for user_id in not_cached_ids),
+                'fields': 'sex,bdate,city,country,activities,interests,music,movies,books'
+            }
+
+            fetched_profiles = self.send_request('users.get', params_of_query=get_users_param)['response']
+            self._put_to_cache('profile', {profile['id']: profile for profile in fetched_profiles})
+            cached_profiles.update((profile['id'], profile) for profile in fetched_profiles)
+
+        data_of_tinder_users = [cached_profiles[user_id] for user_id in opened_tinder_user_ids
+                                if user_id in cached_profiles]
         return data_of_tinder_users
+
+    def _get_from_cache(self, field: str, user_ids: List[StrOrInt]) -> Dict[int, object]:
+        if self.cache is None:
+            return {}
+
+        return self.cache.get_many(field, user_ids)
+
+    def _put_to_cache(self, field: str, values: Dict[int, object]) -> None:
+        if self.cache is not None:
+            self.cache.put_many(field, values)
+
+    def get_friend_list(self, user_id: StrOrInt) -> List[int]:
+        """
+        Send request friends.get to VK API and return ids of friends of user
+
+        :param user_id: id of user from the VK site
+        """
+
+        params = {'user_id': user_id}
+        return self.send_request(method='friends.get', params_of_query=params)['response']['items']
+
+    def get_group_list(self, user_id: StrOrInt) -> List[int]:
+        """
+        Send request users.getSubscriptions to VK API and return ids of groups of user
+
+        :param user_id: id of user from the VK site
+        """
+
+        params = {'user_id': user_id}
+        return self.send_request(method='users.getSubscriptions',
+                                 params_of_query=params)['response']['groups']['items']
+
+    def get_photos_of_user(self, user_id: StrOrInt) -> List[Dict]:
+        """
+        Send request photos.get to VK API and return profile photos of user (with likes)
+
+        :param user_id: id of user from the VK site
+        """
+
+        params = {'owner_id': user_id, 'album_id': 'profile', 'extended': 1}
+        return self.send_request(method='photos.get', params_of_query=params)['response']['items']
+
+    def execute_batched(self, calls: List[Tuple[str, Dict]]) -> List:
+        """
+        Pack many API calls into VKScript "execute" requests and return their results
+
+        :param calls: List of pairs (method of VK API, params of method)
+        :return: List of results in the same order as calls. A failed call gives None
+        """
+
+        results = []
+        for start in range(0, len(calls), MAX_CALLS_IN_EXECUTE):
+            chunk = calls[start:start + MAX_CALLS_IN_EXECUTE]
+            code = 'return [{}];'.format(','.join(f'API.{method}({json.dumps(params)})' for method, params in chunk))
+
+            response = self.send_request(method='execute', params_of_query={'code': code})['response']
+            # VK puts false in place of every sub-call which failed (private profile, deleted user, etc.)
+            results.extend(result if result is not False else None for result in response)
+
+        return results
+
+    def get_friends_and_groups_of_users(self, user_ids: List[StrOrInt],
+                                        mutual_friends: bool = USE_MUTUAL_FRIENDS) -> Dict[int, Dict[str, List[int]]]:
+        """
+        Get friends and groups of many users with batched "execute" requests
+
+        With mutual_friends only common friends of users with the owner of token (the main user) are fetched:
+        friends.getMutual takes up to MAX_TARGETS_OF_GET_MUTUAL users per call and returns much less data than
+        full lists. Scoring gives the same points, because it counts only common friends. Common friends are
+        given in 'common_friends' and 'friends' of such users is empty, because common friends are valid only
+        for this main user. Full lists are fetched only for users whose common friends VK did not give
+
+        :param user_ids: List of ids of users from the VK site
+        :param mutual_friends: fetch only common friends with the owner of token
+        :return: Dict like {user_id: {'friends': [...], 'groups': [...]}}, users with common friends
+                 have {'friends': [], 'groups': [...], 'common_friends': [...]}
+        """
+
+        # full lists of friends from cache give the same score as common friends
+        cached_friends = self._get_from_cache('friends', user_ids)
+        cached_groups = self._get_from_cache('groups', user_ids)
+
+        ids_without_friends = [int(user_id) for user_id in user_ids if int(user_id) not in cached_friends]
+        calls = [('users.getSubscriptions', {'user_id': int(user_id)})
+                 for user_id in user_ids if int(user_id) not in cached_groups]
+        if mutual_friends:
+            for start in range(0, len(ids_without_friends), MAX_TARGETS_OF_GET_MUTUAL):
+                target_ids = ids_without_friends[start:start + MAX_TARGETS_OF_GET_MUTUAL]
+                calls.append(('friends.getMutual', {'target_uids': ','.join(map(str, target_ids))}))
+        else:
+            calls.extend(('friends.get', {'user_id': user_id}) for user_id in ids_without_friends)
+
+        fetched_friends, fetched_groups, common_friends = {}, {}, {}
+        # failed calls give empty lists for this request only, they are not cached
+        failed_friends, failed_groups = {}, {}
+        for (method, params), result in zip(calls, self.execute_batched(calls)):
+            if method == 'friends.get':
+                if result is None:
+                    failed_friends[params['user_id']] = []
+                else:
+                    fetched_friends[params['user_id']] = result['items']
+            elif method == 'friends.getMutual':
+                for common_friends_of_user in result or []:
+                    common_friends[common_friends_of_user['id']] = common_friends_of_user['common_friends']
+            elif result is None:
+                failed_groups[params['user_id']] = []
+            else:
+                fetched_groups[params['user_id']] = result['groups']['items']
+
+        if mutual_friends:
+            # e.g. the main user himself or users with hidden friends
+            ids_without_common_friends = [user_id for user_id in ids_without_friends if user_id not in common_friends]
+            calls = [('friends.get', {'user_id': user_id}) for user_id in ids_without_common_friends]
+            for (_, params), result in zip(calls, self.execute_batched(calls)):
+                if result is None:
+                    failed_friends[params['user_id']] = []
+                else:
+                    fetched_friends[params['user_id']] = result['items']
+
+        # common friends depend on the main user, so only full lists are cached
+        self._put_to_cache('friends', fetched_friends)
+        self._put_to_cache('groups', fetched_groups)
+        cached_friends.update(fetched_friends)
+        cached_friends.update(failed_friends)
+        cached_groups.update(fetched_groups)
+        cached_groups.update(failed_groups)
+
+        friends_and_groups = {}
+        for user_id in map(int, user_ids):
+            if user_id in cached_friends:
+                friends_and_groups[user_id] = {'friends': cached_friends[user_id], 'groups': cached_groups[user_id]}
+            else:
+                friends_and_groups[user_id] = {'friends': [], 'groups': cached_groups[user_id],
+                                               'common_friends': common_friends[user_id]}
+
+        return friends_and_groups
+
+    def get_photos_of_users(self, user_ids: List[StrOrInt]) -> Dict[int, List[Dict]]:
+        """
+        Get profile photos (with likes) of many users with batched "execute" requests
+
+        :param user_ids: List of ids of users from the VK site
+        :return: Dict like {user_id: [photo, ...]}
+        """
+
+        photos_of_users = self._get_from_cache('photos', user_ids)
+
+        calls = [('photos.get', {'owner_id': int(user_id), 'album_id': 'profile', 'extended': 1})
+                 for user_id in user_ids if int(user_id) not in photos_of_users]
+
+        fetched_photos, failed_photos = {}, {}
+        for (_, params), photos in zip(calls, self.execute_batched(calls)):
+            if photos is None:
+                # failed calls give no photos for this request only, they are not cached
+                failed_photos[params['owner_id']] = []
+                continue
+
+            # only likes and the first size of photo are used, so nothing else is kept
+            fetched_photos[params['owner_id']] = [{'likes': photo['likes'], 'sizes': photo['sizes'][:1]}
+                                                  for photo in photos['items']]
+
+        self._put_to_cache('photos', fetched_photos)
+        photos_of_users.update(fetched_photos)
+        photos_of_users.update(failed_photos)
+
+        return {int(user_id): photos_of_users[int(user_id)] for user_id in user_ids}
@@ -0,0 +1,108 @@
+from utils import TinderException
+from typing import Dict, Iterable
+from array import array
+
+import sqlite3
+import threading
+
+
+class TokenVocabulary:
+    """
+    Global vocabulary of terms of text fields (music, books, movies). Every term gets a small integer id,
+    so text of profile is tokenized once and matching of texts is an intersection of sets of ints.
+
+    Ids are stable across runs when the vocabulary is persisted (see open), so they can be stored
+    with profiles. Ids of new terms are given by SQLite in a transaction, so processes which share the file
+    (e.g. batch and server) never give one id to different terms. Lookups of known terms do not take the lock
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids: Dict[str, int] = {}
+        self._conn = None
+
+    def open(self, path: str) -> 'TokenVocabulary':
+        """
+        Load terms from SQLite file (e.g. the file of ProfileCache) and save new terms there.
+        It must be called before the first term is added, otherwise ids can clash
+
+        :param path: path to file
+        """
+
+        with self._lock:
+            if self._ids:
+                raise TinderException('Vocabulary must be opened before terms are added')
+
+            # transactions are begun explicitly (see add_many)
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS token_vocabulary(
+                               token_id INTEGER PRIMARY KEY,
+                               term TEXT UNIQUE NOT NULL);""")
+
+            self._ids = {term: token_id for token_id, term
+                         in self._conn.execute("""SELECT token_id, term FROM token_vocabulary""")}
+
+        return self
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add_many(self, terms: Iterable[str]) -> None:
+        """
+        Add unknown terms to the vocabulary with one transaction. Terms of a whole page of users are added
+        at once (see tinder_users.add_terms_to_vocabulary), so their records are created without writes
+
+        :param terms: normalized terms
+        """
+
+        # known terms do not take the lock
+        unknown_terms = [term for term in terms if term not in self._ids]
+        if not unknown_terms:
+            return
+
+        with self._lock:
+            new_terms = [term for term in dict.fromkeys(unknown_terms) if term not in self._ids]
+            if not new_terms:
+                return
+
+            if self._conn is None:
+                for term in new_terms:
+                    self._ids[term] = len(self._ids)
+                return
+
+            # other processes can add terms too, so ids are given by SQLite and read back
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.executemany("""INSERT OR IGNORE INTO token_vocabulary (term) VALUES (?)""",
+                                       [(term,) for term in new_terms])
+                token_ids = [self._conn.execute("""SELECT token_id FROM token_vocabulary WHERE term=?""",
+                                                (term,)).fetchone()[0]
+                             for term in new_terms]
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+            self._ids.update(zip(new_terms, token_ids))
+
+    def get_ids(self, terms: Iterable[str]) -> array:
+        """
+        Return sorted array of ids of terms without duplicates. Unknown terms are added to the vocabulary
+
+        :param terms: normalized terms (see tinder_users.tokenize_music and tinder_users.tokenize_books)
+        """
+
+        terms = list(terms)
+        self.add_many(terms)
+
+        ids = self._ids
+        return array('i', sorted({ids[term] for term in terms}))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+vocabulary = TokenVocabulary()